@@ -13,6 +13,10 @@ from elftools.elf.elffile import ELFFile
 
 from .create import create_patch
 from .create import create_patch_filenames
+from .create import create_patches
+from .create import create_patches_filenames
+from .create import create_patches_to
+from .create import create_patches_to_filenames
 from .apply import apply_patch
 from .apply import apply_patch_in_place
 from .apply import apply_patch_bsdiff
@@ -21,10 +25,14 @@ from .apply import apply_patch_in_place_filenames
 from .apply import apply_patch_bsdiff_filenames
 from .info import patch_info
 from .info import patch_info_filename
+from .common import PatchStats
+from .common import StageStats
 from .errors import Error
 from .version import __version__
 from .common import DATA_FORMATS as _DATA_FORMATS
 from .common import COMPRESSIONS as _COMPRESSIONS
+from .common import SUFFIX_ARRAY_ALGORITHMS as _SUFFIX_ARRAY_ALGORITHMS
+from .apply import ENGINES as _ENGINES
 from .data_format.elf import from_file as _data_format_elf_from_file
 
 
@@ -237,6 +245,20 @@ def heatshrink_args(args):
     }
 
 
+def compression_args(args):
+    return {
+        'compression_level': args.compression_level,
+        'compression_threads': args.compression_threads
+    }
+
+
+def bsdiff_args(args):
+    return {
+        'min_match': args.min_match,
+        'skip_ahead_size': args.skip_ahead_size
+    }
+
+
 def print_successful(filename, start_time):
     print("Successfully created '{}' in {}!".format(
         filename,
@@ -255,7 +277,13 @@ def _do_create_patch(args):
                            match_score=args.match_score,
                            match_block_size=args.match_block_size,
                            use_mmap=not args.no_mmap,
+                           suffix_array_threads=args.suffix_array_threads,
+                           suffix_array_cache_dir=args.suffix_array_cache_dir,
+                           suffix_array_cache_size=args.suffix_array_cache_size,
+                           max_memory=args.max_memory,
                            **heatshrink_args(args),
+                           **compression_args(args),
+                           **bsdiff_args(args),
                            **data_format_args(args))
     print_successful(args.patchfile, start_time)
 
@@ -273,29 +301,67 @@ def _do_create_patch_in_place(args):
                            args.segment_size,
                            args.minimum_shift_size,
                            use_mmap=not args.no_mmap,
+                           suffix_array_threads=args.suffix_array_threads,
+                           suffix_array_cache_dir=args.suffix_array_cache_dir,
+                           suffix_array_cache_size=args.suffix_array_cache_size,
+                           jobs=args.jobs,
                            **heatshrink_args(args),
+                           **compression_args(args),
+                           **bsdiff_args(args),
                            **data_format_args(args))
     print_successful(args.patchfile, start_time)
 
 
+def _do_create_patches(args):
+    start_time = time.time()
+
+    if len(args.files) % 2 != 0:
+        raise Error('Expected pairs of to and patch files.')
+
+    patchfiles = args.files[1::2]
+    create_patches_filenames(args.fromfile,
+                             args.files[::2],
+                             patchfiles,
+                             args.compression,
+                             args.suffix_array_algorithm,
+                             use_mmap=not args.no_mmap,
+                             suffix_array_threads=args.suffix_array_threads,
+                             suffix_array_cache_dir=args.suffix_array_cache_dir,
+                             suffix_array_cache_size=args.suffix_array_cache_size,
+                             jobs=args.jobs,
+                             use_processes=args.processes,
+                             **heatshrink_args(args),
+                             **compression_args(args),
+                             **bsdiff_args(args))
+
+    for patchfile in patchfiles:
+        print_successful(patchfile, start_time)
+
+
 def _do_create_patch_bsdiff(args):
     start_time = time.time()
     create_patch_filenames(args.fromfile,
                            args.tofile,
                            args.patchfile,
-                           patch_type='bsdiff')
+                           patch_type='bsdiff',
+                           **bsdiff_args(args))
     print_successful(args.patchfile, start_time)
 
 
 def _do_apply_patch(args):
     start_time = time.time()
-    apply_patch_filenames(args.fromfile, args.patchfile, args.tofile)
+    apply_patch_filenames(args.fromfile,
+                          args.patchfile,
+                          args.tofile,
+                          args.engine,
+                          args.mmap,
+                          args.hdiffpatch_cache_size)
     print_successful(args.tofile, start_time)
 
 
 def _do_apply_patch_in_place(args):
     start_time = time.time()
-    apply_patch_in_place_filenames(args.memfile, args.patchfile)
+    apply_patch_in_place_filenames(args.memfile, args.patchfile, args.engine)
     print_successful(args.memfile, start_time)
 
 
@@ -564,6 +630,66 @@ def add_heatshrink_args(subparser):
         help='Heatshrink lookahead sz2 setting (default: %(default)s).')
 
 
+def add_compression_args(subparser):
+    subparser.add_argument(
+        '--compression-level',
+        type=int,
+        help=('Compression level of lzma, bz2, zstd and lz4. A lower level '
+              'creates a bigger patch faster (default: highest level, '
+              'except 6 for lzma).'))
+    subparser.add_argument(
+        '--compression-threads',
+        type=int,
+        default=1,
+        help='Number of zstd compression threads (default: %(default)s).')
+
+
+def add_bsdiff_args(subparser):
+    subparser.add_argument(
+        '--min-match',
+        type=int,
+        default=8,
+        help=('Number of bytes a match must be longer than the match at the '
+              'current offset to start a new control in the bsdiff algorithm '
+              '(default: %(default)s).'))
+    subparser.add_argument(
+        '--skip-ahead-size',
+        type=to_binary_size,
+        default=0,
+        help=('Use matches of at least this size at the current offset '
+              'without searching for longer matches in the bsdiff '
+              'algorithm. Faster for similar files, but may create bigger '
+              'patches. 0 to disable (default: %(default)s).'))
+
+
+def add_suffix_array_args(subparser):
+    subparser.add_argument(
+        '--suffix-array-threads',
+        type=int,
+        help=('Number of threads used by the divsufsort-mt suffix array '
+              'algorithm (default: number of CPUs).'))
+    subparser.add_argument(
+        '--suffix-array-cache-dir',
+        help=('Directory to store suffix arrays in, to not create them '
+              'again for the same from file.'))
+    subparser.add_argument(
+        '--suffix-array-cache-size',
+        type=to_binary_size,
+        help=('Maximum suffix array cache size. Least recently used '
+              'suffix arrays are removed when exceeded (default: no '
+              'limit).'))
+
+
+def add_engine_arg(subparser):
+    subparser.add_argument(
+        '-e', '--engine',
+        choices=_ENGINES,
+        default='auto',
+        help=('Apply engine. auto uses the C engine if it supports the '
+              'patch, and the Python engine otherwise (default: '
+              '%(default)s).'))
+
+
 def _main():
     parser = argparse.ArgumentParser(description='Binary delta encoding utility.')
 
@@ -600,15 +726,16 @@ def _main():
               '(default: %(default)s).'))
     subparser.add_argument(
         '-a', '--algorithm',
-        choices=('bsdiff', 'hdiffpatch', 'match-blocks'),
+        choices=('bsdiff', 'hdiffpatch', 'match-blocks', 'cdc-bsdiff'),
         default='bsdiff',
         help='Diff algorithm (default: %(default)s).')
     subparser.add_argument(
         '-s', '--suffix-array-algorithm',
-        choices=('sais', 'divsufsort'),
+        choices=_SUFFIX_ARRAY_ALGORITHMS,
         default='divsufsort',
         help=('Suffix array algorithm used by bsdiff algorithm '
               '(default: %(default)s).'))
+    add_suffix_array_args(subparser)
     subparser.add_argument(
         '--match-score',
         type=int,
@@ -620,10 +747,19 @@ def _main():
         default=64,
         help=('Match block size used by match-blocks algorithm '
               '(default: %(default)s).'))
+    subparser.add_argument(
+        '--max-memory',
+        type=to_binary_size,
+        help=('Maximum memory used by the bsdiff algorithm when creating a '
+              'sequential patch. The to file is diffed in windows if '
+              'needed. The from and to files are counted unless memory '
+              'mapped.'))
     subparser.add_argument('--no-mmap',
                            action='store_true',
                            help='Do not use mmap.')
     add_heatshrink_args(subparser)
+    add_compression_args(subparser)
+    add_bsdiff_args(subparser)
     add_data_format_args(subparser)
     subparser.add_argument('fromfile', help='From file.')
     subparser.add_argument('tofile', help='To file.')
@@ -638,9 +774,10 @@ def _main():
                            default='lzma',
                            help='Compression algorithm (default: %(default)s).')
     subparser.add_argument('-s', '--suffix-array-algorithm',
-                           choices=('sais', 'divsufsort'),
+                           choices=_SUFFIX_ARRAY_ALGORITHMS,
                            default='divsufsort',
                            help='Suffix array algorithm (default: %(default)s).')
+    add_suffix_array_args(subparser)
     subparser.add_argument('--memory-size',
                            required=True,
                            type=to_binary_size,
@@ -654,19 +791,63 @@ def _main():
         '--minimum-shift-size',
         type=to_binary_size,
         help='Minimum shift size (default: 2 * segment size).')
+    subparser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=1,
+        help='Number of segments to create in parallel (default: %(default)s).')
     subparser.add_argument('--no-mmap',
                            action='store_true',
                            help='Do not use mmap.')
     add_heatshrink_args(subparser)
+    add_compression_args(subparser)
+    add_bsdiff_args(subparser)
     add_data_format_args(subparser)
     subparser.add_argument('fromfile', help='From file.')
     subparser.add_argument('tofile', help='To file.')
     subparser.add_argument('patchfile', help='Created patch file.')
     subparser.set_defaults(func=_do_create_patch_in_place)
 
+    # Create many sequential patches subparser.
+    subparser = subparsers.add_parser(
+        'create_patches',
+        description=('Create sequential patches from one from file to many '
+                     'to files.'))
+    subparser.add_argument('-c', '--compression',
+                           choices=sorted(_COMPRESSIONS),
+                           default='lzma',
+                           help='Compression algorithm (default: %(default)s).')
+    subparser.add_argument('-s', '--suffix-array-algorithm',
+                           choices=_SUFFIX_ARRAY_ALGORITHMS,
+                           default='divsufsort',
+                           help='Suffix array algorithm (default: %(default)s).')
+    add_suffix_array_args(subparser)
+    subparser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=1,
+        help='Number of patches to create in parallel (default: %(default)s).')
+    subparser.add_argument(
+        '--processes',
+        action='store_true',
+        help='Create patches in parallel in processes instead of threads.')
+    subparser.add_argument('--no-mmap',
+                           action='store_true',
+                           help='Do not use mmap.')
+    add_heatshrink_args(subparser)
+    add_compression_args(subparser)
+    add_bsdiff_args(subparser)
+    subparser.add_argument('fromfile', help='From file.')
+    subparser.add_argument('files',
+                           nargs='+',
+                           metavar='tofile patchfile',
+                           help='To file and created patch file pairs.')
+    subparser.set_defaults(func=_do_create_patches)
+
     # Create bsdiff patch subparser.
     subparser = subparsers.add_parser('create_patch_bsdiff',
                                       description='Create a bsdiff patch.')
+    add_bsdiff_args(subparser)
     subparser.add_argument('fromfile', help='From file.')
     subparser.add_argument('tofile', help='To file.')
     subparser.add_argument('patchfile', help='Created patch file.')
@@ -676,6 +857,18 @@ def _main():
     subparser = subparsers.add_parser(
         'apply_patch',
         description='Apply given sequential or hdiffpatch patch.')
+    add_engine_arg(subparser)
+    subparser.add_argument(
+        '--mmap',
+        action='store_true',
+        help=('Memory map the from and to files, and the decompressed '
+              'hdiffpatch patch. Hdiffpatch patches are only applied in '
+              'bounded memory with this option.'))
+    subparser.add_argument(
+        '--hdiffpatch-cache-size',
+        type=to_binary_size,
+        help=('Maximum hdiffpatch patch cache size in bytes (default: '
+              '64 MiB).'))
     subparser.add_argument('fromfile', help='From file.')
     subparser.add_argument('patchfile', help='Patch file.')
     subparser.add_argument('tofile', help='Created to file.')
@@ -684,6 +877,7 @@ def _main():
     # In-place apply patch subparser.
     subparser = subparsers.add_parser('apply_patch_in_place',
                                       description='Apply given in-place patch.')
+    add_engine_arg(subparser)
     subparser.add_argument('memfile', help='Memory file.')
     subparser.add_argument('patchfile', help='Patch file.')
     subparser.set_defaults(func=_do_apply_patch_in_place)
@@ -1,5 +1,8 @@
 import os
+import mmap
 import struct
+import tempfile
+from contextlib import contextmanager
 from lzma import LZMADecompressor
 from bz2 import BZ2Decompressor
 from .errors import Error
@@ -25,10 +28,34 @@ from .common import file_read
 from .common import unpack_size
 from .common import peek_header_type
 from .common import unpack_header
+from .common import collect_stats
+from .common import stage
+from .common import add_chunks
 from .data_format import create_readers
 from . import bsdiff
 from . import hdiffpatch
 
+try:
+    from . import capply
+except ImportError:
+    capply = None
+
+
+# Size of the buffers used when applying patches. Data is decompressed,
+# added and written in chunks of up to this size.
+CHUNK_SIZE = 65536
+
+ENGINES = ('auto', 'c', 'python')
+
+# Compressions supported by the C engine.
+C_ENGINE_COMPRESSIONS = ('none', 'lzma', 'crle', 'heatshrink')
+
+# The C library uses an int for sizes.
+C_ENGINE_MAXIMUM_SIZE = 0x7fffffff
+
+# Default maximum size of the hdiffpatch patch cache.
+HDIFFPATCH_CACHE_SIZE = 64 * 1024 * 1024
+
 
 class PatchReader(object):
 
@@ -51,6 +78,8 @@ class PatchReader(object):
             raise Error(format_bad_compression_string(compression))
 
         self._fpatch = fpatch
+        self._data = memoryview(b'')
+        self._offset = 0
 
     def read(self, size):
         return self.decompress(size)
@@ -60,14 +89,79 @@ class PatchReader(object):
 
         """
 
-        buf = b''
+        if self._offset + size <= len(self._data):
+            data = bytes(self._data[self._offset:self._offset + size])
+            self._offset += size
+        else:
+            data = bytearray(size)
+            self.decompress_into(memoryview(data))
+            data = bytes(data)
+
+        return data
+
+    def unpack_size(self):
+        """Unpack a size. Parsed directly from the internal buffer if
+        possible, which is a lot faster than reading one byte at a
+        time.
+
+        """
+
+        data = self._data
+        offset = self._offset
+
+        if len(data) - offset < 10:
+            return unpack_size(self)
+
+        byte = data[offset]
+        is_signed = (byte & 0x40)
+        value = (byte & 0x3f)
+        shift = 6
+        offset += 1
+
+        while byte & 0x80:
+            byte = data[offset]
+            value |= ((byte & 0x7f) << shift)
+            shift += 7
+            offset += 1
+
+        self._offset = offset
+
+        if is_signed:
+            value *= -1
+
+        return value
+
+    def decompress_into(self, buf):
+        """Decompress ``len(buf)`` bytes into given writable buffer.
+
+        """
+
+        size = len(buf)
+        offset = 0
+
+        while offset < size:
+            if self._offset == len(self._data):
+                self._decompress_chunk()
+
+            chunk_size = min(size - offset, len(self._data) - self._offset)
+            buf[offset:offset + chunk_size] = self._data[
+                self._offset:self._offset + chunk_size]
+            offset += chunk_size
+            self._offset += chunk_size
+
+    def _decompress_chunk(self):
+        """Decompress up to `CHUNK_SIZE` bytes into the internal buffer, so
+        that many small reads, for example of sizes, are cheap.
+
+        """
 
-        while len(buf) < size:
-            if self.decompressor.eof:
-                raise Error('Early end of patch data.')
+        if self.decompressor.eof:
+            raise Error('Early end of patch data.')
 
+        with stage('decompress'):
             if self.decompressor.needs_input:
-                data = self._fpatch.read(4096)
+                with stage('read'):
+                    data = self._fpatch.read(4096)
 
                 if not data:
                     raise Error('Out of patch data.')
@@ -75,45 +169,291 @@ class PatchReader(object):
                 data = b''
 
             try:
-                buf += self.decompressor.decompress(data, size - len(buf))
+                data = self.decompressor.decompress(data, CHUNK_SIZE)
             except Exception:
                 raise Error('Patch decompression failed.')
 
-        return buf
+        self._data = memoryview(data)
+        self._offset = 0
 
     @property
     def eof(self):
-        return self.decompressor.eof
+        return (self._offset == len(self._data)) and self.decompressor.eof
 
 
-def iter_chunks(patch_reader, to_pos, to_size, message):
-    size = unpack_size(patch_reader)
+def read_into(fin, buf, message):
+    """Read exactly ``len(buf)`` bytes from `fin` into given writable
+    buffer. Uses ``readinto()`` if available to avoid copying.
 
-    if to_pos + size > to_size:
+    """
+
+    size = len(buf)
+
+    if hasattr(fin, 'readinto'):
+        offset = 0
+
+        while offset < size:
+            read_size = fin.readinto(buf[offset:])
+
+            if not read_size:
+                break
+
+            offset += read_size
+    else:
+        data = fin.read(size)
+        offset = len(data)
+        buf[:offset] = data
+
+    if offset != size:
         raise Error(message)
 
+
+class OffsetReader(object):
+    """Reads from given file at its own offset, independently of other
+    users of the same file.
+
+    """
+
+    def __init__(self, fin, offset):
+        self._fin = fin
+        self._offset = offset
+
+    def readinto(self, buf):
+        self._fin.seek(self._offset, os.SEEK_SET)
+        read_into(self._fin, buf, 'Out of from data.')
+        self._offset += len(buf)
+
+        return len(buf)
+
+    def seek(self, offset, whence):
+        self._offset += offset
+
+
+class OffsetWriter(object):
+    """Writes to given file at its own offset, independently of other
+    users of the same file.
+
+    """
+
+    def __init__(self, fout, offset):
+        self._fout = fout
+        self._offset = offset
+
+    def write(self, data):
+        self._fout.seek(self._offset, os.SEEK_SET)
+        self._fout.write(data)
+        self._offset += len(data)
+
+
+class CountingWriter(object):
+    """Writes to given file and counts the number of bytes written.
+
+    """
+
+    def __init__(self, fout):
+        self._fout = fout
+        self.size = 0
+
+    def write(self, data):
+        self._fout.write(data)
+        self.size += len(data)
+
+
+def apply_patch_chunks(patch_reader, ffrom, fto, to_size, dfdiff):
+    """Apply diff, extra and adjustment chunks from `patch_reader` until
+    `to_size` bytes have been created.
+
+    Diff and extra data are decompressed directly into a reusable to
+    buffer, where from data (and data format diff data, if any) is
+    added in place. The to buffer is written to `fto` once full.
+
+    """
+
+    to_buf = memoryview(bytearray(min(CHUNK_SIZE, to_size)))
+    from_buf = memoryview(bytearray(len(to_buf)))
+    to_buf_size = len(to_buf)
+    to_buf_offset = 0
+    to_pos = 0
+    number_of_chunks = 0
+
+    while to_pos < to_size:
+        for is_diff, message in [(True, 'Patch diff data too long.'),
+                                 (False, 'Patch extra data too long.')]:
+            size = patch_reader.unpack_size()
+
+            if to_pos + size > to_size:
+                raise Error(message)
+
+            to_pos += size
+
+            while size > 0:
+                chunk_size = min(size, to_buf_size - to_buf_offset)
+                chunk = to_buf[to_buf_offset:to_buf_offset + chunk_size]
+                patch_reader.decompress_into(chunk)
+
+                if is_diff:
+                    from_chunk = from_buf[:chunk_size]
+                    read_into(ffrom, from_chunk, 'Out of from data.')
+                    bsdiff.add_bytes_inplace(chunk, from_chunk)
+
+                if dfdiff is not None:
+                    dfdiff_chunk = from_buf[:chunk_size]
+                    read_into(dfdiff, dfdiff_chunk, 'Out of data format data.')
+                    bsdiff.add_bytes_inplace(chunk, dfdiff_chunk)
+
+                size -= chunk_size
+                to_buf_offset += chunk_size
+
+                if to_buf_offset == to_buf_size:
+                    with stage('write'):
+                        fto.write(to_buf)
+
+                    to_buf_offset = 0
+
+        # Adjustment.
+        ffrom.seek(patch_reader.unpack_size(), os.SEEK_CUR)
+        number_of_chunks += 1
+
+    if to_buf_offset > 0:
+        with stage('write'):
+            fto.write(to_buf[:to_buf_offset])
+
+    add_chunks(number_of_chunks)
+
+
+def add_data_format_diff(chunk, dfdiff, dfdiff_buf):
     offset = 0
 
-    while offset < size:
-        chunk_size = min(size - offset, 4096)
-        offset += chunk_size
-        patch_data = patch_reader.decompress(chunk_size)
+    while offset < len(chunk):
+        size = min(len(chunk) - offset, len(dfdiff_buf))
+        dfdiff_chunk = dfdiff_buf[:size]
+        read_into(dfdiff, dfdiff_chunk, 'Out of data format data.')
+        bsdiff.add_bytes_inplace(chunk[offset:offset + size], dfdiff_chunk)
+        offset += size
 
-        yield chunk_size, patch_data
 
+def apply_patch_chunks_into(patch_reader,
+                            from_data,
+                            from_pos,
+                            to_data,
+                            dfdiff):
+    """Apply diff, extra and adjustment chunks from `patch_reader` to
+    `from_data`, starting at `from_pos`, until the writable buffer
+    `to_data` is full.
 
-def iter_diff_chunks(patch_reader, to_pos, to_size):
-    return iter_chunks(patch_reader,
-                       to_pos,
-                       to_size,
-                       "Patch diff data too long.")
+    Diff and extra data are decompressed directly into `to_data`, where
+    from data is added in place. Only data format diff data, if any, is
+    read into an intermediate buffer.
 
+    """
 
-def iter_extra_chunks(patch_reader, to_pos, to_size):
-    return iter_chunks(patch_reader,
-                       to_pos,
-                       to_size,
-                       "Patch extra data too long.")
+    to_size = len(to_data)
+    to_pos = 0
+    number_of_chunks = 0
+
+    if dfdiff is not None:
+        dfdiff_buf = memoryview(bytearray(min(CHUNK_SIZE, to_size)))
+
+    while to_pos < to_size:
+        for is_diff, message in [(True, 'Patch diff data too long.'),
+                                 (False, 'Patch extra data too long.')]:
+            size = patch_reader.unpack_size()
+
+            if to_pos + size > to_size:
+                raise Error(message)
+
+            if size == 0:
+                continue
+
+            chunk = to_data[to_pos:to_pos + size]
+            patch_reader.decompress_into(chunk)
+
+            if is_diff:
+                if from_pos < 0 or from_pos + size > len(from_data):
+                    raise Error('Out of from data.')
+
+                bsdiff.add_bytes_inplace(chunk,
+                                         from_data[from_pos:from_pos + size])
+                from_pos += size
+
+            if dfdiff is not None:
+                add_data_format_diff(chunk, dfdiff, dfdiff_buf)
+
+            to_pos += size
+
+        # Adjustment.
+        from_pos += patch_reader.unpack_size()
+        number_of_chunks += 1
+
+    add_chunks(number_of_chunks)
+
+
+@contextmanager
+def open_mmap(f, access):
+    """Yields an mmap of given file, or None if it cannot be mapped. The
+    mmap is closed on exit, or when garbage collected if views of it
+    are still alive, for example after an error.
+
+    """
+
+    try:
+        data = mmap.mmap(f.fileno(), 0, access=access)
+    except (AttributeError, ValueError, OSError):
+        yield None
+
+        return
+
+    try:
+        yield data
+    finally:
+        try:
+            data.close()
+        except BufferError:
+            pass
+
+
+@contextmanager
+def open_to_mmap(fto, to_size):
+    """Yields a writable view of `to_size` bytes of given to file, mapped
+    from its current position, or None if it cannot be mapped. The file
+    is resized to fit the to data.
+
+    """
+
+    to_offset = fto.tell()
+
+    try:
+        fto.truncate(to_offset + to_size)
+    except (AttributeError, ValueError, OSError):
+        yield None
+
+        return
+
+    with open_mmap(fto, mmap.ACCESS_WRITE) as to_mmap:
+        if to_mmap is None:
+            yield None
+        else:
+            with memoryview(to_mmap) as to_view:
+                with to_view[to_offset:to_offset + to_size] as to_data:
+                    yield to_data
+
+            to_mmap.flush()
+            fto.seek(to_offset + to_size, os.SEEK_SET)
+
+
+@contextmanager
+def open_from_mmap(ffrom):
+    """Yields the from data and the position to start reading it at. It
+    is an mmap of given from file if possible, and bytes read from
+    its current position otherwise.
+
+    """
+
+    with open_mmap(ffrom, mmap.ACCESS_READ) as from_mmap:
+        if from_mmap is None:
+            yield ffrom.read(), 0
+        else:
+            yield from_mmap, ffrom.tell()
 
 
 def patch_data_length(fpatch):
@@ -244,11 +584,7 @@ def read_header_bsdiff(fpatch):
     return ctrl_size, diff_size, to_size
 
 
-def shift_memory(fmem, memory_size, shift_size, from_size):
-    """Shift given memory.
-
-    """
-
+def check_memory_size(fmem, memory_size):
     size = file_size(fmem)
 
     if size < memory_size:
@@ -257,6 +593,13 @@ def shift_memory(fmem, memory_size, shift_size, from_size):
                 memory_size,
                 size))
 
+
+def shift_memory(fmem, memory_size, shift_size, from_size):
+    """Shift given memory.
+
+    """
+
+    check_memory_size(fmem, memory_size)
     fmem.seek(0, os.SEEK_SET)
     from_data = fmem.read(from_size)
     fmem.seek(shift_size, os.SEEK_SET)
@@ -277,31 +620,13 @@ def apply_patch_in_place_segment(fmem,
     if dfpatch_size > 0:
         raise NotImplementedError()
 
-    to_pos = 0
-
-    while to_pos < to_size:
-        # Diff data.
-        for chunk_size, patch_data in iter_diff_chunks(patch_reader,
-                                                       to_pos,
-                                                       to_size):
-            fmem.seek(from_offset, os.SEEK_SET)
-            from_data = fmem.read(chunk_size)
-            from_offset += chunk_size
-            fmem.seek(to_offset + to_pos, os.SEEK_SET)
-            fmem.write(bsdiff.add_bytes(patch_data, from_data))
-            to_pos += chunk_size
-
-        # Extra data.
-        fmem.seek(to_offset + to_pos, os.SEEK_SET)
-
-        for chunk_size, patch_data in iter_extra_chunks(patch_reader,
-                                                        to_pos,
-                                                        to_size):
-            fmem.write(patch_data)
-            to_pos += chunk_size
-
-        # Adjustment.
-        from_offset += unpack_size(patch_reader)
+    # The from data of a segment is always after its to data, so
+    # buffering the to data does not affect reading the from data.
+    apply_patch_chunks(patch_reader,
+                       OffsetReader(fmem, from_offset),
+                       OffsetWriter(fmem, to_offset),
+                       to_size,
+                       None)
 
 
 def create_data_format_readers(patch_reader, ffrom, to_size):
@@ -310,7 +635,12 @@ def create_data_format_readers(patch_reader, ffrom, to_size):
     if dfpatch_size > 0:
         data_format = unpack_size(patch_reader)
         patch = patch_reader.decompress(dfpatch_size)
-        dfdiff, ffrom = create_readers(data_format, ffrom, patch, to_size)
+
+        with stage('data-format'):
+            dfdiff, ffrom = create_readers(data_format,
+                                           ffrom,
+                                           patch,
+                                           to_size)
 
         # with open('data-format-from-apply.bin', 'wb') as fout:
         #     fout.write(file_read(ffrom))
@@ -322,12 +652,101 @@ def create_data_format_readers(patch_reader, ffrom, to_size):
     return dfdiff, ffrom
 
 
-def apply_patch(ffrom, fpatch, fto):
+def check_engine(engine):
+    if engine not in ENGINES:
+        raise Error(
+            "Expected engine 'auto', 'c' or 'python', but got '{}'.".format(
+                engine))
+
+
+def is_c_engine_used(engine, compression, size):
+    """Returns True if the C engine shall be used to apply a patch with
+    given compression and to or memory size. Raises an error if the C
+    engine was requested, but cannot be used.
+
+    """
+
+    if engine == 'python':
+        return False
+
+    if capply is None:
+        reason = 'The C engine is not available.'
+    elif compression not in C_ENGINE_COMPRESSIONS:
+        reason = "The C engine does not support compression '{}'.".format(
+            compression)
+    elif size > C_ENGINE_MAXIMUM_SIZE:
+        reason = 'The C engine does not support sizes over {} bytes.'.format(
+            C_ENGINE_MAXIMUM_SIZE)
+    else:
+        return True
+
+    if engine == 'c':
+        raise Error(reason)
+
+    return False
+
+
+def call_c_engine(engine, function, *args, is_written=None):
+    """Call given C engine function and return its result. Returns None
+    if it failed in automatic engine mode, in which case the patch
+    should be applied by the Python engine instead. It supports more
+    data formats and gives more detailed error messages. The Python
+    engine cannot be used if `is_written` is given and returns True,
+    as the to-data is then partially written.
+
+    The C engine reads, decompresses, applies and writes in one go, so
+    all its work is recorded in the apply stage.
+
+    """
+
+    try:
+        with stage('apply'):
+            return function(*args)
+    except RuntimeError as e:
+        if engine == 'c' or (is_written is not None and is_written()):
+            raise Error(str(e))
+
+        return None
+
+
+def apply_patch(ffrom,
+                fpatch,
+                fto,
+                engine='auto',
+                use_mmap=False,
+                hdiffpatch_cache_size=None,
+                stats=None):
     """Apply given sequential or hdiffpatch patch `fpatch` to `ffrom` to
     create `fto`. Returns the size of the created to-data.
 
     All arguments are file-like objects.
 
+    `engine` is the sequential patch apply engine; ``'c'``, ``'python'``
+    or ``'auto'``. The C engine applies the patch with the GIL
+    released, reading the from and patch data and writing the to-data
+    in chunks. It supports all compressions but bz2, zstd and lz4, and
+    no data formats. ``'auto'`` uses the C engine if the
+    patch is supported by it, and the Python engine otherwise. Errors
+    raised by the C engine after it has written to `fto` are not
+    retried by the Python engine.
+
+    Sequential patches are applied to memory mapped from and to files
+    if `use_mmap` is ``True``, without copying the from data or
+    buffering the to data. `fto` must then be opened for both reading
+    and writing, for example in ``'w+b'`` mode. Files that cannot be
+    memory mapped are read and written as usual. Hdiffpatch patches
+    are applied to memory mapped files as well, using a patch cache of
+    at most `hdiffpatch_cache_size` bytes. See
+    :func:`~detools.apply_patch_hdiffpatch()`. Hdiffpatch patches are
+    only applied in bounded memory if `use_mmap` is ``True``, as the
+    whole from data, decompressed patch and to data are otherwise
+    loaded into memory.
+
+    Sizes, times, the peak memory usage of the process and chunk count
+    of the applied patch, as well as wall and CPU time per stage, are
+    recorded in `stats`, if given. It must be a
+    :class:`~detools.PatchStats`.
+
     >>> ffrom = open('foo.mem', 'rb')
     >>> fpatch = open('foo.patch', 'rb')
     >>> fto = open('foo.new', 'wb')
@@ -336,70 +755,153 @@ def apply_patch(ffrom, fpatch, fto):
 
     """
 
+    check_engine(engine)
     patch_type = peek_header_type(fpatch)
 
-    if patch_type == PATCH_TYPE_SEQUENTIAL:
-        return apply_patch_sequential(ffrom, fpatch, fto)
-    elif patch_type == PATCH_TYPE_HDIFFPATCH:
-        return apply_patch_hdiffpatch(ffrom, fpatch, fto)
-    else:
-        raise Error('Bad patch type {}.'.format(patch_type))
+    if stats is not None:
+        stats.from_size = file_size(ffrom) - ffrom.tell()
+        stats.patch_size = file_size(fpatch) - fpatch.tell()
+
+    with collect_stats(stats):
+        if patch_type == PATCH_TYPE_SEQUENTIAL:
+            to_size = apply_patch_sequential(ffrom,
+                                             fpatch,
+                                             fto,
+                                             engine,
+                                             use_mmap)
+        elif patch_type == PATCH_TYPE_HDIFFPATCH:
+            to_size = apply_patch_hdiffpatch(ffrom,
+                                             fpatch,
+                                             fto,
+                                             use_mmap,
+                                             hdiffpatch_cache_size)
+        else:
+            raise Error('Bad patch type {}.'.format(patch_type))
+
+    if stats is not None:
+        stats.to_size = to_size
+
+    return to_size
 
 
-def apply_patch_sequential(ffrom, fpatch, fto):
+def apply_patch_sequential(ffrom, fpatch, fto, engine, use_mmap):
+    patch_offset = fpatch.tell()
     compression, to_size = read_header_sequential(fpatch)
 
     if to_size == 0:
         return to_size
 
+    if use_mmap:
+        with open_to_mmap(fto, to_size) as to_data:
+            if to_data is not None:
+                apply_patch_sequential_into(ffrom,
+                                            fpatch,
+                                            patch_offset,
+                                            to_data,
+                                            compression,
+                                            engine)
+
+                return to_size
+
+    if is_c_engine_used(engine, compression, to_size):
+        from_offset = ffrom.tell()
+        patch_size = file_size(fpatch) - patch_offset
+        fpatch.seek(patch_offset, os.SEEK_SET)
+        fto_counting = CountingWriter(fto)
+
+        result = call_c_engine(engine,
+                               capply.apply_patch_files,
+                               ffrom,
+                               fpatch,
+                               fto_counting,
+                               patch_size,
+                               is_written=lambda: fto_counting.size > 0)
+
+        if result is not None:
+            add_chunks(result[1])
+
+            return to_size
+
+        ffrom.seek(from_offset, os.SEEK_SET)
+        fpatch.seek(patch_offset, os.SEEK_SET)
+        read_header_sequential(fpatch)
+
     patch_reader = PatchReader(fpatch, compression)
     dfdiff, ffrom = create_data_format_readers(patch_reader, ffrom, to_size)
-    to_pos = 0
 
-    while to_pos < to_size:
-        # Diff data.
-        for chunk_size, patch_data in iter_diff_chunks(patch_reader,
-                                                       to_pos,
-                                                       to_size):
-            from_data = ffrom.read(chunk_size)
-            data = bsdiff.add_bytes(patch_data, from_data)
+    with stage('apply'):
+        apply_patch_chunks(patch_reader, ffrom, fto, to_size, dfdiff)
 
-            if dfdiff is not None:
-                dfdiff_data = dfdiff.read(chunk_size)
-                data = bsdiff.add_bytes(data, dfdiff_data)
+    if not patch_reader.eof:
+        raise Error('End of patch not found.')
 
-            fto.write(data)
-            to_pos += chunk_size
+    return to_size
 
-        # Extra data.
-        for chunk_size, patch_data in iter_extra_chunks(patch_reader,
-                                                        to_pos,
-                                                        to_size):
-            data = patch_data
 
-            if dfdiff is not None:
-                dfdiff_data = dfdiff.read(chunk_size)
-                data = bsdiff.add_bytes(data, dfdiff_data)
+def apply_patch_sequential_into(ffrom,
+                                fpatch,
+                                patch_offset,
+                                to_data,
+                                compression,
+                                engine):
+    """Apply given sequential patch to memory mapped from data, if
+    possible, and write the result into the writable buffer `to_data`.
 
-            fto.write(data)
-            to_pos += chunk_size
+    """
 
-        # Adjustment.
-        size = unpack_size(patch_reader)
-        ffrom.seek(size, os.SEEK_CUR)
+    with open_from_mmap(ffrom) as (from_data, from_pos):
+        if is_c_engine_used(engine, compression, len(to_data)):
+            with stage('read'):
+                fpatch.seek(patch_offset, os.SEEK_SET)
+                patch = fpatch.read()
+
+            with memoryview(from_data) as from_view:
+                with from_view[from_pos:] as from_chunk:
+                    result = call_c_engine(engine,
+                                           capply.apply_patch,
+                                           from_chunk,
+                                           patch,
+                                           to_data)
+
+            if result is not None:
+                add_chunks(result[1])
+
+                return
+
+            fpatch.seek(patch_offset, os.SEEK_SET)
+            read_header_sequential(fpatch)
+
+        patch_reader = PatchReader(fpatch, compression)
+        dfdiff, ffrom = create_data_format_readers(patch_reader,
+                                                   ffrom,
+                                                   len(to_data))
+
+        if dfdiff is not None:
+            with stage('read'):
+                from_data = file_read(ffrom)
+
+            from_pos = 0
+
+        with memoryview(from_data) as from_view:
+            with stage('apply'):
+                apply_patch_chunks_into(patch_reader,
+                                        from_view,
+                                        from_pos,
+                                        to_data,
+                                        dfdiff)
 
     if not patch_reader.eof:
         raise Error('End of patch not found.')
 
-    return to_size
-
 
-def apply_patch_in_place(fmem, fpatch):
+def apply_patch_in_place(fmem, fpatch, engine='auto'):
     """Apply given in-place patch `fpatch` to `fmem`. Returns the size of
     the created to-data.
 
     Both arguments are file-like objects.
 
+    `engine` is the apply engine, see :func:`~detools.apply_patch()`.
+
     >>> fmem = open('foo.mem', 'r+b')
     >>> fpatch = open('foo-in-place.patch', 'rb')
     >>> apply_patch_in_place(fmem, fpatch)
@@ -407,6 +909,8 @@ def apply_patch_in_place(fmem, fpatch):
 
     """
 
+    check_engine(engine)
+    patch_offset = fpatch.tell()
     (compression,
      memory_size,
      segment_size,
@@ -414,21 +918,42 @@ def apply_patch_in_place(fmem, fpatch):
      from_size,
      to_size) = read_header_in_place(fpatch)
 
-    if to_size > 0:
-        patch_reader = PatchReader(fpatch, compression)
-        shift_memory(fmem, memory_size, shift_size, from_size)
+    if to_size == 0:
+        return to_size
+
+    if is_c_engine_used(engine, compression, memory_size):
+        check_memory_size(fmem, memory_size)
+        fmem.seek(0, os.SEEK_SET)
+        memory = bytearray(fmem.read(memory_size))
+        fpatch.seek(patch_offset, os.SEEK_SET)
+        patch = fpatch.read()
+
+        if call_c_engine(engine,
+                         capply.apply_patch_in_place,
+                         memory,
+                         patch) is not None:
+            fmem.seek(0, os.SEEK_SET)
+            fmem.write(memory)
+
+            return to_size
+
+        fpatch.seek(patch_offset, os.SEEK_SET)
+        read_header_in_place(fpatch)
+
+    patch_reader = PatchReader(fpatch, compression)
+    shift_memory(fmem, memory_size, shift_size, from_size)
 
-        for i, to_pos in enumerate(range(0, to_size, segment_size)):
-            from_offset = max(segment_size * (i + 1), shift_size)
-            segment_to_size = min(segment_size, to_size - to_pos)
-            apply_patch_in_place_segment(fmem,
-                                         patch_reader,
-                                         to_pos,
-                                         segment_to_size,
-                                         from_offset)
+    for i, to_pos in enumerate(range(0, to_size, segment_size)):
+        from_offset = max(segment_size * (i + 1), shift_size)
+        segment_to_size = min(segment_size, to_size - to_pos)
+        apply_patch_in_place_segment(fmem,
+                                     patch_reader,
+                                     to_pos,
+                                     segment_to_size,
+                                     from_offset)
 
-        if not patch_reader.eof:
-            raise Error('End of patch not found.')
+    if not patch_reader.eof:
+        raise Error('End of patch not found.')
 
     return to_size
 
@@ -499,12 +1024,71 @@ def apply_patch_bsdiff(ffrom, fpatch, fto):
     return to_size
 
 
-def apply_patch_hdiffpatch(ffrom, fpatch, fto):
+@contextmanager
+def open_patch_hdiffpatch(patch_reader, patch_size, use_mmap):
+    """Yields the decompressed hdiffpatch patch data. It is decompressed
+    in chunks into a memory mapped temporary file if `use_mmap` is
+    ``True``, and into memory otherwise.
+
+    """
+
+    if not use_mmap or patch_size == 0:
+        yield patch_reader.read(patch_size)
+
+        return
+
+    with tempfile.TemporaryFile() as fdata:
+        offset = 0
+
+        while offset < patch_size:
+            size = min(patch_size - offset, CHUNK_SIZE)
+            fdata.write(patch_reader.read(size))
+            offset += size
+
+        fdata.flush()
+
+        with open_mmap(fdata, mmap.ACCESS_READ) as patch_mmap:
+            if patch_mmap is None:
+                yield file_read(fdata)
+            else:
+                yield patch_mmap
+
+
+def apply_patch_hdiffpatch_into(from_data,
+                                from_pos,
+                                patch,
+                                to_data,
+                                cache_size):
+    with memoryview(from_data) as from_view:
+        with from_view[from_pos:] as from_view:
+            try:
+                with stage('apply'):
+                    hdiffpatch.apply_patch(from_view,
+                                           patch,
+                                           to_data,
+                                           cache_size)
+            except RuntimeError as e:
+                raise Error(str(e))
+
+
+def apply_patch_hdiffpatch(ffrom,
+                           fpatch,
+                           fto,
+                           use_mmap=False,
+                           cache_size=None):
     """Apply given hdiffpatch patch `fpatch` to `ffrom` to create
     `fto`. Returns the size of the created to-data.
 
     All arguments are file-like objects.
 
+    The from and to files are memory mapped and the patch is
+    decompressed into a memory mapped temporary file if `use_mmap` is
+    ``True``, so neither of them is loaded into memory. `fto` must
+    then be opened for both reading and writing. At most `cache_size`
+    bytes, by default 64 MiB, are used as patch cache. Otherwise the
+    whole from data, decompressed patch and to data are loaded into
+    memory.
+
     >>> ffrom = open('foo.mem', 'rb')
     >>> fpatch = open('foo-hdiffpatch.patch', 'rb')
     >>> fto = open('foo.new', 'wb')
@@ -518,14 +1102,45 @@ def apply_patch_hdiffpatch(ffrom, fpatch, fto):
     if to_size == 0:
         return to_size
 
-    patch_reader = PatchReader(fpatch, compression)
-    to_data = hdiffpatch.apply_patch(file_read(ffrom),
-                                     patch_reader.read(patch_size))
-
-    return fto.write(to_data)
+    if cache_size is None:
+        cache_size = HDIFFPATCH_CACHE_SIZE
 
+    patch_reader = PatchReader(fpatch, compression)
 
-def apply_patch_filenames(fromfile, patchfile, tofile):
+    with open_patch_hdiffpatch(patch_reader, patch_size, use_mmap) as patch:
+        if use_mmap:
+            with open_to_mmap(fto, to_size) as to_data:
+                if to_data is not None:
+                    with open_from_mmap(ffrom) as (from_data, from_pos):
+                        apply_patch_hdiffpatch_into(from_data,
+                                                    from_pos,
+                                                    patch,
+                                                    to_data,
+                                                    cache_size)
+
+                    return to_size
+
+        with stage('read'):
+            from_data = file_read(ffrom)
+
+        to_data = bytearray(to_size)
+        apply_patch_hdiffpatch_into(from_data,
+                                    0,
+                                    patch,
+                                    to_data,
+                                    cache_size)
+
+    with stage('write'):
+        return fto.write(to_data)
+
+
+def apply_patch_filenames(fromfile,
+                          patchfile,
+                          tofile,
+                          engine='auto',
+                          use_mmap=False,
+                          hdiffpatch_cache_size=None,
+                          stats=None):
     """Same as :func:`~detools.apply_patch()`, but with filenames instead
     of file-like objects.
 
@@ -536,11 +1151,17 @@ def apply_patch_filenames(fromfile, patchfile, tofile):
 
     with open(fromfile, 'rb') as ffrom:
         with open(patchfile, 'rb') as fpatch:
-            with open(tofile, 'wb') as fto:
-                return apply_patch(ffrom, fpatch, fto)
+            with open(tofile, 'w+b' if use_mmap else 'wb') as fto:
+                return apply_patch(ffrom,
+                                   fpatch,
+                                   fto,
+                                   engine,
+                                   use_mmap,
+                                   hdiffpatch_cache_size,
+                                   stats)
 
 
-def apply_patch_in_place_filenames(memfile, patchfile):
+def apply_patch_in_place_filenames(memfile, patchfile, engine='auto'):
     """Same as :func:`~detools.apply_patch_in_place()`, but with filenames
     instead of file-like objects.
 
@@ -551,7 +1172,7 @@ def apply_patch_in_place_filenames(memfile, patchfile):
 
     with open(memfile, 'r+b') as fmem:
         with open(patchfile, 'rb') as fpatch:
-            return apply_patch_in_place(fmem, fpatch)
+            return apply_patch_in_place(fmem, fpatch, engine)
 
 
 def apply_patch_bsdiff_filenames(fromfile, patchfile, tofile):
@@ -31,15 +31,38 @@
 #include <Python.h>
 
 #define MIN(x, y) (((x) < (y)) ? (x) : (y))
+#define MAX(x, y) (((x) > (y)) ? (x) : (y))
 
-static int32_t matchlen(uint8_t *from_p,
-                        int32_t from_size,
+static int64_t matchlen(uint8_t *from_p,
+                        int64_t from_size,
                         uint8_t *to_p,
-                        int32_t to_size)
+                        int64_t to_size)
 {
-    int32_t i;
+    int64_t i;
+    int64_t size;
+    uint64_t from_word;
+    uint64_t to_word;
 
-    for (i = 0; i < MIN(from_size, to_size); i++) {
+    size = MIN(from_size, to_size);
+
+    /* Compare blocks, then words and finally bytes until they
+       differ. */
+    for (i = 0; i + 256 <= size; i += 256) {
+        if (memcmp(&from_p[i], &to_p[i], 256) != 0) {
+            break;
+        }
+    }
+
+    for (; i + 8 <= size; i += 8) {
+        memcpy(&from_word, &from_p[i], sizeof(from_word));
+        memcpy(&to_word, &to_p[i], sizeof(to_word));
+
+        if (from_word != to_word) {
+            break;
+        }
+    }
+
+    for (; i < size; i++) {
         if (from_p[i] != to_p[i]) {
             break;
         }
@@ -48,45 +71,112 @@ static int32_t matchlen(uint8_t *from_p,
     return (i);
 }
 
-static int32_t search(int32_t *sa_p,
+/* The suffix array items are either 32 or 64 bits wide, depending on
+   the from data size. Small inputs use 32 bits to save memory. */
+struct suffix_array_t {
+    void *buf_p;
+    int is_64_bit;
+};
+
+static inline int64_t suffix_array_get(struct suffix_array_t *sa_p,
+                                       int64_t index)
+{
+    if (sa_p->is_64_bit) {
+        return (((int64_t *)sa_p->buf_p)[index]);
+    } else {
+        return (((int32_t *)sa_p->buf_p)[index]);
+    }
+}
+
+static int64_t suffix_matchlen(struct suffix_array_t *sa_p,
+                               uint8_t *from_p,
+                               int64_t from_size,
+                               uint8_t *to_p,
+                               int64_t to_size,
+                               int64_t index)
+{
+    int64_t pos;
+
+    pos = suffix_array_get(sa_p, index);
+
+    return (matchlen(from_p + pos, from_size - pos, to_p, to_size));
+}
+
+/* Find the longest match of given to data in the from data. A binary
+   search over the suffix array that keeps track of the match lengths
+   at both ends of the current interval. All suffixes in the interval
+   match at least the shorter of them, so comparisons start there
+   instead of at the beginning (Manber-Myers). Lengths not yet known
+   are -1. */
+static int64_t search(struct suffix_array_t *sa_p,
                       uint8_t *from_p,
-                      int32_t from_size,
+                      int64_t from_size,
                       uint8_t *to_p,
-                      int32_t to_size,
-                      int32_t from_begin,
-                      int32_t from_end,
-                      int32_t *pos_p)
-{
-    int32_t x;
-    int32_t y;
-
-    if (from_end - from_begin < 2) {
-        x = matchlen(from_p + sa_p[from_begin],
-                     from_size - sa_p[from_begin],
-                     to_p,
-                     to_size);
-        y = matchlen(from_p + sa_p[from_end],
-                     from_size - sa_p[from_end],
-                     to_p,
-                     to_size);
-
-        if (x > y) {
-            *pos_p = sa_p[from_begin];
-
-            return (x);
-        } else {
-            *pos_p = sa_p[from_end];
+                      int64_t to_size,
+                      int64_t from_begin,
+                      int64_t from_end,
+                      int64_t *pos_p)
+{
+    int64_t x;
+    int64_t begin_len;
+    int64_t end_len;
+    int64_t pos;
+    int64_t len;
+    int64_t size;
+
+    begin_len = -1;
+    end_len = -1;
+
+    while (from_end - from_begin >= 2) {
+        x = (from_begin + (from_end - from_begin) / 2);
+        pos = suffix_array_get(sa_p, x);
+        len = MIN(begin_len, end_len);
+
+        if (len < 0) {
+            len = 0;
+        }
+
+        size = MIN(from_size - pos, to_size);
+        len += matchlen(from_p + pos + len,
+                        size - len,
+                        to_p + len,
+                        size - len);
 
-            return (y);
+        if ((len < size) && (from_p[pos + len] < to_p[len])) {
+            from_begin = x;
+            begin_len = len;
+        } else {
+            from_end = x;
+            end_len = len;
         }
     }
 
-    x = (from_begin + (from_end - from_begin) / 2);
+    if (begin_len < 0) {
+        begin_len = suffix_matchlen(sa_p,
+                                    from_p,
+                                    from_size,
+                                    to_p,
+                                    to_size,
+                                    from_begin);
+    }
+
+    if (end_len < 0) {
+        end_len = suffix_matchlen(sa_p,
+                                  from_p,
+                                  from_size,
+                                  to_p,
+                                  to_size,
+                                  from_end);
+    }
+
+    if (begin_len > end_len) {
+        *pos_p = suffix_array_get(sa_p, from_begin);
 
-    if (memcmp(from_p + sa_p[x], to_p, MIN(from_size - sa_p[x], to_size)) < 0) {
-        return search(sa_p, from_p, from_size, to_p, to_size, x, from_end, pos_p);
+        return (begin_len);
     } else {
-        return search(sa_p, from_p, from_size, to_p, to_size, from_begin, x, pos_p);
+        *pos_p = suffix_array_get(sa_p, from_end);
+
+        return (end_len);
     }
 }
 
@@ -127,7 +217,55 @@ static int pack_size(uint8_t *buf_p, int64_t value, size_t size)
     return (res);
 }
 
-static int append_bytes(PyObject *list_p, uint8_t *buf_p, int32_t size)
+struct control_t {
+    int64_t diff_offset;
+    int64_t diff_size;
+    int64_t extra_pos;
+    int64_t extra_size;
+    int64_t adjustment;
+};
+
+struct controls_t {
+    struct control_t *buf_p;
+    size_t length;
+    size_t size;
+};
+
+static int controls_append(struct controls_t *controls_p,
+                           int64_t diff_offset,
+                           int64_t diff_size,
+                           int64_t extra_pos,
+                           int64_t extra_size,
+                           int64_t adjustment)
+{
+    size_t size;
+    struct control_t *buf_p;
+    struct control_t *control_p;
+
+    if (controls_p->length == controls_p->size) {
+        size = (2 * controls_p->size + 16);
+        buf_p = realloc(controls_p->buf_p, size * sizeof(*buf_p));
+
+        if (buf_p == NULL) {
+            return (-1);
+        }
+
+        controls_p->buf_p = buf_p;
+        controls_p->size = size;
+    }
+
+    control_p = &controls_p->buf_p[controls_p->length];
+    control_p->diff_offset = diff_offset;
+    control_p->diff_size = diff_size;
+    control_p->extra_pos = extra_pos;
+    control_p->extra_size = extra_size;
+    control_p->adjustment = adjustment;
+    controls_p->length++;
+
+    return (0);
+}
+
+static int append_bytes(PyObject *list_p, uint8_t *buf_p, int64_t size)
 {
     int res;
     PyObject *bytes_p;
@@ -145,7 +283,7 @@ static int append_bytes(PyObject *list_p, uint8_t *buf_p, int32_t size)
     return (res);
 }
 
-static int append_size(PyObject *list_p, int32_t size)
+static int append_size(PyObject *list_p, int64_t size)
 {
     int res;
     uint8_t buf[10];
@@ -159,7 +297,7 @@ static int append_size(PyObject *list_p, int32_t size)
     return (append_bytes(list_p, &buf[0], res));
 }
 
-static int append_buffer(PyObject *list_p, uint8_t *buf_p, int32_t size)
+static int append_buffer(PyObject *list_p, uint8_t *buf_p, int64_t size)
 {
     int res;
 
@@ -172,35 +310,138 @@ static int append_buffer(PyObject *list_p, uint8_t *buf_p, int32_t size)
     return (append_bytes(list_p, buf_p, size));
 }
 
-static int write_diff_extra_and_adjustment(PyObject *list_p,
-                                           uint8_t *from_p,
-                                           Py_ssize_t from_size,
-                                           uint8_t *to_p,
-                                           Py_ssize_t to_size,
-                                           uint8_t *debuf_p,
-                                           int32_t scan,
-                                           int32_t pos,
-                                           int32_t *last_scan_p,
-                                           int32_t *last_pos_p,
-                                           int32_t *last_offset_p)
+/* Convert recorded controls to a list of chunks. Must be called with
+   the GIL held. */
+static PyObject *controls_to_list(struct controls_t *controls_p,
+                                  uint8_t *to_p,
+                                  uint8_t *debuf_p)
 {
     int res;
-    int32_t s;
-    int32_t sf;
-    int32_t diff_size;
-    int32_t extra_pos;
-    int32_t extra_size;
-    int32_t sb;
-    int32_t lenb;
-    int32_t overlap;
-    int32_t ss;
-    int32_t lens;
-    int32_t i;
-    int32_t last_scan;
-    int32_t last_pos;
-
-    last_scan = *last_scan_p;
-    last_pos = *last_pos_p;
+    size_t i;
+    struct control_t *control_p;
+    PyObject *list_p;
+
+    list_p = PyList_New(0);
+
+    if (list_p == NULL) {
+        return (NULL);
+    }
+
+    for (i = 0; i < controls_p->length; i++) {
+        control_p = &controls_p->buf_p[i];
+        res = append_buffer(list_p,
+                            &debuf_p[control_p->diff_offset],
+                            control_p->diff_size);
+
+        if (res != 0) {
+            goto err1;
+        }
+
+        res = append_buffer(list_p,
+                            &to_p[control_p->extra_pos],
+                            control_p->extra_size);
+
+        if (res != 0) {
+            goto err1;
+        }
+
+        res = append_size(list_p, control_p->adjustment);
+
+        if (res != 0) {
+            goto err1;
+        }
+    }
+
+    return (list_p);
+
+ err1:
+    Py_DECREF(list_p);
+
+    return (NULL);
+}
+
+/* State of the bsdiff algorithm, so that it can be resumed after
+   each control. */
+struct create_patch_t {
+    struct suffix_array_t suffix_array;
+    uint8_t *from_p;
+    int64_t from_size;
+    uint8_t *to_p;
+    int64_t to_size;
+    int64_t scan;
+    int64_t pos;
+    int64_t len;
+    int64_t last_scan;
+    int64_t last_pos;
+    int64_t last_offset;
+    int64_t min_match;
+    int64_t skip_ahead_size;
+};
+
+/* A control found by the bsdiff algorithm. The diff data is to data at
+   diff_to_pos minus from data at diff_from_pos. */
+struct next_control_t {
+    int64_t diff_to_pos;
+    int64_t diff_from_pos;
+    int64_t diff_size;
+    int64_t extra_pos;
+    int64_t extra_size;
+    int64_t adjustment;
+};
+
+static void create_patch_init(struct create_patch_t *self_p,
+                              struct suffix_array_t *sa_p,
+                              uint8_t *from_p,
+                              int64_t from_size,
+                              uint8_t *to_p,
+                              int64_t to_size,
+                              int64_t min_match,
+                              int64_t skip_ahead_size)
+{
+    self_p->suffix_array = *sa_p;
+    self_p->from_p = from_p;
+    self_p->from_size = from_size;
+    self_p->to_p = to_p;
+    self_p->to_size = to_size;
+    self_p->scan = 0;
+    self_p->pos = 0;
+    self_p->len = 0;
+    self_p->last_scan = 0;
+    self_p->last_pos = 0;
+    self_p->last_offset = 0;
+    self_p->min_match = min_match;
+    self_p->skip_ahead_size = skip_ahead_size;
+}
+
+static void calc_control(struct create_patch_t *self_p,
+                         struct next_control_t *control_p)
+{
+    int64_t s;
+    int64_t sf;
+    int64_t diff_size;
+    int64_t sb;
+    int64_t lenb;
+    int64_t overlap;
+    int64_t ss;
+    int64_t lens;
+    int64_t i;
+    int64_t last_scan;
+    int64_t last_pos;
+    int64_t scan;
+    int64_t pos;
+    uint8_t *from_p;
+    int64_t from_size;
+    uint8_t *to_p;
+    int64_t to_size;
+
+    from_p = self_p->from_p;
+    from_size = self_p->from_size;
+    to_p = self_p->to_p;
+    to_size = self_p->to_size;
+    scan = self_p->scan;
+    pos = self_p->pos;
+    last_scan = self_p->last_scan;
+    last_pos = self_p->last_pos;
     s = 0;
     sf = 0;
     diff_size = 0;
@@ -263,83 +504,97 @@ static int write_diff_extra_and_adjustment(PyObject *list_p,
         lenb -= lens;
     }
 
-    /* Diff data. */
-    for (i = 0; i < diff_size; i++) {
-        debuf_p[i] = (to_p[last_scan + i] - from_p[last_pos + i]);
-    }
+    control_p->diff_to_pos = last_scan;
+    control_p->diff_from_pos = last_pos;
+    control_p->diff_size = diff_size;
 
-    res = append_buffer(list_p, &debuf_p[0], diff_size);
+    /* Extra data is taken as is from the to data. */
+    control_p->extra_pos = (last_scan + diff_size);
+    control_p->extra_size = (scan - lenb - control_p->extra_pos);
+    control_p->adjustment = ((pos - lenb) - (last_pos + diff_size));
 
-    if (res != 0) {
-        return (res);
-    }
+    self_p->last_scan = (scan - lenb);
+    self_p->last_pos = (pos - lenb);
+    self_p->last_offset = (pos - scan);
+}
 
-    /* Extra data. */
-    extra_pos = (last_scan + diff_size);
-    extra_size = (scan - lenb - extra_pos);
+/* Returns the length of the match at the last offset at given to
+   position if it is at least skip_ahead_size bytes, and zero
+   otherwise. Such matches are used as is instead of searching for a
+   longer match, so runs of equal data are skipped in one go. */
+static int64_t skip_ahead(struct create_patch_t *self_p,
+                          int64_t scan,
+                          int64_t *pos_p)
+{
+    int64_t pos;
+    int64_t len;
 
-    for (i = 0; i < extra_size; i++) {
-        debuf_p[i] = to_p[extra_pos + i];
+    if (self_p->skip_ahead_size == 0) {
+        return (0);
     }
 
-    res = append_buffer(list_p, &debuf_p[0], extra_size);
+    pos = (scan + self_p->last_offset);
 
-    if (res != 0) {
-        return (res);
+    if ((pos < 0) || (pos >= self_p->from_size)) {
+        return (0);
     }
 
-    /* Adjustment. */
-    res = append_size(list_p, (pos - lenb) - (last_pos + diff_size));
+    len = matchlen(self_p->from_p + pos,
+                   self_p->from_size - pos,
+                   self_p->to_p + scan,
+                   self_p->to_size - scan);
 
-    if (res != 0) {
-        return (res);
+    if (len < self_p->skip_ahead_size) {
+        return (0);
     }
 
-    *last_scan_p = (scan - lenb);
-    *last_pos_p = (pos - lenb);
-    *last_offset_p = (pos - scan);
+    *pos_p = pos;
 
-    return (0);
+    return (len);
 }
 
-static int create_patch_loop(PyObject *list_p,
-                             int32_t *sa_p,
-                             uint8_t *from_p,
-                             Py_ssize_t from_size,
-                             uint8_t *to_p,
-                             Py_ssize_t to_size,
-                             uint8_t *debuf_p)
+/* Run the bsdiff algorithm until next control is found. Returns 1 if
+   a control was found, and 0 when all to data has been processed. */
+static int next_control(struct create_patch_t *self_p,
+                        struct next_control_t *control_p)
 {
-    int res;
-    int32_t scan;
-    int32_t pos;
-    int32_t len;
-    int32_t last_scan;
-    int32_t last_pos;
-    int32_t last_offset;
-    int32_t from_score;
-    int32_t scsc;
-
-    scan = 0;
-    len = 0;
-    last_scan = 0;
-    last_pos = 0;
-    last_offset = 0;
-    pos = 0;
+    int64_t scan;
+    int64_t pos;
+    int64_t len;
+    int64_t last_offset;
+    int64_t from_score;
+    int64_t scsc;
+    uint8_t *from_p;
+    int64_t from_size;
+    uint8_t *to_p;
+    int64_t to_size;
+
+    from_p = self_p->from_p;
+    from_size = self_p->from_size;
+    to_p = self_p->to_p;
+    to_size = self_p->to_size;
+    scan = self_p->scan;
+    pos = self_p->pos;
+    len = self_p->len;
+    last_offset = self_p->last_offset;
 
     while (scan < to_size) {
         from_score = 0;
         scan += len;
 
         for (scsc = scan; scan < to_size; scan++) {
-            len = search(sa_p,
-                         from_p,
-                         (int32_t)from_size,
-                         to_p + scan,
-                         (int32_t)to_size - scan,
-                         0,
-                         (int32_t)from_size,
-                         &pos);
+            len = skip_ahead(self_p, scan, &pos);
+
+            if (len == 0) {
+                len = search(&self_p->suffix_array,
+                             from_p,
+                             from_size,
+                             to_p + scan,
+                             to_size - scan,
+                             0,
+                             from_size,
+                             &pos);
+            }
 
             for (; scsc < scan + len; scsc++) {
                 if ((scsc + last_offset < from_size)
@@ -348,7 +603,8 @@ static int create_patch_loop(PyObject *list_p,
                 }
             }
 
-            if (((len == from_score) && (len != 0)) || (len > from_score + 8)) {
+            if (((len == from_score) && (len != 0))
+                || (len > from_score + self_p->min_match)) {
                 break;
             }
 
@@ -359,24 +615,70 @@ static int create_patch_loop(PyObject *list_p,
         }
 
         if ((len != from_score) || (scan == to_size)) {
-            res = write_diff_extra_and_adjustment(list_p,
-                                                  from_p,
-                                                  from_size,
-                                                  to_p,
-                                                  to_size,
-                                                  debuf_p,
-                                                  scan,
-                                                  pos,
-                                                  &last_scan,
-                                                  &last_pos,
-                                                  &last_offset);
-
-            if (res != 0) {
-                return (res);
-            }
+            self_p->scan = scan;
+            self_p->pos = pos;
+            self_p->len = len;
+            calc_control(self_p, control_p);
+
+            return (1);
         }
     }
 
+    self_p->scan = scan;
+    self_p->pos = pos;
+    self_p->len = len;
+
+    return (0);
+}
+
+static int create_patch_loop(struct controls_t *controls_p,
+                             struct suffix_array_t *sa_p,
+                             uint8_t *from_p,
+                             Py_ssize_t from_size,
+                             uint8_t *to_p,
+                             Py_ssize_t to_size,
+                             uint8_t *debuf_p,
+                             Py_ssize_t min_match,
+                             Py_ssize_t skip_ahead_size)
+{
+    int res;
+    int64_t i;
+    int64_t debuf_offset;
+    struct create_patch_t create_patch;
+    struct next_control_t control;
+
+    create_patch_init(&create_patch,
+                      sa_p,
+                      from_p,
+                      from_size,
+                      to_p,
+                      to_size,
+                      min_match,
+                      skip_ahead_size);
+    debuf_offset = 0;
+
+    while (next_control(&create_patch, &control) == 1) {
+        /* Diff data. Stored after previous diffs in the diff buffer
+           as the chunks are created once the loop has finished. */
+        for (i = 0; i < control.diff_size; i++) {
+            debuf_p[debuf_offset + i] = (to_p[control.diff_to_pos + i]
+                                         - from_p[control.diff_from_pos + i]);
+        }
+
+        res = controls_append(controls_p,
+                              debuf_offset,
+                              control.diff_size,
+                              control.extra_pos,
+                              control.extra_size,
+                              control.adjustment);
+
+        if (res != 0) {
+            return (res);
+        }
+
+        debuf_offset += control.diff_size;
+    }
+
     return (0);
 }
 
@@ -410,11 +712,34 @@ static PyObject *m_pack_size(PyObject *self_p, PyObject *arg_p)
     return (bytes_p);
 }
 
+/* Default bsdiff algorithm options. */
+#define MIN_MATCH_DEFAULT 8
+#define SKIP_AHEAD_SIZE_DEFAULT 0
+
+static int check_options(Py_ssize_t min_match, Py_ssize_t skip_ahead_size)
+{
+    if (min_match < 0) {
+        PyErr_SetString(PyExc_ValueError, "Negative minimum match.");
+
+        return (-1);
+    }
+
+    if (skip_ahead_size < 0) {
+        PyErr_SetString(PyExc_ValueError, "Negative skip ahead size.");
+
+        return (-1);
+    }
+
+    return (0);
+}
+
 static int parse_args(PyObject *args_p,
                       Py_buffer *suffix_array_view_p,
                       Py_buffer *from_view_p,
                       Py_buffer *to_view_p,
-                      Py_buffer *de_view_p)
+                      Py_buffer *de_view_p,
+                      Py_ssize_t *min_match_p,
+                      Py_ssize_t *skip_ahead_size_p)
 {
     int res;
     PyObject *suffix_array_p;
@@ -422,17 +747,27 @@ static int parse_args(PyObject *args_p,
     PyObject *to_p;
     PyObject *de_p;
 
+    *min_match_p = MIN_MATCH_DEFAULT;
+    *skip_ahead_size_p = SKIP_AHEAD_SIZE_DEFAULT;
     res = PyArg_ParseTuple(args_p,
-                           "OOOO",
+                           "OOOO|nn",
                            &suffix_array_p,
                            &from_p,
                            &to_p,
-                           &de_p);
+                           &de_p,
+                           min_match_p,
+                           skip_ahead_size_p);
 
     if (res == 0) {
         return (-1);
     }
 
+    res = check_options(*min_match_p, *skip_ahead_size_p);
+
+    if (res != 0) {
+        return (res);
+    }
+
     res = PyObject_GetBuffer(suffix_array_p,
                              suffix_array_view_p,
                              PyBUF_CONTIG_RO);
@@ -473,6 +808,19 @@ static int parse_args(PyObject *args_p,
     return (res);
 }
 
+/**
+ * def create_patch(suffix_array,
+ *                  from_data,
+ *                  to_data,
+ *                  diff_buffer,
+ *                  min_match=8,
+ *                  skip_ahead_size=0) -> chunks
+ *
+ * A new control is created when a match is more than min_match bytes
+ * longer than the match at the last offset. Matches at the last
+ * offset of at least skip_ahead_size bytes are used without searching
+ * for longer matches, if non-zero.
+ */
 static PyObject *m_create_patch(PyObject *self_p, PyObject *args_p)
 {
     int res;
@@ -481,54 +829,370 @@ static PyObject *m_create_patch(PyObject *self_p, PyObject *args_p)
     Py_buffer from_view;
     Py_buffer to_view;
     Py_buffer de_view;
+    Py_ssize_t min_match;
+    Py_ssize_t skip_ahead_size;
+    struct controls_t controls;
+    struct suffix_array_t suffix_array;
 
     res = parse_args(args_p,
                      &suffix_array_view,
                      &from_view,
                      &to_view,
-                     &de_view);
+                     &de_view,
+                     &min_match,
+                     &skip_ahead_size);
 
     if (res != 0) {
         return (NULL);
     }
 
-    list_p = PyList_New(0);
+    list_p = NULL;
 
-    if (list_p == NULL) {
-        goto err1;
+    if (de_view.len < to_view.len) {
+        PyErr_SetString(PyExc_ValueError, "Diff buffer too small.");
+
+        goto out;
     }
 
-    res = create_patch_loop(list_p,
-                            suffix_array_view.buf,
+    /* One item per from byte, plus the from size first. */
+    suffix_array.buf_p = suffix_array_view.buf;
+
+    if (suffix_array_view.len == 4 * (from_view.len + 1)) {
+        suffix_array.is_64_bit = 0;
+    } else if (suffix_array_view.len == 8 * (from_view.len + 1)) {
+        suffix_array.is_64_bit = 1;
+    } else {
+        PyErr_SetString(PyExc_ValueError, "Bad suffix array size.");
+
+        goto out;
+    }
+
+    controls.buf_p = NULL;
+    controls.length = 0;
+    controls.size = 0;
+
+    /* The bsdiff algorithm does not use any Python objects and may
+       run for a long time, so let other threads run meanwhile. */
+    Py_BEGIN_ALLOW_THREADS
+    res = create_patch_loop(&controls,
+                            &suffix_array,
                             from_view.buf,
                             from_view.len,
                             to_view.buf,
                             to_view.len,
-                            de_view.buf);
+                            de_view.buf,
+                            min_match,
+                            skip_ahead_size);
+    Py_END_ALLOW_THREADS
 
     if (res != 0) {
-        goto err2;
+        PyErr_NoMemory();
+    } else {
+        list_p = controls_to_list(&controls, to_view.buf, de_view.buf);
     }
 
+    free(controls.buf_p);
+
+ out:
     PyBuffer_Release(&suffix_array_view);
     PyBuffer_Release(&from_view);
     PyBuffer_Release(&to_view);
     PyBuffer_Release(&de_view);
 
     return (list_p);
+}
+
+/* Iterator of chunks, one per control. The bsdiff algorithm is
+   resumed each time the next chunk is requested, so that only one
+   control at a time is kept in memory. */
+struct patch_iterator_t {
+    PyObject_HEAD
+    struct create_patch_t create_patch;
+    Py_buffer suffix_array_view;
+    Py_buffer from_view;
+    Py_buffer to_view;
+    int has_views;
+    int is_running;
+};
+
+static void patch_iterator_release_views(struct patch_iterator_t *self_p)
+{
+    if (self_p->has_views) {
+        PyBuffer_Release(&self_p->suffix_array_view);
+        PyBuffer_Release(&self_p->from_view);
+        PyBuffer_Release(&self_p->to_view);
+        self_p->has_views = 0;
+    }
+}
+
+static void patch_iterator_dealloc(PyObject *self_p)
+{
+    patch_iterator_release_views((struct patch_iterator_t *)self_p);
+    PyObject_Del(self_p);
+}
+
+/* Diff size, diff data, extra size, extra data and adjustment of
+   given control in a bytes object. */
+static PyObject *control_to_bytes(struct create_patch_t *create_patch_p,
+                                  struct next_control_t *control_p)
+{
+    uint8_t diff_size[10];
+    uint8_t extra_size[10];
+    uint8_t adjustment[10];
+    int diff_size_size;
+    int extra_size_size;
+    int adjustment_size;
+    int64_t i;
+    uint8_t *from_p;
+    uint8_t *to_p;
+    uint8_t *buf_p;
+    PyObject *bytes_p;
+
+    diff_size_size = pack_size(&diff_size[0],
+                               control_p->diff_size,
+                               sizeof(diff_size));
+    extra_size_size = pack_size(&extra_size[0],
+                                control_p->extra_size,
+                                sizeof(extra_size));
+    adjustment_size = pack_size(&adjustment[0],
+                                control_p->adjustment,
+                                sizeof(adjustment));
+    bytes_p = PyBytes_FromStringAndSize(NULL,
+                                        diff_size_size
+                                        + control_p->diff_size
+                                        + extra_size_size
+                                        + control_p->extra_size
+                                        + adjustment_size);
+
+    if (bytes_p == NULL) {
+        return (NULL);
+    }
+
+    buf_p = (uint8_t *)PyBytes_AS_STRING(bytes_p);
+    from_p = &create_patch_p->from_p[control_p->diff_from_pos];
+    to_p = &create_patch_p->to_p[control_p->diff_to_pos];
+    memcpy(buf_p, &diff_size[0], diff_size_size);
+    buf_p += diff_size_size;
+
+    for (i = 0; i < control_p->diff_size; i++) {
+        buf_p[i] = (to_p[i] - from_p[i]);
+    }
+
+    buf_p += control_p->diff_size;
+    memcpy(buf_p, &extra_size[0], extra_size_size);
+    buf_p += extra_size_size;
+    memcpy(buf_p,
+           &create_patch_p->to_p[control_p->extra_pos],
+           control_p->extra_size);
+    buf_p += control_p->extra_size;
+    memcpy(buf_p, &adjustment[0], adjustment_size);
+
+    return (bytes_p);
+}
+
+static PyObject *patch_iterator_next(PyObject *self_p)
+{
+    int res;
+    struct patch_iterator_t *iterator_p;
+    struct next_control_t control;
+
+    iterator_p = (struct patch_iterator_t *)self_p;
+
+    if (!iterator_p->has_views) {
+        return (NULL);
+    }
+
+    if (iterator_p->is_running) {
+        PyErr_SetString(PyExc_ValueError, "Iterator already executing.");
+
+        return (NULL);
+    }
+
+    iterator_p->is_running = 1;
+
+    Py_BEGIN_ALLOW_THREADS
+    res = next_control(&iterator_p->create_patch, &control);
+    Py_END_ALLOW_THREADS
+
+    iterator_p->is_running = 0;
+
+    if (res == 0) {
+        /* Release the buffers as soon as possible, as an exported
+           mmap cannot be closed. */
+        patch_iterator_release_views(iterator_p);
+
+        return (NULL);
+    }
+
+    return (control_to_bytes(&iterator_p->create_patch, &control));
+}
+
+static PyTypeObject patch_iterator_type = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "detools.bsdiff.PatchIterator",
+    .tp_basicsize = sizeof(struct patch_iterator_t),
+    .tp_itemsize = 0,
+    .tp_dealloc = patch_iterator_dealloc,
+    .tp_flags = Py_TPFLAGS_DEFAULT,
+    .tp_iter = PyObject_SelfIter,
+    .tp_iternext = patch_iterator_next
+};
+
+/**
+ * def create_patch_iter(suffix_array,
+ *                       from_data,
+ *                       to_data,
+ *                       min_match=8,
+ *                       skip_ahead_size=0) -> iterator
+ *
+ * Same chunks as create_patch(), but one chunk per control, created
+ * as they are consumed. No diff buffer is needed.
+ */
+static PyObject *m_create_patch_iter(PyObject *self_p, PyObject *args_p)
+{
+    int res;
+    PyObject *suffix_array_p;
+    PyObject *from_p;
+    PyObject *to_p;
+    Py_ssize_t min_match;
+    Py_ssize_t skip_ahead_size;
+    struct patch_iterator_t *iterator_p;
+    struct suffix_array_t suffix_array;
+
+    min_match = MIN_MATCH_DEFAULT;
+    skip_ahead_size = SKIP_AHEAD_SIZE_DEFAULT;
+    res = PyArg_ParseTuple(args_p,
+                           "OOO|nn",
+                           &suffix_array_p,
+                           &from_p,
+                           &to_p,
+                           &min_match,
+                           &skip_ahead_size);
+
+    if (res == 0) {
+        return (NULL);
+    }
+
+    res = check_options(min_match, skip_ahead_size);
+
+    if (res != 0) {
+        return (NULL);
+    }
+
+    iterator_p = PyObject_New(struct patch_iterator_t, &patch_iterator_type);
+
+    if (iterator_p == NULL) {
+        return (NULL);
+    }
+
+    iterator_p->has_views = 0;
+    iterator_p->is_running = 0;
+
+    res = PyObject_GetBuffer(suffix_array_p,
+                             &iterator_p->suffix_array_view,
+                             PyBUF_CONTIG_RO);
+
+    if (res == -1) {
+        goto err1;
+    }
+
+    res = PyObject_GetBuffer(from_p, &iterator_p->from_view, PyBUF_CONTIG_RO);
+
+    if (res == -1) {
+        goto err2;
+    }
+
+    res = PyObject_GetBuffer(to_p, &iterator_p->to_view, PyBUF_CONTIG_RO);
+
+    if (res == -1) {
+        goto err3;
+    }
+
+    iterator_p->has_views = 1;
+    suffix_array.buf_p = iterator_p->suffix_array_view.buf;
+
+    if (iterator_p->suffix_array_view.len
+        == 4 * (iterator_p->from_view.len + 1)) {
+        suffix_array.is_64_bit = 0;
+    } else if (iterator_p->suffix_array_view.len
+               == 8 * (iterator_p->from_view.len + 1)) {
+        suffix_array.is_64_bit = 1;
+    } else {
+        PyErr_SetString(PyExc_ValueError, "Bad suffix array size.");
+
+        goto err1;
+    }
+
+    create_patch_init(&iterator_p->create_patch,
+                      &suffix_array,
+                      iterator_p->from_view.buf,
+                      iterator_p->from_view.len,
+                      iterator_p->to_view.buf,
+                      iterator_p->to_view.len,
+                      min_match,
+                      skip_ahead_size);
+
+    return ((PyObject *)iterator_p);
+
+ err3:
+    PyBuffer_Release(&iterator_p->from_view);
 
  err2:
-    Py_DECREF(list_p);
+    PyBuffer_Release(&iterator_p->suffix_array_view);
 
  err1:
-    PyBuffer_Release(&suffix_array_view);
-    PyBuffer_Release(&from_view);
-    PyBuffer_Release(&to_view);
-    PyBuffer_Release(&de_view);
+    Py_DECREF(iterator_p);
 
     return (NULL);
 }
 
+/* Buffers at least this big are added with the GIL released. */
+#define ADD_BYTES_GIL_RELEASE_SIZE                         8192
+
+#define LOW_SEVEN_BITS                       0x7f7f7f7f7f7f7f7fULL
+#define HIGH_BIT                             0x8080808080808080ULL
+
+/* Add a and b, byte by byte, and store the result in dst. Eight bytes
+   are added at a time in a 64 bits word, masking out the high bit of
+   each byte to not carry into the next byte. Any of the buffers may
+   be the same. */
+static void add_bytes(uint8_t *dst_p,
+                      const uint8_t *a_p,
+                      const uint8_t *b_p,
+                      size_t size)
+{
+    size_t i;
+    uint64_t a;
+    uint64_t b;
+    uint64_t sum;
+
+    for (i = 0; i + sizeof(sum) <= size; i += sizeof(sum)) {
+        memcpy(&a, &a_p[i], sizeof(a));
+        memcpy(&b, &b_p[i], sizeof(b));
+        sum = (((a & LOW_SEVEN_BITS) + (b & LOW_SEVEN_BITS))
+               ^ ((a ^ b) & HIGH_BIT));
+        memcpy(&dst_p[i], &sum, sizeof(sum));
+    }
+
+    for (; i < size; i++) {
+        dst_p[i] = (uint8_t)(a_p[i] + b_p[i]);
+    }
+}
+
+static void add_bytes_maybe_without_gil(uint8_t *dst_p,
+                                        const uint8_t *a_p,
+                                        const uint8_t *b_p,
+                                        size_t size)
+{
+    if (size >= ADD_BYTES_GIL_RELEASE_SIZE) {
+        Py_BEGIN_ALLOW_THREADS
+        add_bytes(dst_p, a_p, b_p, size);
+        Py_END_ALLOW_THREADS
+    } else {
+        add_bytes(dst_p, a_p, b_p, size);
+    }
+}
+
 static int parse_add_bytes_args(PyObject *args_p,
                                 Py_buffer *first_view_p,
                                 Py_buffer *second_view_p)
@@ -563,15 +1227,17 @@ static int parse_add_bytes_args(PyObject *args_p,
     return (res);
 }
 
+/**
+ * def add_bytes(first, second) -> bytearray
+ *
+ * Add first and second, byte by byte, and return the result in a new
+ * bytearray.
+ */
 static PyObject *m_add_bytes(PyObject *self_p, PyObject *args_p)
 {
     int res;
     Py_buffer first_view;
     Py_buffer second_view;
-    uint8_t *dst_p;
-    uint8_t *first_p;
-    uint8_t *second_p;
-    Py_ssize_t i;
     PyObject *byte_array_p;
 
     res = parse_add_bytes_args(args_p, &first_view, &second_view);
@@ -583,7 +1249,7 @@ static PyObject *m_add_bytes(PyObject *self_p, PyObject *args_p)
     if (first_view.len != second_view.len) {
         PyErr_SetString(PyExc_ValueError, "Lengths must be equal.");
 
-        return (NULL);
+        goto err1;
     }
 
     byte_array_p = PyByteArray_FromStringAndSize("", 1);
@@ -598,13 +1264,10 @@ static PyObject *m_add_bytes(PyObject *self_p, PyObject *args_p)
         goto err2;
     }
 
-    dst_p = (uint8_t *)PyByteArray_AsString(byte_array_p);
-    first_p = (uint8_t *)first_view.buf;
-    second_p = (uint8_t *)second_view.buf;
-
-    for (i = 0; i < first_view.len; i++) {
-        dst_p[i] = (first_p[i] + second_p[i]);
-    }
+    add_bytes((uint8_t *)PyByteArray_AsString(byte_array_p),
+              (const uint8_t *)first_view.buf,
+              (const uint8_t *)second_view.buf,
+              (size_t)first_view.len);
 
     PyBuffer_Release(&first_view);
     PyBuffer_Release(&second_view);
@@ -621,10 +1284,311 @@ static PyObject *m_add_bytes(PyObject *self_p, PyObject *args_p)
     return (NULL);
 }
 
+/**
+ * def add_bytes_into(dst, a, b)
+ *
+ * Add a and b, byte by byte, and store the result in dst, without
+ * allocating a new buffer. dst may be a or b.
+ */
+static PyObject *m_add_bytes_into(PyObject *self_p, PyObject *args_p)
+{
+    int res;
+    PyObject *dst_p;
+    PyObject *a_p;
+    PyObject *b_p;
+    Py_buffer dst_view;
+    Py_buffer a_view;
+    Py_buffer b_view;
+
+    res = PyArg_ParseTuple(args_p, "OOO", &dst_p, &a_p, &b_p);
+
+    if (res == 0) {
+        return (NULL);
+    }
+
+    res = PyObject_GetBuffer(dst_p, &dst_view, PyBUF_CONTIG);
+
+    if (res == -1) {
+        return (NULL);
+    }
+
+    res = PyObject_GetBuffer(a_p, &a_view, PyBUF_CONTIG_RO);
+
+    if (res == -1) {
+        goto err1;
+    }
+
+    res = PyObject_GetBuffer(b_p, &b_view, PyBUF_CONTIG_RO);
+
+    if (res == -1) {
+        goto err2;
+    }
+
+    if ((dst_view.len != a_view.len) || (dst_view.len != b_view.len)) {
+        PyErr_SetString(PyExc_ValueError, "Lengths must be equal.");
+
+        goto err3;
+    }
+
+    add_bytes_maybe_without_gil((uint8_t *)dst_view.buf,
+                                (const uint8_t *)a_view.buf,
+                                (const uint8_t *)b_view.buf,
+                                (size_t)dst_view.len);
+
+    PyBuffer_Release(&dst_view);
+    PyBuffer_Release(&a_view);
+    PyBuffer_Release(&b_view);
+    Py_INCREF(Py_None);
+
+    return (Py_None);
+
+ err3:
+    PyBuffer_Release(&b_view);
+
+ err2:
+    PyBuffer_Release(&a_view);
+
+ err1:
+    PyBuffer_Release(&dst_view);
+
+    return (NULL);
+}
+
+/**
+ * def add_bytes_inplace(dst, src)
+ *
+ * Add src to dst, byte by byte, without allocating a new buffer.
+ */
+static PyObject *m_add_bytes_inplace(PyObject *self_p, PyObject *args_p)
+{
+    int res;
+    PyObject *dst_p;
+    PyObject *src_p;
+    Py_buffer dst_view;
+    Py_buffer src_view;
+
+    res = PyArg_ParseTuple(args_p, "OO", &dst_p, &src_p);
+
+    if (res == 0) {
+        return (NULL);
+    }
+
+    res = PyObject_GetBuffer(dst_p, &dst_view, PyBUF_CONTIG);
+
+    if (res == -1) {
+        return (NULL);
+    }
+
+    res = PyObject_GetBuffer(src_p, &src_view, PyBUF_CONTIG_RO);
+
+    if (res == -1) {
+        goto err1;
+    }
+
+    if (dst_view.len != src_view.len) {
+        PyErr_SetString(PyExc_ValueError, "Lengths must be equal.");
+
+        goto err2;
+    }
+
+    add_bytes_maybe_without_gil((uint8_t *)dst_view.buf,
+                                (const uint8_t *)dst_view.buf,
+                                (const uint8_t *)src_view.buf,
+                                (size_t)dst_view.len);
+
+    PyBuffer_Release(&dst_view);
+    PyBuffer_Release(&src_view);
+    Py_INCREF(Py_None);
+
+    return (Py_None);
+
+ err2:
+    PyBuffer_Release(&src_view);
+
+ err1:
+    PyBuffer_Release(&dst_view);
+
+    return (NULL);
+}
+
+/* Gear hash values of all byte values, created when the module is
+   initialized. */
+static uint64_t gear[256];
+
+static void gear_init(void)
+{
+    int i;
+    uint64_t state;
+    uint64_t value;
+
+    /* Splitmix64 with a fixed seed, so chunk boundaries never
+       change. */
+    state = 0;
+
+    for (i = 0; i < 256; i++) {
+        state += 0x9e3779b97f4a7c15ULL;
+        value = state;
+        value = ((value ^ (value >> 30)) * 0xbf58476d1ce4e5b9ULL);
+        value = ((value ^ (value >> 27)) * 0x94d049bb133111ebULL);
+        gear[i] = (value ^ (value >> 31));
+    }
+}
+
+static int64_t find_chunk_ends(const uint8_t *buf_p,
+                               int64_t size,
+                               uint64_t mask,
+                               int64_t minimum_size,
+                               int64_t maximum_size,
+                               int64_t *ends_p)
+{
+    int64_t number_of_ends;
+    int64_t begin;
+    int64_t end;
+    int64_t i;
+    uint64_t hash;
+
+    number_of_ends = 0;
+    begin = 0;
+
+    while (begin < size) {
+        end = MIN(begin + maximum_size, size);
+        i = MIN(begin + minimum_size, end);
+        hash = 0;
+
+        for (; i < end; i++) {
+            hash = ((hash << 1) + gear[buf_p[i]]);
+
+            if ((hash & mask) == 0) {
+                end = (i + 1);
+                break;
+            }
+        }
+
+        ends_p[number_of_ends] = end;
+        number_of_ends++;
+        begin = end;
+    }
+
+    return (number_of_ends);
+}
+
+/**
+ * def content_defined_chunks(data,
+ *                            average_size_bits,
+ *                            minimum_size,
+ *                            maximum_size) -> ends
+ *
+ * Returns a list of the end offsets of the content defined chunks of
+ * given data. A chunk ends where the gear hash of the bytes after its
+ * first minimum_size bytes has its top average_size_bits bits
+ * cleared, or after maximum_size bytes. The boundaries only depend on
+ * the data around them, so equal data gets equal chunks even if
+ * moved.
+ */
+static PyObject *m_content_defined_chunks(PyObject *self_p, PyObject *args_p)
+{
+    int res;
+    PyObject *data_p;
+    int average_size_bits;
+    Py_ssize_t minimum_size;
+    Py_ssize_t maximum_size;
+    Py_buffer data_view;
+    int64_t *ends_p;
+    int64_t number_of_ends;
+    int64_t i;
+    uint64_t mask;
+    PyObject *list_p;
+    PyObject *end_p;
+
+    res = PyArg_ParseTuple(args_p,
+                           "Oinn",
+                           &data_p,
+                           &average_size_bits,
+                           &minimum_size,
+                           &maximum_size);
+
+    if (res == 0) {
+        return (NULL);
+    }
+
+    if ((average_size_bits < 1) || (average_size_bits > 63)) {
+        PyErr_SetString(PyExc_ValueError, "Bad average size bits.");
+
+        return (NULL);
+    }
+
+    if ((minimum_size < 0) || (maximum_size < 1)
+        || (minimum_size > maximum_size)) {
+        PyErr_SetString(PyExc_ValueError, "Bad chunk sizes.");
+
+        return (NULL);
+    }
+
+    res = PyObject_GetBuffer(data_p, &data_view, PyBUF_CONTIG_RO);
+
+    if (res == -1) {
+        return (NULL);
+    }
+
+    list_p = NULL;
+
+    /* At most one chunk per minimum size bytes, except the last. */
+    ends_p = malloc(sizeof(*ends_p)
+                    * (size_t)(data_view.len / MAX(minimum_size, 1) + 1));
+
+    if (ends_p == NULL) {
+        PyErr_NoMemory();
+
+        goto out1;
+    }
+
+    mask = (((1ULL << average_size_bits) - 1) << (64 - average_size_bits));
+
+    Py_BEGIN_ALLOW_THREADS
+    number_of_ends = find_chunk_ends((const uint8_t *)data_view.buf,
+                                     data_view.len,
+                                     mask,
+                                     minimum_size,
+                                     maximum_size,
+                                     ends_p);
+    Py_END_ALLOW_THREADS
+
+    list_p = PyList_New(number_of_ends);
+
+    if (list_p == NULL) {
+        goto out2;
+    }
+
+    for (i = 0; i < number_of_ends; i++) {
+        end_p = PyLong_FromLongLong(ends_p[i]);
+
+        if (end_p == NULL) {
+            Py_DECREF(list_p);
+            list_p = NULL;
+
+            goto out2;
+        }
+
+        PyList_SET_ITEM(list_p, i, end_p);
+    }
+
+ out2:
+    free(ends_p);
+
+ out1:
+    PyBuffer_Release(&data_view);
+
+    return (list_p);
+}
+
 static PyMethodDef module_methods[] = {
     { "pack_size", m_pack_size, METH_O },
     { "create_patch", m_create_patch, METH_VARARGS },
+    { "create_patch_iter", m_create_patch_iter, METH_VARARGS },
     { "add_bytes", m_add_bytes, METH_VARARGS },
+    { "add_bytes_into", m_add_bytes_into, METH_VARARGS },
+    { "add_bytes_inplace", m_add_bytes_inplace, METH_VARARGS },
+    { "content_defined_chunks", m_content_defined_chunks, METH_VARARGS },
     { NULL }
 };
 
@@ -640,6 +1604,12 @@ PyMODINIT_FUNC PyInit_bsdiff(void)
 {
     PyObject *m_p;
 
+    if (PyType_Ready(&patch_iterator_type) < 0) {
+        return (NULL);
+    }
+
+    gear_init();
+
     /* Module creation. */
     m_p = PyModule_Create(&module);
 
@@ -0,0 +1,788 @@
+/**
+ * BSD 2-Clause License
+ *
+ * Copyright (c) 2019-2020, Erik Moqvist
+ * All rights reserved.
+ *
+ * Redistribution and use in source and binary forms, with or without
+ * modification, are permitted provided that the following conditions
+ * are met:
+ *
+ * * Redistributions of source code must retain the above copyright
+ *   notice, this list of conditions and the following disclaimer.
+ *
+ * * Redistributions in binary form must reproduce the above copyright
+ *   notice, this list of conditions and the following disclaimer in
+ *   the documentation and/or other materials provided with the
+ *   distribution.
+ *
+ * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+ * "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+ * LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+ * FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+ * COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+ * INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+ * (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+ * SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+ * HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+ * STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ * ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+ * OF THE POSSIBILITY OF SUCH DAMAGE.
+ *
+ * Python wrapper of the C library in c/detools.c. Patches are applied
+ * either to data kept in buffers, in which case no Python code is
+ * called while applying the patch, or to file-like objects, which are
+ * read and written in chunks. The GIL is released while applying the
+ * patch, and only taken to read and write chunks.
+ */
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <stdbool.h>
+#include "detools.h"
+
+/* Size of the from data, patch and to data chunks when applying a
+   patch to file-like objects. */
+#define FILE_CHUNK_SIZE                                     65536
+
+#define MIN(x, y) (((x) < (y)) ? (x) : (y))
+
+struct buffer_t {
+    uint8_t *buf_p;
+    size_t size;
+    size_t offset;
+};
+
+/* The number of chunks is the number of applied diff, extra and
+   adjustment chunks. The from data is seeked once per adjustment. */
+struct apply_patch_t {
+    struct buffer_t from;
+    struct buffer_t to;
+    size_t chunks;
+};
+
+struct apply_patch_files_t {
+    PyObject *ffrom_p;
+    PyObject *fto_p;
+    PyThreadState *thread_state_p;
+    bool failed;
+    size_t chunks;
+    struct {
+        long long base;
+        long long offset;
+        long long buf_offset;
+        size_t buf_size;
+        uint8_t buf[FILE_CHUNK_SIZE];
+    } from;
+    struct {
+        size_t buf_size;
+        uint8_t buf[FILE_CHUNK_SIZE];
+    } to;
+};
+
+struct apply_patch_in_place_t {
+    struct buffer_t memory;
+    int step;
+};
+
+static int from_read(void *arg_p, uint8_t *buf_p, size_t size)
+{
+    struct apply_patch_t *self_p;
+
+    self_p = (struct apply_patch_t *)arg_p;
+
+    if (size > self_p->from.size - self_p->from.offset) {
+        return (-DETOOLS_IO_FAILED);
+    }
+
+    memcpy(buf_p, &self_p->from.buf_p[self_p->from.offset], size);
+    self_p->from.offset += size;
+
+    return (0);
+}
+
+static int from_seek(void *arg_p, int offset)
+{
+    struct apply_patch_t *self_p;
+    int64_t from_offset;
+
+    self_p = (struct apply_patch_t *)arg_p;
+    from_offset = ((int64_t)self_p->from.offset + offset);
+
+    if ((from_offset < 0) || ((size_t)from_offset > self_p->from.size)) {
+        return (-DETOOLS_IO_FAILED);
+    }
+
+    self_p->from.offset = (size_t)from_offset;
+    self_p->chunks++;
+
+    return (0);
+}
+
+static int to_write(void *arg_p, const uint8_t *buf_p, size_t size)
+{
+    struct apply_patch_t *self_p;
+
+    self_p = (struct apply_patch_t *)arg_p;
+
+    if (size > self_p->to.size - self_p->to.offset) {
+        return (-DETOOLS_IO_FAILED);
+    }
+
+    memcpy(&self_p->to.buf_p[self_p->to.offset], buf_p, size);
+    self_p->to.offset += size;
+
+    return (0);
+}
+
+/* Reads a from data chunk at the current from offset. Must be called
+   with the GIL held. */
+static int files_from_fill(struct apply_patch_files_t *self_p)
+{
+    PyObject *res_p;
+    char *buf_p;
+    Py_ssize_t size;
+
+    res_p = PyObject_CallMethod(self_p->ffrom_p,
+                                "seek",
+                                "L",
+                                self_p->from.base + self_p->from.offset);
+
+    if (res_p == NULL) {
+        return (-1);
+    }
+
+    Py_DECREF(res_p);
+    res_p = PyObject_CallMethod(self_p->ffrom_p, "read", "n", FILE_CHUNK_SIZE);
+
+    if (res_p == NULL) {
+        return (-1);
+    }
+
+    if (PyBytes_AsStringAndSize(res_p, &buf_p, &size) != 0) {
+        Py_DECREF(res_p);
+
+        return (-1);
+    }
+
+    if (size > FILE_CHUNK_SIZE) {
+        size = FILE_CHUNK_SIZE;
+    }
+
+    memcpy(&self_p->from.buf[0], buf_p, (size_t)size);
+    self_p->from.buf_offset = self_p->from.offset;
+    self_p->from.buf_size = (size_t)size;
+    Py_DECREF(res_p);
+
+    return (0);
+}
+
+static int files_from_read(void *arg_p, uint8_t *buf_p, size_t size)
+{
+    struct apply_patch_files_t *self_p;
+    long long offset;
+    int res;
+
+    self_p = (struct apply_patch_files_t *)arg_p;
+
+    if (self_p->failed) {
+        return (-DETOOLS_IO_FAILED);
+    }
+
+    offset = (self_p->from.offset - self_p->from.buf_offset);
+
+    if ((offset < 0) || ((size_t)offset + size > self_p->from.buf_size)) {
+        PyEval_RestoreThread(self_p->thread_state_p);
+        res = files_from_fill(self_p);
+        self_p->thread_state_p = PyEval_SaveThread();
+
+        if (res != 0) {
+            self_p->failed = true;
+
+            return (-DETOOLS_IO_FAILED);
+        }
+
+        if (size > self_p->from.buf_size) {
+            return (-DETOOLS_IO_FAILED);
+        }
+
+        offset = 0;
+    }
+
+    memcpy(buf_p, &self_p->from.buf[offset], size);
+    self_p->from.offset += (long long)size;
+
+    return (0);
+}
+
+static int files_from_seek(void *arg_p, int offset)
+{
+    struct apply_patch_files_t *self_p;
+
+    self_p = (struct apply_patch_files_t *)arg_p;
+
+    if (self_p->from.offset + offset < 0) {
+        return (-DETOOLS_IO_FAILED);
+    }
+
+    self_p->from.offset += offset;
+    self_p->chunks++;
+
+    return (0);
+}
+
+/* Writes buffered to data. Must be called with the GIL held. */
+static int files_to_flush(struct apply_patch_files_t *self_p)
+{
+    PyObject *res_p;
+
+    if (self_p->to.buf_size == 0) {
+        return (0);
+    }
+
+    res_p = PyObject_CallMethod(self_p->fto_p,
+                                "write",
+                                "y#",
+                                &self_p->to.buf[0],
+                                (Py_ssize_t)self_p->to.buf_size);
+
+    if (res_p == NULL) {
+        return (-1);
+    }
+
+    Py_DECREF(res_p);
+    self_p->to.buf_size = 0;
+
+    return (0);
+}
+
+static int files_to_write(void *arg_p, const uint8_t *buf_p, size_t size)
+{
+    struct apply_patch_files_t *self_p;
+    int res;
+
+    self_p = (struct apply_patch_files_t *)arg_p;
+
+    if (self_p->failed) {
+        return (-DETOOLS_IO_FAILED);
+    }
+
+    if (size > FILE_CHUNK_SIZE - self_p->to.buf_size) {
+        PyEval_RestoreThread(self_p->thread_state_p);
+        res = files_to_flush(self_p);
+        self_p->thread_state_p = PyEval_SaveThread();
+
+        if (res != 0) {
+            self_p->failed = true;
+
+            return (-DETOOLS_IO_FAILED);
+        }
+    }
+
+    memcpy(&self_p->to.buf[self_p->to.buf_size], buf_p, size);
+    self_p->to.buf_size += size;
+
+    return (0);
+}
+
+static bool is_in_memory(struct apply_patch_in_place_t *self_p,
+                         uintptr_t addr,
+                         size_t size)
+{
+    return ((addr <= self_p->memory.size)
+            && (size <= self_p->memory.size - addr));
+}
+
+static int mem_read(void *arg_p, void *dst_p, uintptr_t src, size_t size)
+{
+    struct apply_patch_in_place_t *self_p;
+
+    self_p = (struct apply_patch_in_place_t *)arg_p;
+
+    if (!is_in_memory(self_p, src, size)) {
+        return (-DETOOLS_IO_FAILED);
+    }
+
+    memcpy(dst_p, &self_p->memory.buf_p[src], size);
+
+    return (0);
+}
+
+static int mem_write(void *arg_p, uintptr_t dst, void *src_p, size_t size)
+{
+    struct apply_patch_in_place_t *self_p;
+
+    self_p = (struct apply_patch_in_place_t *)arg_p;
+
+    if (!is_in_memory(self_p, dst, size)) {
+        return (-DETOOLS_IO_FAILED);
+    }
+
+    memcpy(&self_p->memory.buf_p[dst], src_p, size);
+
+    return (0);
+}
+
+static int mem_erase(void *arg_p, uintptr_t addr, size_t size)
+{
+    struct apply_patch_in_place_t *self_p;
+
+    self_p = (struct apply_patch_in_place_t *)arg_p;
+
+    if (!is_in_memory(self_p, addr, size)) {
+        return (-DETOOLS_IO_FAILED);
+    }
+
+    return (0);
+}
+
+static int step_set(void *arg_p, int step)
+{
+    ((struct apply_patch_in_place_t *)arg_p)->step = step;
+
+    return (0);
+}
+
+static int step_get(void *arg_p, int *step_p)
+{
+    *step_p = ((struct apply_patch_in_place_t *)arg_p)->step;
+
+    return (0);
+}
+
+static int apply_patch(const uint8_t *from_p,
+                       size_t from_size,
+                       const uint8_t *patch_p,
+                       size_t patch_size,
+                       uint8_t *to_p,
+                       size_t to_size,
+                       size_t *chunks_p)
+{
+    int res;
+    struct apply_patch_t self;
+    struct detools_apply_patch_t apply_patch;
+
+    self.from.buf_p = (uint8_t *)from_p;
+    self.from.size = from_size;
+    self.from.offset = 0;
+    self.to.buf_p = to_p;
+    self.to.size = to_size;
+    self.to.offset = 0;
+    self.chunks = 0;
+    *chunks_p = 0;
+
+    res = detools_apply_patch_init(&apply_patch,
+                                   from_read,
+                                   from_seek,
+                                   patch_size,
+                                   to_write,
+                                   &self);
+
+    if (res != 0) {
+        return (res);
+    }
+
+    res = detools_apply_patch_process(&apply_patch, patch_p, patch_size);
+
+    if (res == 0) {
+        res = detools_apply_patch_finalize(&apply_patch);
+    } else {
+        (void)detools_apply_patch_finalize(&apply_patch);
+    }
+
+    if ((res >= 0) && ((size_t)res != to_size)) {
+        res = -DETOOLS_CORRUPT_PATCH;
+    }
+
+    *chunks_p = self.chunks;
+
+    return (res);
+}
+
+static int apply_patch_in_place(uint8_t *memory_p,
+                                size_t memory_size,
+                                const uint8_t *patch_p,
+                                size_t patch_size)
+{
+    int res;
+    struct apply_patch_in_place_t self;
+    struct detools_apply_patch_in_place_t apply_patch;
+
+    self.memory.buf_p = memory_p;
+    self.memory.size = memory_size;
+    self.memory.offset = 0;
+    self.step = 0;
+
+    res = detools_apply_patch_in_place_init(&apply_patch,
+                                            mem_read,
+                                            mem_write,
+                                            mem_erase,
+                                            step_set,
+                                            step_get,
+                                            patch_size,
+                                            &self);
+
+    if (res != 0) {
+        return (res);
+    }
+
+    res = detools_apply_patch_in_place_process(&apply_patch,
+                                               patch_p,
+                                               patch_size);
+
+    if (res == 0) {
+        res = detools_apply_patch_in_place_finalize(&apply_patch);
+    } else {
+        (void)detools_apply_patch_in_place_finalize(&apply_patch);
+    }
+
+    return (res);
+}
+
+/* Feeds the patch in chunks read from fpatch to given initialized
+   apply patch object. Must be called with the GIL held. Returns the
+   to size, or a negative error code. */
+static int apply_patch_files_process(struct apply_patch_files_t *self_p,
+                                     struct detools_apply_patch_t *apply_patch_p,
+                                     PyObject *fpatch_p,
+                                     size_t patch_size)
+{
+    int res;
+    PyObject *chunk_p;
+    char *buf_p;
+    Py_ssize_t size;
+    size_t offset;
+
+    res = 0;
+    offset = 0;
+
+    while ((offset < patch_size) && (res == 0)) {
+        chunk_p = PyObject_CallMethod(fpatch_p,
+                                      "read",
+                                      "n",
+                                      (Py_ssize_t)MIN(FILE_CHUNK_SIZE,
+                                                      patch_size - offset));
+
+        if (chunk_p == NULL) {
+            self_p->failed = true;
+
+            return (-DETOOLS_IO_FAILED);
+        }
+
+        if (PyBytes_AsStringAndSize(chunk_p, &buf_p, &size) != 0) {
+            Py_DECREF(chunk_p);
+            self_p->failed = true;
+
+            return (-DETOOLS_IO_FAILED);
+        }
+
+        if (size == 0) {
+            Py_DECREF(chunk_p);
+
+            return (-DETOOLS_IO_FAILED);
+        }
+
+        self_p->thread_state_p = PyEval_SaveThread();
+        res = detools_apply_patch_process(apply_patch_p,
+                                          (const uint8_t *)buf_p,
+                                          (size_t)size);
+        PyEval_RestoreThread(self_p->thread_state_p);
+        Py_DECREF(chunk_p);
+        offset += (size_t)size;
+    }
+
+    if (self_p->failed) {
+        return (-DETOOLS_IO_FAILED);
+    }
+
+    self_p->thread_state_p = PyEval_SaveThread();
+
+    if (res == 0) {
+        res = detools_apply_patch_finalize(apply_patch_p);
+    } else {
+        (void)detools_apply_patch_finalize(apply_patch_p);
+    }
+
+    PyEval_RestoreThread(self_p->thread_state_p);
+
+    if (self_p->failed) {
+        return (-DETOOLS_IO_FAILED);
+    }
+
+    if (res >= 0) {
+        if (files_to_flush(self_p) != 0) {
+            self_p->failed = true;
+
+            return (-DETOOLS_IO_FAILED);
+        }
+    }
+
+    return (res);
+}
+
+static void set_error(int res)
+{
+    if (res == -DETOOLS_NOT_IMPLEMENTED) {
+        PyErr_SetString(PyExc_RuntimeError,
+                        "Data formats are not supported by the C engine.");
+    } else {
+        PyErr_SetString(PyExc_RuntimeError, detools_error_as_string(res));
+    }
+}
+
+/**
+ * def apply_patch(from_data, patch, to_data) -> (to_size, chunks)
+ *
+ * Apply given sequential patch to from_data and write the result to
+ * the writable buffer to_data, which must be exactly to size bytes.
+ */
+static PyObject *m_apply_patch(PyObject *self_p, PyObject *args_p)
+{
+    int res;
+    size_t chunks;
+    PyObject *from_p;
+    PyObject *patch_p;
+    PyObject *to_p;
+    Py_buffer from_view;
+    Py_buffer patch_view;
+    Py_buffer to_view;
+
+    res = PyArg_ParseTuple(args_p, "OOO", &from_p, &patch_p, &to_p);
+
+    if (res == 0) {
+        return (NULL);
+    }
+
+    res = PyObject_GetBuffer(from_p, &from_view, PyBUF_CONTIG_RO);
+
+    if (res == -1) {
+        return (NULL);
+    }
+
+    res = PyObject_GetBuffer(patch_p, &patch_view, PyBUF_CONTIG_RO);
+
+    if (res == -1) {
+        goto err1;
+    }
+
+    res = PyObject_GetBuffer(to_p, &to_view, PyBUF_CONTIG);
+
+    if (res == -1) {
+        goto err2;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    res = apply_patch((const uint8_t *)from_view.buf,
+                      (size_t)from_view.len,
+                      (const uint8_t *)patch_view.buf,
+                      (size_t)patch_view.len,
+                      (uint8_t *)to_view.buf,
+                      (size_t)to_view.len,
+                      &chunks);
+    Py_END_ALLOW_THREADS
+
+    if (res < 0) {
+        set_error(res);
+
+        goto err3;
+    }
+
+    PyBuffer_Release(&from_view);
+    PyBuffer_Release(&patch_view);
+    PyBuffer_Release(&to_view);
+
+    return (Py_BuildValue("(in)", res, (Py_ssize_t)chunks));
+
+ err3:
+    PyBuffer_Release(&to_view);
+
+ err2:
+    PyBuffer_Release(&patch_view);
+
+ err1:
+    PyBuffer_Release(&from_view);
+
+    return (NULL);
+}
+
+/**
+ * def apply_patch_files(ffrom, fpatch, fto, patch_size) -> (to_size, chunks)
+ *
+ * Apply given sequential patch of patch_size bytes, read from fpatch,
+ * to the from data in ffrom, starting at its current position, and
+ * write the result to fto. All data is read and written in chunks.
+ */
+static PyObject *m_apply_patch_files(PyObject *self_p, PyObject *args_p)
+{
+    int res;
+    size_t chunks;
+    PyObject *fpatch_p;
+    PyObject *offset_p;
+    Py_ssize_t patch_size;
+    struct apply_patch_files_t *files_p;
+    struct detools_apply_patch_t apply_patch;
+
+    files_p = PyMem_Malloc(sizeof(*files_p));
+
+    if (files_p == NULL) {
+        return (PyErr_NoMemory());
+    }
+
+    res = PyArg_ParseTuple(args_p,
+                           "OOOn",
+                           &files_p->ffrom_p,
+                           &fpatch_p,
+                           &files_p->fto_p,
+                           &patch_size);
+
+    if (res == 0) {
+        goto err1;
+    }
+
+    if (patch_size < 0) {
+        PyErr_SetString(PyExc_ValueError, "Negative patch size.");
+
+        goto err1;
+    }
+
+    offset_p = PyObject_CallMethod(files_p->ffrom_p, "tell", NULL);
+
+    if (offset_p == NULL) {
+        goto err1;
+    }
+
+    files_p->from.base = PyLong_AsLongLong(offset_p);
+    Py_DECREF(offset_p);
+
+    if (PyErr_Occurred()) {
+        goto err1;
+    }
+
+    files_p->failed = false;
+    files_p->chunks = 0;
+    files_p->from.offset = 0;
+    files_p->from.buf_offset = 0;
+    files_p->from.buf_size = 0;
+    files_p->to.buf_size = 0;
+
+    res = detools_apply_patch_init(&apply_patch,
+                                   files_from_read,
+                                   files_from_seek,
+                                   (size_t)patch_size,
+                                   files_to_write,
+                                   files_p);
+
+    if (res == 0) {
+        res = apply_patch_files_process(files_p,
+                                        &apply_patch,
+                                        fpatch_p,
+                                        (size_t)patch_size);
+    }
+
+    if (files_p->failed) {
+        goto err1;
+    }
+
+    if (res < 0) {
+        set_error(res);
+
+        goto err1;
+    }
+
+    chunks = files_p->chunks;
+    PyMem_Free(files_p);
+
+    return (Py_BuildValue("(in)", res, (Py_ssize_t)chunks));
+
+ err1:
+    PyMem_Free(files_p);
+
+    return (NULL);
+}
+
+/**
+ * def apply_patch_in_place(memory, patch) -> to_size
+ *
+ * Apply given in-place patch to the writable buffer memory.
+ */
+static PyObject *m_apply_patch_in_place(PyObject *self_p, PyObject *args_p)
+{
+    int res;
+    PyObject *memory_p;
+    PyObject *patch_p;
+    Py_buffer memory_view;
+    Py_buffer patch_view;
+
+    res = PyArg_ParseTuple(args_p, "OO", &memory_p, &patch_p);
+
+    if (res == 0) {
+        return (NULL);
+    }
+
+    res = PyObject_GetBuffer(memory_p, &memory_view, PyBUF_CONTIG);
+
+    if (res == -1) {
+        return (NULL);
+    }
+
+    res = PyObject_GetBuffer(patch_p, &patch_view, PyBUF_CONTIG_RO);
+
+    if (res == -1) {
+        goto err1;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    res = apply_patch_in_place((uint8_t *)memory_view.buf,
+                               (size_t)memory_view.len,
+                               (const uint8_t *)patch_view.buf,
+                               (size_t)patch_view.len);
+    Py_END_ALLOW_THREADS
+
+    if (res < 0) {
+        set_error(res);
+
+        goto err2;
+    }
+
+    PyBuffer_Release(&memory_view);
+    PyBuffer_Release(&patch_view);
+
+    return (PyLong_FromLong(res));
+
+ err2:
+    PyBuffer_Release(&patch_view);
+
+ err1:
+    PyBuffer_Release(&memory_view);
+
+    return (NULL);
+}
+
+static PyMethodDef module_methods[] = {
+    { "apply_patch", m_apply_patch, METH_VARARGS },
+    { "apply_patch_files", m_apply_patch_files, METH_VARARGS },
+    { "apply_patch_in_place", m_apply_patch_in_place, METH_VARARGS },
+    { NULL }
+};
+
+static PyModuleDef module = {
+    PyModuleDef_HEAD_INIT,
+    .m_name = "capply",
+    .m_doc = NULL,
+    .m_size = -1,
+    .m_methods = module_methods
+};
+
+PyMODINIT_FUNC PyInit_capply(void)
+{
+    PyObject *m_p;
+
+    /* Module creation. */
+    m_p = PyModule_Create(&module);
+
+    if (m_p == NULL) {
+        return (NULL);
+    }
+
+    return (m_p);
+}
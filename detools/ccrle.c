@@ -0,0 +1,471 @@
+/**
+ * BSD 2-Clause License
+ *
+ * Copyright (c) 2019-2020, Erik Moqvist
+ * All rights reserved.
+ *
+ * Redistribution and use in source and binary forms, with or without
+ * modification, are permitted provided that the following conditions
+ * are met:
+ *
+ * * Redistributions of source code must retain the above copyright
+ *   notice, this list of conditions and the following disclaimer.
+ *
+ * * Redistributions in binary form must reproduce the above copyright
+ *   notice, this list of conditions and the following disclaimer in
+ *   the documentation and/or other materials provided with the
+ *   distribution.
+ *
+ * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+ * "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+ * LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+ * FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+ * COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+ * INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+ * (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+ * SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+ * HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+ * STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ * ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+ * OF THE POSSIBILITY OF SUCH DAMAGE.
+ *
+ * Conditional Run Length Encoding (CRLE) in C. Creates exactly the
+ * same output as the Python implementation in
+ * detools/compression/crle.py.
+ */
+
+#include <stdbool.h>
+#include <stdint.h>
+#include <string.h>
+#include <Python.h>
+
+#define MINIMUM_REPEATED_SIZE                               6
+
+#define SCATTERED                                           0
+#define REPEATED                                            1
+
+/* Maximum segment header size; kind and size. */
+#define SEGMENT_HEADER_SIZE                                11
+
+#define DECODE_OK                                           0
+#define DECODE_BAD_KIND                                    -1
+#define DECODE_SIZE_TOO_BIG                                -2
+
+static size_t pack_size(uint8_t *buf_p, uint64_t value)
+{
+    size_t size;
+
+    size = 0;
+
+    do {
+        buf_p[size] = (0x80 | (value & 0x7f));
+        value >>= 7;
+        size++;
+    } while (value > 0);
+
+    buf_p[size - 1] &= 0x7f;
+
+    return (size);
+}
+
+/* Returns the number of bytes unpacked, 0 if more data is needed, or
+   DECODE_SIZE_TOO_BIG. */
+static int unpack_size(const uint8_t *buf_p, size_t size, uint64_t *value_p)
+{
+    size_t i;
+    uint8_t byte;
+    int shift;
+
+    *value_p = 0;
+    shift = 0;
+
+    for (i = 0; i < size; i++) {
+        if (shift > 63) {
+            return (DECODE_SIZE_TOO_BIG);
+        }
+
+        byte = buf_p[i];
+        *value_p |= ((uint64_t)(byte & 0x7f) << shift);
+        shift += 7;
+
+        if ((byte & 0x80) == 0) {
+            return ((int)i + 1);
+        }
+    }
+
+    return (0);
+}
+
+static size_t run_length(const uint8_t *buf_p, size_t offset, size_t size)
+{
+    size_t length;
+
+    length = 1;
+
+    while ((offset + length < size)
+           && (buf_p[offset + length] == buf_p[offset])) {
+        length++;
+    }
+
+    return (length);
+}
+
+static size_t write_segment(uint8_t *dst_p,
+                            int kind,
+                            const uint8_t *src_p,
+                            size_t length)
+{
+    size_t size;
+
+    dst_p[0] = (uint8_t)kind;
+    size = 1;
+    size += pack_size(&dst_p[size], length);
+
+    if (kind == SCATTERED) {
+        memcpy(&dst_p[size], src_p, length);
+        size += length;
+    } else {
+        dst_p[size] = src_p[0];
+        size++;
+    }
+
+    return (size);
+}
+
+/* Compress all complete segments in given data. A repeated segment
+   ending at the end of the data is not complete unless flushing, as
+   more repeated bytes may follow. Neither are scattered data not
+   followed by a repeated segment. */
+static size_t compress(const uint8_t *src_p,
+                       size_t src_size,
+                       size_t offset,
+                       bool flush,
+                       uint8_t *dst_p,
+                       size_t *consumed_p,
+                       size_t *offset_p)
+{
+    size_t dst_size;
+    size_t segment_offset;
+    size_t length;
+
+    dst_size = 0;
+    segment_offset = 0;
+
+    while (offset < src_size) {
+        length = run_length(src_p, offset, src_size);
+
+        if ((offset + length == src_size) && !flush) {
+            break;
+        }
+
+        if (length >= MINIMUM_REPEATED_SIZE) {
+            if (offset > segment_offset) {
+                dst_size += write_segment(&dst_p[dst_size],
+                                          SCATTERED,
+                                          &src_p[segment_offset],
+                                          offset - segment_offset);
+            }
+
+            dst_size += write_segment(&dst_p[dst_size],
+                                      REPEATED,
+                                      &src_p[offset],
+                                      length);
+            segment_offset = offset + length;
+        }
+
+        offset += length;
+    }
+
+    if (flush && (src_size > segment_offset)) {
+        dst_size += write_segment(&dst_p[dst_size],
+                                  SCATTERED,
+                                  &src_p[segment_offset],
+                                  src_size - segment_offset);
+        segment_offset = src_size;
+    }
+
+    *consumed_p = segment_offset;
+    *offset_p = (offset - segment_offset);
+
+    return (dst_size);
+}
+
+/* Decode all complete segments in given data, and as much as
+   available of a scattered segment. Only calculates the decompressed
+   size if dst_p is NULL. The consumed size is the offset of the bad
+   segment on failure. */
+static int decompress(const uint8_t *src_p,
+                      size_t src_size,
+                      uint64_t scattered_left,
+                      uint8_t *dst_p,
+                      uint64_t *dst_size_p,
+                      size_t *consumed_p,
+                      uint64_t *scattered_left_p)
+{
+    size_t offset;
+    size_t length;
+    uint64_t value;
+    uint64_t dst_size;
+    int res;
+
+    offset = 0;
+    dst_size = 0;
+
+    while (true) {
+        if (scattered_left > 0) {
+            length = src_size - offset;
+
+            if (length > scattered_left) {
+                length = scattered_left;
+            }
+
+            if (dst_p != NULL) {
+                memcpy(&dst_p[dst_size], &src_p[offset], length);
+            }
+
+            dst_size += length;
+            offset += length;
+            scattered_left -= length;
+
+            if (scattered_left > 0) {
+                break;
+            }
+        }
+
+        if (offset == src_size) {
+            break;
+        }
+
+        *consumed_p = offset;
+
+        if (src_p[offset] > REPEATED) {
+            return (DECODE_BAD_KIND);
+        }
+
+        res = unpack_size(&src_p[offset + 1], src_size - offset - 1, &value);
+
+        if (res < 0) {
+            return (res);
+        } else if (res == 0) {
+            break;
+        }
+
+        if (src_p[offset] == SCATTERED) {
+            offset += (1 + (size_t)res);
+            scattered_left = value;
+        } else {
+            if (offset + 1 + (size_t)res == src_size) {
+                break;
+            }
+
+            if (dst_p != NULL) {
+                memset(&dst_p[dst_size], src_p[offset + 1 + res], value);
+            }
+
+            dst_size += value;
+            offset += (2 + (size_t)res);
+        }
+    }
+
+    *dst_size_p = dst_size;
+    *consumed_p = offset;
+    *scattered_left_p = scattered_left;
+
+    return (DECODE_OK);
+}
+
+/**
+ * def compress(data, offset, flush) -> (compressed, consumed, offset)
+ *
+ * Compress all complete segments in data, starting the search for
+ * repeated bytes at offset. Returns the compressed segments, the
+ * number of data bytes they contain and the offset to pass in the
+ * next call, relative to the first data byte not consumed.
+ */
+static PyObject *m_compress(PyObject *self_p, PyObject *args_p)
+{
+    int res;
+    PyObject *data_p;
+    Py_ssize_t offset;
+    int flush;
+    Py_buffer data_view;
+    PyObject *compressed_p;
+    size_t compressed_size;
+    size_t consumed;
+    size_t next_offset;
+    size_t max_size;
+
+    res = PyArg_ParseTuple(args_p, "Onp", &data_p, &offset, &flush);
+
+    if (res == 0) {
+        return (NULL);
+    }
+
+    res = PyObject_GetBuffer(data_p, &data_view, PyBUF_CONTIG_RO);
+
+    if (res == -1) {
+        return (NULL);
+    }
+
+    if ((offset < 0) || (offset > data_view.len)) {
+        PyErr_SetString(PyExc_ValueError, "Bad offset.");
+
+        goto err1;
+    }
+
+    /* There are at most two segments per repeated segment, and every
+       segment is at most its data and a header. */
+    max_size = ((size_t)data_view.len
+                + (2 * ((size_t)data_view.len / MINIMUM_REPEATED_SIZE) + 1)
+                * SEGMENT_HEADER_SIZE);
+    compressed_p = PyBytes_FromStringAndSize(NULL, (Py_ssize_t)max_size);
+
+    if (compressed_p == NULL) {
+        goto err1;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    compressed_size = compress((const uint8_t *)data_view.buf,
+                               (size_t)data_view.len,
+                               (size_t)offset,
+                               flush,
+                               (uint8_t *)PyBytes_AS_STRING(compressed_p),
+                               &consumed,
+                               &next_offset);
+    Py_END_ALLOW_THREADS
+
+    PyBuffer_Release(&data_view);
+
+    res = _PyBytes_Resize(&compressed_p, (Py_ssize_t)compressed_size);
+
+    if (res != 0) {
+        return (NULL);
+    }
+
+    return (Py_BuildValue("Nnn",
+                          compressed_p,
+                          (Py_ssize_t)consumed,
+                          (Py_ssize_t)next_offset));
+
+ err1:
+    PyBuffer_Release(&data_view);
+
+    return (NULL);
+}
+
+/**
+ * def decompress(data, scattered_left) -> (decompressed,
+ *                                          consumed,
+ *                                          scattered_left)
+ *
+ * Decompress all complete segments in data, given that scattered_left
+ * bytes of a scattered segment remains. Returns the decompressed data,
+ * the number of consumed data bytes and the number of bytes left of
+ * the last scattered segment.
+ */
+static PyObject *m_decompress(PyObject *self_p, PyObject *args_p)
+{
+    int res;
+    PyObject *data_p;
+    unsigned long long scattered_left;
+    Py_buffer data_view;
+    PyObject *decompressed_p;
+    uint64_t decompressed_size;
+    size_t consumed;
+    uint64_t next_scattered_left;
+
+    res = PyArg_ParseTuple(args_p, "OK", &data_p, &scattered_left);
+
+    if (res == 0) {
+        return (NULL);
+    }
+
+    res = PyObject_GetBuffer(data_p, &data_view, PyBUF_CONTIG_RO);
+
+    if (res == -1) {
+        return (NULL);
+    }
+
+    res = decompress((const uint8_t *)data_view.buf,
+                     (size_t)data_view.len,
+                     scattered_left,
+                     NULL,
+                     &decompressed_size,
+                     &consumed,
+                     &next_scattered_left);
+
+    if (res == DECODE_BAD_KIND) {
+        PyErr_Format(PyExc_ValueError,
+                     "Expected kind scattered(0) or repeated(1), but got %d.",
+                     ((const uint8_t *)data_view.buf)[consumed]);
+
+        goto err1;
+    } else if (res == DECODE_SIZE_TOO_BIG) {
+        PyErr_SetString(PyExc_ValueError, "Size too big.");
+
+        goto err1;
+    }
+
+    if (decompressed_size > PY_SSIZE_T_MAX) {
+        PyErr_SetString(PyExc_ValueError, "Size too big.");
+
+        goto err1;
+    }
+
+    decompressed_p = PyBytes_FromStringAndSize(NULL,
+                                               (Py_ssize_t)decompressed_size);
+
+    if (decompressed_p == NULL) {
+        goto err1;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    (void)decompress((const uint8_t *)data_view.buf,
+                     (size_t)data_view.len,
+                     scattered_left,
+                     (uint8_t *)PyBytes_AS_STRING(decompressed_p),
+                     &decompressed_size,
+                     &consumed,
+                     &next_scattered_left);
+    Py_END_ALLOW_THREADS
+
+    PyBuffer_Release(&data_view);
+
+    return (Py_BuildValue("NnK",
+                          decompressed_p,
+                          (Py_ssize_t)consumed,
+                          (unsigned long long)next_scattered_left));
+
+ err1:
+    PyBuffer_Release(&data_view);
+
+    return (NULL);
+}
+
+static PyMethodDef module_methods[] = {
+    { "compress", m_compress, METH_VARARGS },
+    { "decompress", m_decompress, METH_VARARGS },
+    { NULL }
+};
+
+static PyModuleDef module = {
+    PyModuleDef_HEAD_INIT,
+    .m_name = "ccrle",
+    .m_doc = NULL,
+    .m_size = -1,
+    .m_methods = module_methods
+};
+
+PyMODINIT_FUNC PyInit_ccrle(void)
+{
+    PyObject *m_p;
+
+    /* Module creation. */
+    m_p = PyModule_Create(&module);
+
+    if (m_p == NULL) {
+        return (NULL);
+    }
+
+    return (m_p);
+}
@@ -1,10 +1,20 @@
 import os
+import sys
+import time
 import struct
+import threading
 from io import BytesIO
+from contextlib import contextmanager
+from contextvars import ContextVar
 import bitstruct
 from .errors import Error
 from .bsdiff import pack_size
 
+try:
+    import resource
+except ImportError:
+    resource = None
+
 
 PATCH_TYPE_SEQUENTIAL  = 0
 PATCH_TYPE_IN_PLACE    = 1
@@ -34,6 +44,8 @@ COMPRESSIONS = {
     'lz4': COMPRESSION_LZ4
 }
 
+SUFFIX_ARRAY_ALGORITHMS = ('sais', 'divsufsort', 'divsufsort-mt')
+
 DATA_FORMAT_ARM_CORTEX_M4 = 0
 DATA_FORMAT_AARCH64       = 1
 DATA_FORMAT_XTENSA_LX106  = 2
@@ -102,6 +114,179 @@ def div_ceil(a, b):
     return (a + b - 1) // b
 
 
+def peak_memory_usage():
+    """Returns the peak resident set size (RSS) of this process in bytes,
+    or ``None`` if unknown.
+
+    """
+
+    if resource is None:
+        return None
+
+    size = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Kilobytes on Linux, but bytes on macOS.
+    if sys.platform != 'darwin':
+        size *= 1024
+
+    return size
+
+
+class StageStats(object):
+    """Statistics of a patch creation or application stage. `wall_time`
+    and `cpu_time` are in seconds. The CPU time is the one used by the
+    thread executing the stage.
+
+    """
+
+    def __init__(self, wall_time=0, cpu_time=0):
+        self.wall_time = wall_time
+        self.cpu_time = cpu_time
+
+    def __repr__(self):
+        return 'StageStats(wall_time={}, cpu_time={})'.format(self.wall_time,
+                                                             self.cpu_time)
+
+
+class PatchStats(object):
+    """Statistics of a created or applied patch. Sizes are in bytes and
+    times in seconds.
+
+    `time` and `cpu_time` are the wall and CPU time of the whole
+    operation. The CPU time is the one used by the whole process,
+    including other threads. `peak_memory` is the peak resident set
+    size of the process since it was started, or ``None`` if
+    unknown. It is not reset per operation, so it includes earlier
+    operations and other threads, and is only an upper bound of the
+    memory used by this one. `chunks` is the number of bsdiff controls,
+    each a diff, an extra and an adjustment, created or applied. It is
+    zero for hdiffpatch patches and in-place patches applied by the C
+    engine.
+
+    `stages` is a dictionary of stage name to :class:`~detools.StageStats`.
+    Nested stages are not included in the time of their parent
+    stage. Creation stages are ``'read'``, ``'data-format'``,
+    ``'suffix-sort'``, ``'bsdiff'``, ``'hdiffpatch'``, ``'compress'``
+    and ``'write'``. Application stages are ``'read'``,
+    ``'data-format'``, ``'decompress'``, ``'apply'`` and ``'write'``.
+    The C engine reads, decompresses and writes as it applies, so all
+    its work is recorded in the ``'apply'`` stage.
+
+    """
+
+    def __init__(self, from_size=0, to_size=0, patch_size=0, time=0):
+        self.from_size = from_size
+        self.to_size = to_size
+        self.patch_size = patch_size
+        self.time = time
+        self.cpu_time = 0
+        self.peak_memory = None
+        self.chunks = 0
+        self.stages = {}
+
+    def __repr__(self):
+        return ('PatchStats(from_size={}, to_size={}, patch_size={}, '
+                'time={}, cpu_time={}, peak_memory={}, chunks={}, '
+                'stages={})'.format(self.from_size,
+                                    self.to_size,
+                                    self.patch_size,
+                                    self.time,
+                                    self.cpu_time,
+                                    self.peak_memory,
+                                    self.chunks,
+                                    self.stages))
+
+
+# The statistics of the patch being created or applied in the current
+# context, if any.
+_STATS = ContextVar('stats', default=None)
+
+# Stages of the current thread, and the lock protecting the statistics
+# of patches created in multiple threads.
+_STAGES = threading.local()
+_STATS_LOCK = threading.Lock()
+
+
+@contextmanager
+def collect_stats(stats):
+    """Record the total times, the peak memory usage of the process and
+    all stages executed within the context in given statistics, unless
+    ``None``.
+
+    """
+
+    if stats is None:
+        yield
+
+        return
+
+    token = _STATS.set(stats)
+    start_time = time.time()
+    start_cpu_time = time.process_time()
+
+    try:
+        yield
+    finally:
+        _STATS.reset(token)
+        stats.time = time.time() - start_time
+        stats.cpu_time = time.process_time() - start_cpu_time
+        stats.peak_memory = peak_memory_usage()
+
+
+@contextmanager
+def stage(name):
+    """Record the wall and CPU time of the stage executed within the
+    context in the statistics being collected, if any. Time spent in a
+    stage named ``None``, for example waiting for another thread, is
+    not recorded at all.
+
+    """
+
+    stats = _STATS.get()
+
+    if stats is None:
+        yield
+
+        return
+
+    if not hasattr(_STAGES, 'stack'):
+        _STAGES.stack = []
+
+    # Wall and CPU times of the stage and of its nested stages.
+    times = [time.time(), time.thread_time(), 0, 0]
+    _STAGES.stack.append(times)
+
+    try:
+        yield
+    finally:
+        _STAGES.stack.pop()
+        wall_time = time.time() - times[0]
+        cpu_time = time.thread_time() - times[1]
+
+        if _STAGES.stack:
+            _STAGES.stack[-1][2] += wall_time
+            _STAGES.stack[-1][3] += cpu_time
+
+        if name is not None:
+            with _STATS_LOCK:
+                stage_stats = stats.stages.setdefault(name, StageStats())
+                stage_stats.wall_time += wall_time - times[2]
+                stage_stats.cpu_time += cpu_time - times[3]
+
+
+def add_chunks(count):
+    """Add given number of chunks to the statistics being collected, if
+    any.
+
+    """
+
+    stats = _STATS.get()
+
+    if stats is not None:
+        with _STATS_LOCK:
+            stats.chunks += count
+
+
 def file_size(f):
     position = f.tell()
     f.seek(0, os.SEEK_END)
@@ -4,10 +4,19 @@ with RLE, but leaves other data sequences as is.
 It compresses diffs fairly well, but extras poorly. Not very useful in
 general.
 
+The codec is implemented in C if the extension module is available,
+and in Python otherwise. Both create the same output.
+
 """
 
 import struct
 from ..errors import Error
+from .utils import OutputBuffer
+
+try:
+    from .. import ccrle
+except ImportError:
+    ccrle = None
 
 
 MINIMUM_REPEATED_SIZE = 6
@@ -16,7 +25,7 @@ SCATTERED = 0
 REPEATED = 1
 
 
-class CrleCompressor(object):
+class PythonCrleCompressor(object):
 
     def __init__(self):
         self._data = b''
@@ -133,7 +142,7 @@ class CrleCompressor(object):
         return compressed
 
 
-class CrleDecompressor(object):
+class PythonCrleDecompressor(object):
 
     def __init__(self, number_of_bytes):
         self._number_of_indata_bytes_left = number_of_bytes
@@ -223,6 +232,100 @@ class CrleDecompressor(object):
         return data
 
 
+class CCrleCompressor(object):
+
+    def __init__(self):
+        self._data = bytearray()
+        self._offset = 0
+        self._number_of_bytes = 0
+
+    def compress(self, data):
+        """Compress `data` and return any compressed data.
+
+        """
+
+        self._data += data
+        self._number_of_bytes += len(data)
+
+        return self.compress_segments(False)
+
+    def flush(self):
+        """Compress and return remaining data.
+
+        """
+
+        if self._number_of_bytes == 0:
+            compressed = struct.pack('B', SCATTERED)
+            compressed += pack_size(0)
+        else:
+            compressed = self.compress_segments(True)
+
+        return compressed
+
+    def compress_segments(self, flush):
+        compressed, consumed, self._offset = ccrle.compress(self._data,
+                                                            self._offset,
+                                                            flush)
+        del self._data[:consumed]
+
+        return compressed
+
+
+class CCrleDecompressor(object):
+
+    def __init__(self, number_of_bytes):
+        self._number_of_indata_bytes_left = number_of_bytes
+        self._indata = b''
+        self._outdata = OutputBuffer()
+        self._number_of_scattered_bytes_left = 0
+
+    def decompress(self, data, size):
+        """Decompress up to size bytes.
+
+        """
+
+        if self.eof:
+            raise Error('Already at end of stream.')
+
+        if len(data) > self._number_of_indata_bytes_left:
+            data = data[:self._number_of_indata_bytes_left]
+
+        self._number_of_indata_bytes_left -= len(data)
+
+        # Only a partial segment header is left from the previous call.
+        if self._indata:
+            data = self._indata + data
+
+        try:
+            decompressed, consumed, self._number_of_scattered_bytes_left = (
+                ccrle.decompress(data, self._number_of_scattered_bytes_left))
+        except ValueError as e:
+            raise Error(str(e))
+
+        self._indata = data[consumed:]
+        self._outdata.append(decompressed)
+
+        return self._outdata.read(size)
+
+    @property
+    def needs_input(self):
+        return not self._outdata and not self.eof
+
+    @property
+    def eof(self):
+        return (self._number_of_indata_bytes_left == 0
+                and not self._outdata
+                and not self._indata)
+
+
+if ccrle is None:
+    CrleCompressor = PythonCrleCompressor
+    CrleDecompressor = PythonCrleDecompressor
+else:
+    CrleCompressor = CCrleCompressor
+    CrleDecompressor = CCrleDecompressor
+
+
 def pack_size(value):
     if value >= 0x8000000000000000:
         raise Error('Size too big.')
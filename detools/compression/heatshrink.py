@@ -7,6 +7,7 @@ import bitstruct
 from heatshrink2.core import Writer
 from heatshrink2.core import Reader
 from heatshrink2.core import Encoder
+from .utils import OutputBuffer
 
 
 def pack_header(window_sz2, lookahead_sz2):
@@ -43,7 +44,7 @@ class HeatshrinkDecompressor(object):
 
     def __init__(self, number_of_bytes):
         self._number_of_bytes_left = number_of_bytes
-        self._data = b''
+        self._data = OutputBuffer()
         self._encoder = None
         self.window_sz2 = None
         self.lookahead_sz2 = None
@@ -60,22 +61,19 @@ class HeatshrinkDecompressor(object):
             self._number_of_bytes_left -= 1
 
         if self._number_of_bytes_left > 0:
-            self._data += self._encoder.fill(data)
+            self._data.append(self._encoder.fill(data))
             self._number_of_bytes_left -= len(data)
 
         if self._number_of_bytes_left == 0:
-            self._data += self._encoder.finish()
+            self._data.append(self._encoder.finish())
             self._number_of_bytes_left = -1
 
-        decompressed = self._data[:size]
-        self._data = self._data[size:]
-
-        return decompressed
+        return self._data.read(size)
 
     @property
     def needs_input(self):
-        return self._data == b'' and not self.eof
+        return not self._data and not self.eof
 
     @property
     def eof(self):
-        return self._number_of_bytes_left == -1 and self._data == b''
+        return self._number_of_bytes_left == -1 and not self._data
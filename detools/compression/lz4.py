@@ -6,13 +6,17 @@ import os
 from io import BytesIO
 import lz4.frame
 from ..errors import Error
+from .utils import OutputBuffer
 
 
 class Lz4Compressor(object):
 
-    def __init__(self):
+    def __init__(self, level=None):
+        if level is None:
+            level = lz4.frame.COMPRESSIONLEVEL_MAX
+
         self._compressor = lz4.frame.LZ4FrameCompressor(
-            compression_level=lz4.frame.COMPRESSIONLEVEL_MAX)
+            compression_level=level)
         self._header = self._compressor.begin()
 
     def compress(self, data):
@@ -28,6 +32,22 @@ class Lz4Compressor(object):
         return self._compressor.flush()
 
 
-class Lz4Decompressor(lz4.frame.LZ4FrameDecompressor):
+class Lz4Decompressor(object):
+
+    def __init__(self):
+        self._decompressor = lz4.frame.LZ4FrameDecompressor()
+        self._data = OutputBuffer()
+
+    def decompress(self, data, size):
+        if data:
+            self._data.append(self._decompressor.decompress(data))
+
+        return self._data.read(size)
+
+    @property
+    def needs_input(self):
+        return not self._data and not self._decompressor.eof
 
-    pass
+    @property
+    def eof(self):
+        return self._decompressor.eof and not self._data
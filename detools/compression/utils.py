@@ -0,0 +1,52 @@
+"""Utilities shared by the compression wrappers.
+
+"""
+
+from collections import deque
+
+
+class OutputBuffer(object):
+    """A first in, first out buffer of decompressed data. Appended data
+    is not copied, and reading consumes it from the beginning, so the
+    cost of both is proportional to the data size only.
+
+    """
+
+    def __init__(self):
+        self._chunks = deque()
+        self._offset = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def append(self, data):
+        if data:
+            self._chunks.append(memoryview(data))
+            self._size += len(data)
+
+    def read(self, size):
+        """Read and remove up to `size` bytes from the beginning of the
+        buffer.
+
+        """
+
+        chunks = []
+        left = min(size, self._size)
+        self._size -= left
+
+        while left > 0:
+            chunk = self._chunks[0]
+            end = self._offset + left
+
+            if end < len(chunk):
+                chunks.append(chunk[self._offset:end])
+                self._offset = end
+            else:
+                chunks.append(chunk[self._offset:])
+                self._chunks.popleft()
+                self._offset = 0
+
+            left -= len(chunks[-1])
+
+        return b''.join(chunks)
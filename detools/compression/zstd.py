@@ -2,15 +2,25 @@
 
 """
 
-import os
-from io import BytesIO
 import zstandard
 from ..errors import Error
 
 
 class ZstdCompressor(object):
 
-    def __init__(self):
+    def __init__(self, level=None, threads=1):
+        if level is None:
+            level = 22
+
+        # Zero threads compresses in the calling thread and negative
+        # uses all CPUs.
+        if threads is None:
+            threads = -1
+        elif threads == 1:
+            threads = 0
+
+        self._level = level
+        self._threads = threads
         self._data = []
 
     def compress(self, data):
@@ -19,37 +29,104 @@ class ZstdCompressor(object):
         return b''
 
     def flush(self):
-        return zstandard.ZstdCompressor(level=22).compress(b''.join(self._data))
+        compressor = zstandard.ZstdCompressor(level=self._level,
+                                              threads=self._threads)
 
+        return compressor.compress(b''.join(self._data))
 
-class ZstdDecompressor(object):
+
+class NeedsInput(Exception):
+    pass
+
+
+class ZstdDecompressorInput(object):
+    """The compressed data source of the stream reader. Raises
+    `NeedsInput` if empty before all compressed data has been added,
+    as returning no data would end the stream.
+
+    """
 
     def __init__(self, number_of_bytes):
         self._number_of_bytes_left = number_of_bytes
-        self._output_offset = 0
-        self._fout = BytesIO()
-        decompressor = zstandard.ZstdDecompressor()
-        self._decompressor = decompressor.stream_writer(self._fout)
+        self._data = b''
+
+    def add(self, data):
+        self._number_of_bytes_left -= len(data)
+        self._data += data
+
+    def read(self, size):
+        if not self._data and not self.is_complete:
+            raise NeedsInput()
+
+        data = self._data[:size]
+        self._data = self._data[size:]
+
+        return data
+
+    @property
+    def is_complete(self):
+        return self._number_of_bytes_left == 0
+
+    def __len__(self):
+        return len(self._data)
+
+
+class ZstdDecompressor(object):
+    """Decompresses at most `size` bytes at a time using a stream reader,
+    so memory usage does not grow with the patch size or the
+    compression ratio.
+
+    """
+
+    def __init__(self, number_of_bytes):
+        self._input = ZstdDecompressorInput(number_of_bytes)
+        self._reader = zstandard.ZstdDecompressor().stream_reader(
+            self._input,
+            read_across_frames=True)
+        self._output = b''
+        self._is_finished = False
 
     def decompress(self, data, size):
         if self.eof:
             raise Error('Already at end of stream.')
 
-        self._number_of_bytes_left -= len(data)
-        self._decompressor.write(data)
+        if data:
+            self._input.add(data)
 
-        self._fout.seek(self._output_offset, os.SEEK_SET)
-        data = self._fout.read(size)
-        self._output_offset += len(data)
-        self._fout.seek(0, os.SEEK_END)
+        data = self._output
+        self._output = b''
+
+        if len(data) < size:
+            data += self._read(size - len(data))
 
         return data
 
+    def _read(self, size):
+        try:
+            return self._reader.read1(size)
+        except NeedsInput:
+            return b''
+
     @property
     def needs_input(self):
-        return (self._output_offset == self._fout.tell()) and not self.eof
+        return (not self._output
+                and not self._input
+                and not self._input.is_complete)
 
     @property
     def eof(self):
-        return (self._number_of_bytes_left == 0
-                and self._output_offset == self._fout.tell())
+        if self._output or self._input or not self._input.is_complete:
+            return False
+
+        # The decompressor may have buffered output left. Read a byte to
+        # find out. Corrupt data after the end of the stream is not an
+        # end of stream either.
+        if not self._is_finished:
+            try:
+                self._output = self._read(1)
+            except zstandard.ZstdError:
+                return False
+
+            self._is_finished = not self._output
+
+        return self._is_finished
@@ -1,12 +1,23 @@
 import io
+import os
 import time
 import logging
 import tempfile
 import mmap
 import lzma
+import hashlib
+import queue
+import threading
 from bz2 import BZ2Compressor
 from io import BytesIO
 import struct
+from functools import partial
+from contextlib import contextmanager
+from contextvars import copy_context
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import wait
+from concurrent.futures import FIRST_COMPLETED
 import bitstruct
 from humanfriendly import format_timespan
 from humanfriendly import format_size
@@ -29,27 +40,104 @@ from .common import file_read
 from .common import pack_size
 from .common import DataSegment
 from .common import unpack_size_bytes
+from .common import peak_memory_usage
+from .common import PatchStats
+from .common import collect_stats
+from .common import stage
+from .common import add_chunks
 from .data_format import encode as data_format_encode
+from .suffix_array_cache import SuffixArrayCache
 from .suffix_array import sais
 from .suffix_array import divsufsort
+from .suffix_array import divsufsort_mt
+from .suffix_array import divsufsort64
+from .suffix_array import offset as offset_suffix_array
 from . import bsdiff
 from . import hdiffpatch
 
 
 LOGGER = logging.getLogger(__name__)
 
+# Largest from data size that fits in a suffix array with 32 bits
+# items. Bigger data uses 64 bits items.
+SUFFIX_ARRAY_32_MAX_SIZE = 0x7fffffff
+
+# Chunks are passed from the bsdiff thread to the compression thread
+# in batches of at least this many bytes, and at most
+# COMPRESSION_QUEUE_SIZE batches are queued.
+COMPRESSION_BATCH_SIZE = 65536
+COMPRESSION_QUEUE_SIZE = 16
+
+# Content defined chunks used by the cdc-bsdiff algorithm are 4 KiB
+# on average, and 1 KiB to 64 KiB.
+CDC_AVERAGE_SIZE_BITS = 12
+CDC_MINIMUM_SIZE = 1024
+CDC_MAXIMUM_SIZE = 65536
+
+# Windowed patches use to windows of the max memory left for windows
+# divided by this, and from windows twice that size. A window needs
+# about 12 times its to window size for its data, suffix array, diff
+# buffer and chunks.
+MAX_MEMORY_TO_WINDOW_DIVISOR = 16
+MAX_MEMORY_MIN = MAX_MEMORY_TO_WINDOW_DIVISOR * CDC_MAXIMUM_SIZE
+
+# Estimated size in bytes of an entry in the content defined chunks
+# index, including its digest and offset.
+CDC_INDEX_ENTRY_SIZE = 160
+
+# Minimum and maximum compression levels per compression.
+COMPRESSION_LEVELS = {
+    'lzma': (0, 9),
+    'bz2': (1, 9),
+    'zstd': (1, 22),
+    'lz4': (0, 16)
+}
+
 
 def pack_header(patch_type, compression):
     return bitstruct.pack('p1u3u4', patch_type, compression)
 
 
+def check_compression_level(compression, compression_level):
+    if compression_level is None:
+        return
+
+    if compression not in COMPRESSION_LEVELS:
+        raise Error(
+            "Compression level is not supported by {} compression.".format(
+                compression))
+
+    minimum, maximum = COMPRESSION_LEVELS[compression]
+
+    if not minimum <= compression_level <= maximum:
+        raise Error(
+            "Expected {} compression level {}..{}, but got {}.".format(
+                compression,
+                minimum,
+                maximum,
+                compression_level))
+
+
 def create_compressor(compression,
                       heatshrink_window_sz2,
-                      heatshrink_lookahead_sz2):
+                      heatshrink_lookahead_sz2,
+                      compression_level,
+                      compression_threads):
+    check_compression_level(compression, compression_level)
+
+    if compression_threads is not None and compression_threads < 1:
+        raise Error(
+            "Expected at least one compression thread, but got {}.".format(
+                compression_threads))
+
     if compression == 'lzma':
-        compressor = lzma.LZMACompressor(format=lzma.FORMAT_ALONE)
+        compressor = lzma.LZMACompressor(format=lzma.FORMAT_ALONE,
+                                         preset=compression_level)
     elif compression == 'bz2':
-        compressor = BZ2Compressor()
+        if compression_level is None:
+            compression_level = 9
+
+        compressor = BZ2Compressor(compression_level)
     elif compression == 'none':
         compressor = NoneCompressor()
     elif compression == 'crle':
@@ -58,22 +146,50 @@ def create_compressor(compression,
         compressor = HeatshrinkCompressor(heatshrink_window_sz2,
                                           heatshrink_lookahead_sz2)
     elif compression == 'zstd':
-        compressor = ZstdCompressor()
+        compressor = ZstdCompressor(compression_level, compression_threads)
     elif compression == 'lz4':
-        compressor = Lz4Compressor()
+        compressor = Lz4Compressor(compression_level)
     else:
         raise Error(format_bad_compression_string(compression))
 
     return compressor
 
 
-def create_suffix_array(suffix_array, data, suffix_array_algorithm):
-    if suffix_array_algorithm == 'sais':
-        sais(data, suffix_array)
-    elif suffix_array_algorithm == 'divsufsort':
-        divsufsort(data, suffix_array)
+def suffix_array_size(data_size):
+    """Returns the suffix array size in bytes for data of given size.
+
+    """
+
+    if data_size <= SUFFIX_ARRAY_32_MAX_SIZE:
+        item_size = 4
     else:
-        raise Error('Bad suffix array algorithm {}.'.format(suffix_array_algorithm))
+        item_size = 8
+
+    return item_size * (data_size + 1)
+
+
+def create_suffix_array(suffix_array,
+                        data,
+                        suffix_array_algorithm,
+                        suffix_array_threads):
+    with stage('suffix-sort'):
+        if len(data) > SUFFIX_ARRAY_32_MAX_SIZE:
+            LOGGER.debug('Using divsufsort64 as the data is too big for '
+                         'the %s suffix array algorithm.',
+                         suffix_array_algorithm)
+            divsufsort64(data, suffix_array)
+        elif suffix_array_algorithm == 'sais':
+            sais(data, suffix_array)
+        elif suffix_array_algorithm == 'divsufsort':
+            divsufsort(data, suffix_array)
+        elif suffix_array_algorithm == 'divsufsort-mt':
+            if suffix_array_threads is None:
+                suffix_array_threads = os.cpu_count() or 1
+
+            divsufsort_mt(data, suffix_array, suffix_array_threads)
+        else:
+            raise Error('Bad suffix array algorithm {}.'.format(
+                suffix_array_algorithm))
 
 
 def temporary_file(size):
@@ -93,71 +209,178 @@ def mmap_read_write(fin):
     return mmap.mmap(fin.fileno(), 0)
 
 
-def create_chunks_mmap(ffrom, fto, suffix_array_algorithm):
-    LOGGER.debug('Creating chunks using mmap.')
+def create_suffix_array_cache(suffix_array_cache_dir,
+                              suffix_array_cache_size):
+    if suffix_array_cache_dir is None:
+        return None
 
-    suffix_array_size = 4 * (file_size(ffrom) + 1)
+    return SuffixArrayCache(suffix_array_cache_dir, suffix_array_cache_size)
 
-    with mmap_read_only(ffrom) as from_mmap:
-        with mmap_read_only(fto) as to_mmap:
-            with temporary_file(suffix_array_size) as fsuffix_array:
-                with mmap_read_write(fsuffix_array) as suffix_array_mmap:
-                    start_time = time.time()
-                    create_suffix_array(suffix_array_mmap,
-                                        from_mmap,
-                                        suffix_array_algorithm)
 
-                    LOGGER.info('Suffix array of %s created in %s using mmap.',
-                                format_size(suffix_array_size),
-                                format_timespan(time.time() - start_time))
+def load_suffix_array(data,
+                      suffix_array_algorithm,
+                      suffix_array_threads,
+                      suffix_array_cache):
+    """Returns a read-only mmap of the suffix array of given data from
+    given cache. It is created and added to the cache if missing.
+
+    """
+
+    sa_size = suffix_array_size(len(data))
+    key = suffix_array_cache.key(data, suffix_array_algorithm)
+    suffix_array = suffix_array_cache.get(key, sa_size)
+
+    if suffix_array is not None:
+        LOGGER.info('Suffix array of %s loaded from cache.',
+                    format_size(sa_size))
+    else:
+        start_time = time.time()
+        suffix_array = suffix_array_cache.put(
+            key,
+            sa_size,
+            lambda suffix_array: create_suffix_array(suffix_array,
+                                                     data,
+                                                     suffix_array_algorithm,
+                                                     suffix_array_threads))
+
+        LOGGER.info('Suffix array of %s created in %s and added to cache.',
+                    format_size(sa_size),
+                    format_timespan(time.time() - start_time))
+
+    return suffix_array
+
+
+@contextmanager
+def open_suffix_array_mmap(from_mmap,
+                           suffix_array_algorithm,
+                           suffix_array_threads,
+                           suffix_array_cache):
+    if suffix_array_cache is not None:
+        with load_suffix_array(from_mmap,
+                               suffix_array_algorithm,
+                               suffix_array_threads,
+                               suffix_array_cache) as suffix_array_mmap:
+            yield suffix_array_mmap
 
-                    with temporary_file(file_size(fto) + 1) as fde:
-                        with mmap_read_write(fde) as fde_mmap:
-                            start_time = time.time()
-                            chunks = bsdiff.create_patch(suffix_array_mmap,
-                                                         from_mmap,
-                                                         to_mmap,
-                                                         fde_mmap)
+        return
 
-                            LOGGER.info(
-                                'Bsdiff algorithm completed in %s using mmap.',
-                                format_timespan(time.time() - start_time))
+    sa_size = suffix_array_size(len(from_mmap))
 
-    return chunks
+    with temporary_file(sa_size) as fsuffix_array:
+        with mmap_read_write(fsuffix_array) as suffix_array_mmap:
+            start_time = time.time()
+            create_suffix_array(suffix_array_mmap,
+                                from_mmap,
+                                suffix_array_algorithm,
+                                suffix_array_threads)
 
+            LOGGER.info('Suffix array of %s created in %s using mmap.',
+                        format_size(sa_size),
+                        format_timespan(time.time() - start_time))
 
-def create_chunks_heap(ffrom, fto, suffix_array_algorithm):
-    LOGGER.debug('Creating chunks using the heap.')
+            yield suffix_array_mmap
+
+
+@contextmanager
+def open_suffix_array_heap(from_data,
+                           suffix_array_algorithm,
+                           suffix_array_threads,
+                           suffix_array_cache):
+    if suffix_array_cache is not None:
+        with load_suffix_array(from_data,
+                               suffix_array_algorithm,
+                               suffix_array_threads,
+                               suffix_array_cache) as suffix_array_mmap:
+            yield suffix_array_mmap
+
+        return
 
-    from_data = file_read(ffrom)
     start_time = time.time()
-    suffix_array = bytearray(4 * (len(from_data) + 1))
-    create_suffix_array(suffix_array, from_data, suffix_array_algorithm)
+    suffix_array = bytearray(suffix_array_size(len(from_data)))
+    create_suffix_array(suffix_array,
+                        from_data,
+                        suffix_array_algorithm,
+                        suffix_array_threads)
 
     LOGGER.info('Suffix array of %s created in %s.',
                 format_size(len(suffix_array)),
                 format_timespan(time.time() - start_time))
 
-    start_time = time.time()
-    chunks = bsdiff.create_patch(suffix_array,
-                                 from_data,
-                                 file_read(fto),
-                                 bytearray(file_size(fto) + 1))
+    yield suffix_array
 
-    LOGGER.info('Bsdiff algorithm completed in %s.',
-                format_timespan(time.time() - start_time))
 
-    return chunks
+@contextmanager
+def open_data(fin, use_mmap):
+    """Yields the data of given file as an mmap if possible and enabled,
+    otherwise as bytes.
 
+    """
 
-def create_chunks(ffrom, fto, suffix_array_algorithm, use_mmap):
-    if not use_mmap:
-        return create_chunks_heap(ffrom, fto, suffix_array_algorithm)
+    if use_mmap:
+        try:
+            with stage('read'):
+                data_mmap = mmap_read_only(fin)
+        except (io.UnsupportedOperation, ValueError):
+            pass
+        else:
+            with data_mmap:
+                yield data_mmap
 
-    try:
-        return create_chunks_mmap(ffrom, fto, suffix_array_algorithm)
-    except (io.UnsupportedOperation, ValueError):
-        return create_chunks_heap(ffrom, fto, suffix_array_algorithm)
+            return
+
+    with stage('read'):
+        data = file_read(fin)
+
+    yield data
+
+
+@contextmanager
+def open_from_data(ffrom, use_mmap):
+    """Yields the from data as an mmap if possible and enabled, otherwise
+    as bytes, and the matching suffix array context manager.
+
+    """
+
+    with open_data(ffrom, use_mmap) as from_data:
+        if isinstance(from_data, mmap.mmap):
+            yield from_data, open_suffix_array_mmap
+        else:
+            yield from_data, open_suffix_array_heap
+
+
+def create_chunks(ffrom,
+                  fto,
+                  suffix_array_algorithm,
+                  suffix_array_threads,
+                  suffix_array_cache,
+                  use_mmap,
+                  min_match,
+                  skip_ahead_size):
+    """Yields the chunks of a sequential patch as they are created by the
+    bsdiff algorithm, one per control. The chunks are compressed in
+    another thread while the next chunks are created.
+
+    """
+
+    with open_from_data(ffrom, use_mmap) as (from_data, open_suffix_array):
+        with open_data(fto, use_mmap) as to_data:
+            with open_suffix_array(from_data,
+                                   suffix_array_algorithm,
+                                   suffix_array_threads,
+                                   suffix_array_cache) as suffix_array:
+                chunks = bsdiff.create_patch_iter(suffix_array,
+                                                  from_data,
+                                                  to_data,
+                                                  min_match,
+                                                  skip_ahead_size)
+
+                # The iterator holds buffers of the data, which must be
+                # released before any mmap is closed, also if the
+                # generator is closed early.
+                try:
+                    yield from chunks
+                finally:
+                    del chunks
 
 
 def create_patch_sequential_data(ffrom,
@@ -165,11 +388,17 @@ def create_patch_sequential_data(ffrom,
                                  fpatch,
                                  compression,
                                  suffix_array_algorithm,
+                                 suffix_array_threads,
+                                 suffix_array_cache,
                                  data_format,
                                  data_segment,
                                  use_mmap,
                                  heatshrink_window_sz2,
-                                 heatshrink_lookahead_sz2):
+                                 heatshrink_lookahead_sz2,
+                                 compression_level,
+                                 compression_threads,
+                                 min_match,
+                                 skip_ahead_size):
     to_size = file_size(fto)
 
     if to_size == 0:
@@ -177,33 +406,201 @@ def create_patch_sequential_data(ffrom,
 
     compressor = create_compressor(compression,
                                    heatshrink_window_sz2,
-                                   heatshrink_lookahead_sz2)
+                                   heatshrink_lookahead_sz2,
+                                   compression_level,
+                                   compression_threads)
 
     if data_format is None:
         dfpatch = pack_size(0)
     else:
-        ffrom, fto, patch = data_format_encode(
-            ffrom,
-            fto,
-            data_format,
-            data_segment)
+        with stage('data-format'):
+            ffrom, fto, patch = data_format_encode(
+                ffrom,
+                fto,
+                data_format,
+                data_segment)
 
         dfpatch = pack_size(len(patch))
         dfpatch += pack_size(DATA_FORMATS[data_format])
         dfpatch += patch
 
-    fpatch.write(compressor.compress(dfpatch))
-    chunks = create_chunks(ffrom, fto, suffix_array_algorithm, use_mmap)
+    write_compressed(fpatch, compressor, dfpatch)
+    chunks = create_chunks(ffrom,
+                           fto,
+                           suffix_array_algorithm,
+                           suffix_array_threads,
+                           suffix_array_cache,
+                           use_mmap,
+                           min_match,
+                           skip_ahead_size)
+    compress_chunks(fpatch, compressor, compression, chunks)
+
+
+class ChunksProducer(threading.Thread):
+    """Creates chunks in a separate thread and puts them in batches in a
+    bounded queue. The last item in the queue is None, or the raised
+    exception if chunk creation failed. Chunks are created in the
+    context of the creating thread, so their stages and number of
+    chunks, one per control, are recorded in the statistics of its
+    patch.
+
+    """
+
+    def __init__(self, chunks):
+        super().__init__()
+        self.batches = queue.Queue(COMPRESSION_QUEUE_SIZE)
+        self.elapsed_time = 0
+        self._chunks = chunks
+        self._stopped = threading.Event()
+        self._finished = False
+        self._context = copy_context()
+
+    def run(self):
+        try:
+            self._context.run(self.produce)
+        except BaseException as e:
+            self.batches.put(e)
+        else:
+            self.batches.put(None)
+
+    def produce(self):
+        batch = []
+        batch_size = 0
+        start_time = time.time()
+
+        with stage('bsdiff'):
+            for chunk in self._chunks:
+                batch.append(chunk)
+                batch_size += len(chunk)
+
+                if batch_size >= COMPRESSION_BATCH_SIZE:
+                    self.elapsed_time += time.time() - start_time
+                    add_chunks(len(batch))
+
+                    # Waiting for the compression is not part of any stage.
+                    with stage(None):
+                        self.batches.put(b''.join(batch))
+
+                    if self._stopped.is_set():
+                        close = getattr(self._chunks, 'close', None)
+
+                        if close is not None:
+                            close()
+
+                        return
+
+                    batch = []
+                    batch_size = 0
+                    start_time = time.time()
+
+        self.elapsed_time += time.time() - start_time
+
+        if batch:
+            add_chunks(len(batch))
+            self.batches.put(b''.join(batch))
+
+    def get(self):
+        """Returns the next batch of chunks, or None if all chunks have
+        been created. Raises the exception chunk creation failed with,
+        if any.
+
+        """
+
+        batch = self.batches.get()
+
+        if batch is None:
+            self._finished = True
+        elif isinstance(batch, BaseException):
+            self._finished = True
+
+            raise batch
+
+        return batch
+
+    def stop(self):
+        """Stop creating chunks and wait for the thread to finish.
+
+        """
+
+        self._stopped.set()
+
+        # Discard batches until the last item is removed from the
+        # queue, as the thread may be blocked putting a batch.
+        while not self._finished:
+            try:
+                self.get()
+            except BaseException:
+                pass
+
+        self.join()
+
+
+def write_compressed(fpatch, compressor, data):
+    """Compress given chunk of patch data and write it to given patch
+    file.
+
+    """
+
+    with stage('compress'):
+        data = compressor.compress(data)
+
+    with stage('write'):
+        fpatch.write(data)
+
+
+def write_flushed(fpatch, compressor):
+    with stage('compress'):
+        data = compressor.flush()
+
+    with stage('write'):
+        fpatch.write(data)
+
+
+def compress_chunks(fpatch, compressor, compression, chunks):
+    """Compress given chunks and write them to given patch file. The
+    chunks are created in a separate thread, so the bsdiff algorithm
+    and compression run in parallel. Both release the GIL, except for
+    the compressors implemented in Python.
+
+    """
+
     start_time = time.time()
+    compression_time = 0
+    producer = ChunksProducer(chunks)
+    producer.start()
+
+    try:
+        while True:
+            batch = producer.get()
 
-    for chunk in chunks:
-        fpatch.write(compressor.compress(chunk))
+            if batch is None:
+                break
 
-    fpatch.write(compressor.flush())
+            compression_start_time = time.time()
+            write_compressed(fpatch, compressor, batch)
+            compression_time += time.time() - compression_start_time
 
+        compression_start_time = time.time()
+        write_flushed(fpatch, compressor)
+        compression_time += time.time() - compression_start_time
+    finally:
+        producer.stop()
+
+    LOGGER.info('Bsdiff algorithm completed in %s.',
+                format_timespan(producer.elapsed_time))
     LOGGER.info('Compression (%s) completed in %s.',
                 compression,
+                format_timespan(compression_time))
+    LOGGER.info('Bsdiff algorithm and compression completed in %s.',
                 format_timespan(time.time() - start_time))
+    log_peak_memory_usage()
+
+
+def log_peak_memory_usage():
+    size = peak_memory_usage()
+
+    if size is not None:
+        LOGGER.info('Peak memory usage (RSS) is %s.', format_size(size))
 
 
 def create_patch_sequential(ffrom,
@@ -211,11 +608,17 @@ def create_patch_sequential(ffrom,
                             fpatch,
                             compression,
                             suffix_array_algorithm,
+                            suffix_array_threads,
+                            suffix_array_cache,
                             data_format,
                             data_segment,
                             use_mmap,
                             heatshrink_window_sz2,
-                            heatshrink_lookahead_sz2):
+                            heatshrink_lookahead_sz2,
+                            compression_level,
+                            compression_threads,
+                            min_match,
+                            skip_ahead_size):
     fpatch.write(pack_header(PATCH_TYPE_SEQUENTIAL,
                              compression_string_to_number(compression)))
     fpatch.write(pack_size(file_size(fto)))
@@ -224,11 +627,58 @@ def create_patch_sequential(ffrom,
                                  fpatch,
                                  compression,
                                  suffix_array_algorithm,
+                                 suffix_array_threads,
+                                 suffix_array_cache,
                                  data_format,
                                  data_segment,
                                  use_mmap,
                                  heatshrink_window_sz2,
-                                 heatshrink_lookahead_sz2)
+                                 heatshrink_lookahead_sz2,
+                                 compression_level,
+                                 compression_threads,
+                                 min_match,
+                                 skip_ahead_size)
+
+
+def create_patch_sequential_suffix_array(suffix_array,
+                                        from_data,
+                                        fto,
+                                        fpatch,
+                                        compression,
+                                        heatshrink_window_sz2,
+                                        heatshrink_lookahead_sz2,
+                                        compression_level,
+                                        compression_threads,
+                                        min_match,
+                                        skip_ahead_size):
+    """Create a sequential patch using given suffix array of the from
+    data.
+
+    """
+
+    with stage('read'):
+        to_data = file_read(fto)
+
+    to_size = len(to_data)
+    fpatch.write(pack_header(PATCH_TYPE_SEQUENTIAL,
+                             compression_string_to_number(compression)))
+    fpatch.write(pack_size(to_size))
+
+    if to_size == 0:
+        return
+
+    compressor = create_compressor(compression,
+                                   heatshrink_window_sz2,
+                                   heatshrink_lookahead_sz2,
+                                   compression_level,
+                                   compression_threads)
+    write_compressed(fpatch, compressor, pack_size(0))
+    chunks = bsdiff.create_patch_iter(suffix_array,
+                                      from_data,
+                                      to_data,
+                                      min_match,
+                                      skip_ahead_size)
+    compress_chunks(fpatch, compressor, compression, chunks)
 
 
 def calc_shift(memory_size, segment_size, minimum_shift_size, from_size):
@@ -248,11 +698,122 @@ def calc_shift(memory_size, segment_size, minimum_shift_size, from_size):
     return shift_size
 
 
+def create_patch_in_place_segment(from_data,
+                                  to_data,
+                                  segment_size,
+                                  suffix_array_algorithm,
+                                  suffix_array_threads,
+                                  data_format,
+                                  data_segment,
+                                  use_mmap,
+                                  heatshrink_window_sz2,
+                                  heatshrink_lookahead_sz2,
+                                  min_match,
+                                  skip_ahead_size,
+                                  from_offset,
+                                  to_offset):
+    """Returns an uncompressed sequential patch of given segment, creating
+    a suffix array of its from data. The segments are compressed
+    together later, so no compression level or threads are given. The
+    suffix array cache is not used, as the from data of a segment is
+    unlikely to be seen again.
+
+    """
+
+    fsegment = BytesIO()
+    create_patch_sequential_data(
+        BytesIO(from_data[from_offset:]),
+        BytesIO(to_data[to_offset:to_offset + segment_size]),
+        fsegment,
+        'none',
+        suffix_array_algorithm,
+        suffix_array_threads,
+        None,
+        data_format,
+        data_segment,
+        use_mmap,
+        heatshrink_window_sz2,
+        heatshrink_lookahead_sz2,
+        None,
+        None,
+        min_match,
+        skip_ahead_size)
+
+    return fsegment.getvalue()
+
+
+def create_patch_in_place_segment_suffix_array(suffix_array,
+                                               from_data,
+                                               to_data,
+                                               segment_size,
+                                               min_match,
+                                               skip_ahead_size,
+                                               from_offset,
+                                               to_offset):
+    """Returns an uncompressed sequential patch of given segment. The
+    suffix array of its from data is created from given suffix array
+    of all from data, which is a lot faster than sorting it again. The
+    patch is identical to the one created by
+    create_patch_in_place_segment() without a data format.
+
+    """
+
+    to_data = to_data[to_offset:to_offset + segment_size]
+    segment_suffix_array = bytearray(
+        suffix_array_size(len(from_data) - from_offset))
+
+    with stage('suffix-sort'):
+        offset_suffix_array(suffix_array, from_offset, segment_suffix_array)
+
+    with stage('bsdiff'):
+        chunks = bsdiff.create_patch(segment_suffix_array,
+                                     memoryview(from_data)[from_offset:],
+                                     to_data,
+                                     bytearray(len(to_data) + 1),
+                                     min_match,
+                                     skip_ahead_size)
+
+    add_chunks(len(chunks) // 5)
+
+    return pack_size(0) + b''.join(chunks)
+
+
+def create_patch_in_place_segments(create_segment,
+                                   from_size,
+                                   to_size,
+                                   segment_size,
+                                   shift_size,
+                                   jobs):
+    """Create a sequential patch for each segment by calling
+    `create_segment` with its from and to offsets. The segments are
+    independent of each other, and the suffix array algorithms and
+    the bsdiff algorithm release the GIL, so threads are enough to
+    create them in parallel.
+
+    """
+
+    with ThreadPoolExecutor(jobs) as executor:
+        futures = []
+
+        for segment in range(div_ceil(to_size, segment_size)):
+            to_offset = (segment * segment_size)
+            from_offset = max(to_offset + segment_size - shift_size, 0)
+            from_offset = min(from_offset, from_size)
+            futures.append(executor.submit(copy_context().run,
+                                           create_segment,
+                                           from_offset,
+                                           to_offset))
+
+        return [future.result() for future in futures]
+
+
 def create_patch_in_place(ffrom,
                           fto,
                           fpatch,
                           compression,
                           suffix_array_algorithm,
+                          suffix_array_threads,
+                          suffix_array_cache,
                           memory_size,
                           segment_size,
                           minimum_shift_size,
@@ -260,7 +821,12 @@ def create_patch_in_place(ffrom,
                           data_segment,
                           use_mmap,
                           heatshrink_window_sz2,
-                          heatshrink_lookahead_sz2):
+                          heatshrink_lookahead_sz2,
+                          compression_level,
+                          compression_threads,
+                          min_match,
+                          skip_ahead_size,
+                          jobs):
     if (memory_size % segment_size) != 0:
         raise Error(
             'Memory size {} is not a multiple of segment size {}.'.format(
@@ -276,9 +842,14 @@ def create_patch_in_place(ffrom,
                 minimum_shift_size,
                 segment_size))
 
-    from_data = ffrom.read()
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+
+    with stage('read'):
+        from_data = ffrom.read()
+        to_data = fto.read()
+
     from_size = len(from_data)
-    to_data = fto.read()
     to_size = len(to_data)
     shift_size = calc_shift(memory_size,
                             segment_size,
@@ -286,27 +857,52 @@ def create_patch_in_place(ffrom,
                             len(from_data))
     shifted_size = (memory_size - shift_size)
     from_data = from_data[:shifted_size]
-    number_of_to_segments = div_ceil(to_size, segment_size)
-
-    # Create a sequential patch for each segment.
-    fsegments = BytesIO()
-
-    for segment in range(number_of_to_segments):
-        to_offset = (segment * segment_size)
-        from_offset = max(to_offset + segment_size - shift_size, 0)
-        fsegment = BytesIO()
-        create_patch_sequential_data(
-            BytesIO(from_data[from_offset:]),
-            BytesIO(to_data[to_offset:to_offset + segment_size]),
-            fsegment,
-            'none',
-            suffix_array_algorithm,
-            data_format,
-            data_segment,
-            use_mmap,
-            heatshrink_window_sz2,
-            heatshrink_lookahead_sz2)
-        fsegments.write(fsegment.getvalue())
+
+    if data_format is None:
+        if use_mmap:
+            open_suffix_array = open_suffix_array_mmap
+        else:
+            open_suffix_array = open_suffix_array_heap
+
+        # Sort the from data once. The suffix array of each segment's
+        # from data is created from it.
+        with open_suffix_array(from_data,
+                               suffix_array_algorithm,
+                               suffix_array_threads,
+                               suffix_array_cache) as suffix_array:
+            segments = create_patch_in_place_segments(
+                partial(create_patch_in_place_segment_suffix_array,
+                        suffix_array,
+                        from_data,
+                        to_data,
+                        segment_size,
+                        min_match,
+                        skip_ahead_size),
+                len(from_data),
+                to_size,
+                segment_size,
+                shift_size,
+                jobs)
+    else:
+        segments = create_patch_in_place_segments(
+            partial(create_patch_in_place_segment,
+                    from_data,
+                    to_data,
+                    segment_size,
+                    suffix_array_algorithm,
+                    suffix_array_threads,
+                    data_format,
+                    data_segment,
+                    use_mmap,
+                    heatshrink_window_sz2,
+                    heatshrink_lookahead_sz2,
+                    min_match,
+                    skip_ahead_size),
+            len(from_data),
+            to_size,
+            segment_size,
+            shift_size,
+            jobs)
 
     # Create the patch.
     fpatch.write(pack_header(PATCH_TYPE_IN_PLACE,
@@ -322,9 +918,11 @@ def create_patch_in_place(ffrom,
 
     compressor = create_compressor(compression,
                                    heatshrink_window_sz2,
-                                   heatshrink_lookahead_sz2)
-    fpatch.write(compressor.compress(fsegments.getvalue()))
-    fpatch.write(compressor.flush())
+                                   heatshrink_lookahead_sz2,
+                                   compression_level,
+                                   compression_threads)
+    write_compressed(fpatch, compressor, b''.join(segments))
+    write_flushed(fpatch, compressor)
 
 
 def offtout(x):
@@ -335,16 +933,24 @@ def offtout(x):
     return struct.pack('<Q', x)
 
 
-def create_patch_bsdiff(ffrom, fto, fpatch):
+def create_patch_bsdiff(ffrom, fto, fpatch, min_match, skip_ahead_size):
     to_size = file_size(fto)
-    from_data = file_read(ffrom)
+
+    with stage('read'):
+        from_data = file_read(ffrom)
+        to_data = file_read(fto)
+
     start_time = time.time()
-    suffix_array = bytearray(4 * (len(from_data) + 1))
-    divsufsort(from_data, suffix_array)
-    chunks = bsdiff.create_patch(suffix_array,
-                                 from_data,
-                                 file_read(fto),
-                                 bytearray(file_size(fto) + 1))
+    suffix_array = bytearray(suffix_array_size(len(from_data)))
+    create_suffix_array(suffix_array, from_data, 'divsufsort', None)
+
+    with stage('bsdiff'):
+        chunks = bsdiff.create_patch(suffix_array,
+                                     from_data,
+                                     to_data,
+                                     bytearray(to_size + 1),
+                                     min_match,
+                                     skip_ahead_size)
 
     LOGGER.info('Bsdiff algorithm completed in %s.',
                 format_timespan(time.time() - start_time))
@@ -359,31 +965,35 @@ def create_patch_bsdiff(ffrom, fto, fpatch):
     diff_compressor = BZ2Compressor()
     extra_compressor = BZ2Compressor()
 
-    for i in range(0, len(chunks), 5):
-        size = offtout(unpack_size_bytes(chunks[i + 0]))
-        fctrl.write(ctrl_compressor.compress(size))
-        fdiff.write(diff_compressor.compress(chunks[i + 1]))
-        size = offtout(unpack_size_bytes(chunks[i + 2]))
-        fctrl.write(ctrl_compressor.compress(size))
-        fextra.write(extra_compressor.compress(chunks[i + 3]))
-        size = offtout(unpack_size_bytes(chunks[i + 4]))
-        fctrl.write(ctrl_compressor.compress(size))
-
-    fctrl.write(ctrl_compressor.flush())
-    fdiff.write(diff_compressor.flush())
-    fextra.write(extra_compressor.flush())
+    with stage('compress'):
+        for i in range(0, len(chunks), 5):
+            size = offtout(unpack_size_bytes(chunks[i + 0]))
+            fctrl.write(ctrl_compressor.compress(size))
+            fdiff.write(diff_compressor.compress(chunks[i + 1]))
+            size = offtout(unpack_size_bytes(chunks[i + 2]))
+            fctrl.write(ctrl_compressor.compress(size))
+            fextra.write(extra_compressor.compress(chunks[i + 3]))
+            size = offtout(unpack_size_bytes(chunks[i + 4]))
+            fctrl.write(ctrl_compressor.compress(size))
+
+        fctrl.write(ctrl_compressor.flush())
+        fdiff.write(diff_compressor.flush())
+        fextra.write(extra_compressor.flush())
+
+    add_chunks(len(chunks) // 5)
 
     LOGGER.info('Compression completed in %s.',
                 format_timespan(time.time() - start_time))
 
     # Write everything to the patch file.
-    fpatch.write(b'BSDIFF40')
-    fpatch.write(offtout(fctrl.tell()))
-    fpatch.write(offtout(fdiff.tell()))
-    fpatch.write(offtout(to_size))
-    fpatch.write(fctrl.getvalue())
-    fpatch.write(fdiff.getvalue())
-    fpatch.write(fextra.getvalue())
+    with stage('write'):
+        fpatch.write(b'BSDIFF40')
+        fpatch.write(offtout(fctrl.tell()))
+        fpatch.write(offtout(fdiff.tell()))
+        fpatch.write(offtout(to_size))
+        fpatch.write(fctrl.getvalue())
+        fpatch.write(fdiff.getvalue())
+        fpatch.write(fextra.getvalue())
 
 
 def create_patch_hdiffpatch_generic(ffrom,
@@ -395,17 +1005,23 @@ def create_patch_hdiffpatch_generic(ffrom,
     if use_mmap:
         with mmap_read_only(ffrom) as from_mmap:
             with mmap_read_only(fto) as to_mmap:
-                return hdiffpatch.create_patch(from_mmap,
-                                               to_mmap,
-                                               match_score,
-                                               match_block_size,
-                                               patch_type)
+                with stage('hdiffpatch'):
+                    return hdiffpatch.create_patch(from_mmap,
+                                                   to_mmap,
+                                                   match_score,
+                                                   match_block_size,
+                                                   patch_type)
     else:
-        return hdiffpatch.create_patch(file_read(ffrom),
-                                       file_read(fto),
-                                       match_score,
-                                       match_block_size,
-                                       patch_type)
+        with stage('read'):
+            from_data = file_read(ffrom)
+            to_data = file_read(fto)
+
+        with stage('hdiffpatch'):
+            return hdiffpatch.create_patch(from_data,
+                                           to_data,
+                                           match_score,
+                                           match_block_size,
+                                           patch_type)
 
 
 def create_patch_hdiffpatch(ffrom,
@@ -415,7 +1031,9 @@ def create_patch_hdiffpatch(ffrom,
                             match_score,
                             use_mmap,
                             heatshrink_window_sz2,
-                            heatshrink_lookahead_sz2):
+                            heatshrink_lookahead_sz2,
+                            compression_level,
+                            compression_threads):
     start_time = time.time()
     patch = create_patch_hdiffpatch_generic(ffrom,
                                             fto,
@@ -430,14 +1048,16 @@ def create_patch_hdiffpatch(ffrom,
     start_time = time.time()
     compressor = create_compressor(compression,
                                    heatshrink_window_sz2,
-                                   heatshrink_lookahead_sz2)
+                                   heatshrink_lookahead_sz2,
+                                   compression_level,
+                                   compression_threads)
 
     fpatch.write(pack_header(PATCH_TYPE_HDIFFPATCH,
                              compression_string_to_number(compression)))
     fpatch.write(pack_size(file_size(fto)))
     fpatch.write(pack_size(len(patch)))
-    fpatch.write(compressor.compress(patch))
-    fpatch.write(compressor.flush())
+    write_compressed(fpatch, compressor, patch)
+    write_flushed(fpatch, compressor)
 
     LOGGER.info('Compression completed in %s.',
                 format_timespan(time.time() - start_time))
@@ -451,7 +1071,9 @@ def create_patch_match_blocks(ffrom,
                               match_block_size,
                               use_mmap,
                               heatshrink_window_sz2,
-                              heatshrink_lookahead_sz2):
+                              heatshrink_lookahead_sz2,
+                              compression_level,
+                              compression_threads):
     start_time = time.time()
     patch = create_patch_hdiffpatch_generic(ffrom,
                                             fto,
@@ -466,7 +1088,9 @@ def create_patch_match_blocks(ffrom,
     start_time = time.time()
     compressor = create_compressor(compression,
                                    heatshrink_window_sz2,
-                                   heatshrink_lookahead_sz2)
+                                   heatshrink_lookahead_sz2,
+                                   compression_level,
+                                   compression_threads)
 
     if patch_type == 'hdiffpatch':
         fpatch.write(pack_header(PATCH_TYPE_HDIFFPATCH,
@@ -477,17 +1101,516 @@ def create_patch_match_blocks(ffrom,
         fpatch.write(pack_header(PATCH_TYPE_SEQUENTIAL,
                                  compression_string_to_number(compression)))
         fpatch.write(pack_size(file_size(fto)))
-        fpatch.write(compressor.compress(pack_size(0)))
+        write_compressed(fpatch, compressor, pack_size(0))
     else:
         raise Error('Bad patch type {}.'.format(patch_type))
 
-    fpatch.write(compressor.compress(patch))
-    fpatch.write(compressor.flush())
+    write_compressed(fpatch, compressor, patch)
+    write_flushed(fpatch, compressor)
 
     LOGGER.info('Compression completed in %s.',
                 format_timespan(time.time() - start_time))
 
 
+def content_defined_chunks(data):
+    """Yields offset and size of all content defined chunks of given
+    data.
+
+    """
+
+    offset = 0
+
+    for end in bsdiff.content_defined_chunks(data,
+                                             CDC_AVERAGE_SIZE_BITS,
+                                             CDC_MINIMUM_SIZE,
+                                             CDC_MAXIMUM_SIZE):
+        yield offset, end - offset
+        offset = end
+
+
+def chunk_digest(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def create_chunks_index(data):
+    """Returns a dictionary of digests of the content defined chunks of
+    given data to their offsets.
+
+    """
+
+    offsets = {}
+
+    with memoryview(data) as view:
+        for offset, size in content_defined_chunks(data):
+            offsets.setdefault(chunk_digest(view[offset:offset + size]),
+                               offset)
+
+    return offsets
+
+
+def find_cdc_matches(from_data, to_data):
+    """Returns a list of to offset, from offset and size of to chunks
+    that are also found in the from data, in to offset order. Adjacent
+    matches that are adjacent in the from data as well are merged.
+
+    """
+
+    matches = []
+    from_offsets = create_chunks_index(from_data)
+
+    with memoryview(from_data) as from_view:
+        with memoryview(to_data) as to_view:
+            for to_offset, size in content_defined_chunks(to_data):
+                to_chunk = to_view[to_offset:to_offset + size]
+                from_offset = from_offsets.get(chunk_digest(to_chunk))
+
+                if from_offset is None:
+                    continue
+
+                if from_view[from_offset:from_offset + size] != to_chunk:
+                    continue
+
+                if matches:
+                    last_to_offset, last_from_offset, last_size = matches[-1]
+
+                    if ((last_to_offset + last_size == to_offset)
+                        and (last_from_offset + last_size == from_offset)):
+                        matches[-1] = (last_to_offset,
+                                       last_from_offset,
+                                       last_size + size)
+
+                        continue
+
+                matches.append((to_offset, from_offset, size))
+
+            return extend_cdc_matches(from_view, to_view, matches)
+
+
+def common_prefix_size(a, b):
+    """Returns the number of equal bytes at the beginning of given
+    memoryviews. Prefixes of doubling sizes are compared, followed by
+    a binary search, so short prefixes of big views are found quickly.
+
+    """
+
+    maximum_size = min(len(a), len(b))
+    low = 0
+    high = 64
+
+    while high < maximum_size and a[:high] == b[:high]:
+        low = high
+        high *= 2
+
+    high = min(high, maximum_size)
+
+    while low < high:
+        middle = (low + high + 1) // 2
+
+        if a[low:middle] == b[low:middle]:
+            low = middle
+        else:
+            high = middle - 1
+
+    return low
+
+
+def common_suffix_size(a, b):
+    """Returns the number of equal bytes at the end of given memoryviews.
+
+    """
+
+    maximum_size = min(len(a), len(b))
+
+    return common_prefix_size(a[::-1][:maximum_size],
+                              b[::-1][:maximum_size])
+
+
+def extend_cdc_matches(from_view, to_view, matches):
+    """Extend given matches backwards and forwards as long as the from and
+    to data are equal, which is often the case into chunks that were
+    not found because of a small difference.
+
+    """
+
+    extended_matches = []
+    to_offset = 0
+
+    for i, (match_to_offset, match_from_offset, size) in enumerate(matches):
+        if i + 1 < len(matches):
+            next_to_offset = matches[i + 1][0]
+        else:
+            next_to_offset = len(to_view)
+
+        backward_size = common_suffix_size(
+            from_view[:match_from_offset],
+            to_view[to_offset:match_to_offset])
+        match_to_offset -= backward_size
+        match_from_offset -= backward_size
+        size += backward_size
+        size += common_prefix_size(
+            from_view[match_from_offset + size:],
+            to_view[match_to_offset + size:next_to_offset])
+        extended_matches.append((match_to_offset, match_from_offset, size))
+        to_offset = match_to_offset + size
+
+    return extended_matches
+
+
+def create_bsdiff_controls(from_data,
+                           to_data,
+                           from_offset,
+                           suffix_array_algorithm,
+                           suffix_array_threads,
+                           min_match,
+                           skip_ahead_size):
+    """Yields from offset, diff data and extra data of the bsdiff controls
+    from given from data, found at `from_offset` in all from data, to
+    given to data.
+
+    """
+
+    suffix_array = bytearray(suffix_array_size(len(from_data)))
+    create_suffix_array(suffix_array,
+                        from_data,
+                        suffix_array_algorithm,
+                        suffix_array_threads)
+    chunks = bsdiff.create_patch(suffix_array,
+                                 from_data,
+                                 to_data,
+                                 bytearray(len(to_data) + 1),
+                                 min_match,
+                                 skip_ahead_size)
+
+    for i in range(0, len(chunks), 5):
+        yield from_offset, chunks[i + 1], chunks[i + 3]
+        from_offset += len(chunks[i + 1]) + unpack_size_bytes(chunks[i + 4])
+
+
+def create_cdc_bsdiff_controls(from_data,
+                               to_data,
+                               suffix_array_algorithm,
+                               suffix_array_threads,
+                               min_match,
+                               skip_ahead_size):
+    """Yields from offset, diff data and extra data of all controls. Chunks
+    found in the from data are copied, and the to data between them is
+    diffed by the bsdiff algorithm against the from data between the
+    surrounding matches. If the matches are not in order, or far
+    apart, it is diffed against as much from data after the previous
+    match instead.
+
+    """
+
+    from_size = len(from_data)
+    to_size = len(to_data)
+    from_offset = 0
+    to_offset = 0
+    matches = find_cdc_matches(from_data, to_data)
+    matches.append((to_size, from_size, 0))
+
+    for match_to_offset, match_from_offset, size in matches:
+        if match_to_offset > to_offset:
+            gap_size = match_to_offset - to_offset
+            from_end = match_from_offset
+
+            if not from_offset <= from_end <= from_offset + 2 * gap_size:
+                from_end = min(from_offset + gap_size, from_size)
+
+            yield from create_bsdiff_controls(
+                from_data[from_offset:from_end],
+                to_data[to_offset:match_to_offset],
+                from_offset,
+                suffix_array_algorithm,
+                suffix_array_threads,
+                min_match,
+                skip_ahead_size)
+
+        if size > 0:
+            yield match_from_offset, bytes(size), b''
+
+        from_offset = match_from_offset + size
+        to_offset = match_to_offset + size
+
+
+def create_controls_chunks(controls):
+    """Yields the chunks of a sequential patch of given controls, one
+    per control. The adjustment of each control moves the from offset
+    to the next control.
+
+    """
+
+    previous_from_offset = 0
+    previous_diff = b''
+    previous_extra = b''
+
+    for from_offset, diff, extra in controls:
+        adjustment = from_offset - (previous_from_offset + len(previous_diff))
+
+        if previous_diff or previous_extra or adjustment != 0:
+            yield b''.join([pack_size(len(previous_diff)),
+                            previous_diff,
+                            pack_size(len(previous_extra)),
+                            previous_extra,
+                            pack_size(adjustment)])
+
+        previous_from_offset = from_offset
+        previous_diff = diff
+        previous_extra = extra
+
+    if previous_diff or previous_extra:
+        yield b''.join([pack_size(len(previous_diff)),
+                        previous_diff,
+                        pack_size(len(previous_extra)),
+                        previous_extra,
+                        pack_size(0)])
+
+
+def create_patch_cdc_bsdiff(ffrom,
+                            fto,
+                            fpatch,
+                            compression,
+                            suffix_array_algorithm,
+                            suffix_array_threads,
+                            data_format,
+                            use_mmap,
+                            heatshrink_window_sz2,
+                            heatshrink_lookahead_sz2,
+                            compression_level,
+                            compression_threads,
+                            min_match,
+                            skip_ahead_size):
+    """Create a sequential patch, only sorting the from data between
+    content defined chunks found in both the from and to data.
+
+    """
+
+    if data_format is not None:
+        raise Error(
+            'Data formats are not supported by the cdc-bsdiff algorithm.')
+
+    to_size = file_size(fto)
+    fpatch.write(pack_header(PATCH_TYPE_SEQUENTIAL,
+                             compression_string_to_number(compression)))
+    fpatch.write(pack_size(to_size))
+
+    if to_size == 0:
+        return
+
+    compressor = create_compressor(compression,
+                                   heatshrink_window_sz2,
+                                   heatshrink_lookahead_sz2,
+                                   compression_level,
+                                   compression_threads)
+    write_compressed(fpatch, compressor, pack_size(0))
+
+    with open_data(ffrom, use_mmap) as from_data:
+        with open_data(fto, use_mmap) as to_data:
+            controls = create_cdc_bsdiff_controls(from_data,
+                                                  to_data,
+                                                  suffix_array_algorithm,
+                                                  suffix_array_threads,
+                                                  min_match,
+                                                  skip_ahead_size)
+            compress_chunks(fpatch,
+                            compressor,
+                            compression,
+                            create_controls_chunks(controls))
+
+
+def find_window_from_offset(from_offsets,
+                            to_window,
+                            from_size,
+                            from_window_size):
+    """Returns the offset of the from window of given size that contains
+    the most content defined chunks of given to window. The chunks are
+    centered in the from window. Returns None if no chunk is found.
+
+    """
+
+    matches = []
+
+    with memoryview(to_window) as to_view:
+        for offset, size in content_defined_chunks(to_window):
+            from_offset = from_offsets.get(
+                chunk_digest(to_view[offset:offset + size]))
+
+            if from_offset is not None:
+                matches.append((from_offset, size))
+
+    if not matches:
+        return None
+
+    matches.sort()
+    best_size = 0
+    best_begin = 0
+    best_end = 0
+    size = 0
+    begin = 0
+
+    for end, (from_offset, match_size) in enumerate(matches):
+        size += match_size
+
+        while from_offset + match_size > matches[begin][0] + from_window_size:
+            size -= matches[begin][1]
+            begin += 1
+
+        if size > best_size:
+            best_size = size
+            best_begin = matches[begin][0]
+            best_end = from_offset + match_size
+
+    from_offset = best_begin - (from_window_size - best_end + best_begin) // 2
+
+    return max(min(from_offset, from_size - from_window_size), 0)
+
+
+def create_windowed_controls(from_data,
+                             to_data,
+                             to_window_size,
+                             from_window_size,
+                             suffix_array_algorithm,
+                             suffix_array_threads,
+                             min_match,
+                             skip_ahead_size):
+    """Yields from offset, diff data and extra data of all controls,
+    created by the bsdiff algorithm one to window at a time. Each to
+    window is diffed against the from window with the most of its
+    content defined chunks, or the from window at the same offset if
+    none is found.
+
+    """
+
+    from_size = len(from_data)
+    from_offsets = create_chunks_index(from_data)
+
+    for to_offset in range(0, len(to_data), to_window_size):
+        to_window = to_data[to_offset:to_offset + to_window_size]
+        from_offset = find_window_from_offset(from_offsets,
+                                              to_window,
+                                              from_size,
+                                              from_window_size)
+
+        if from_offset is None:
+            from_offset = max(min(to_offset, from_size - from_window_size), 0)
+
+        LOGGER.debug('Diffing to data at offset %d against from data at '
+                     'offset %d.',
+                     to_offset,
+                     from_offset)
+
+        yield from create_bsdiff_controls(
+            from_data[from_offset:from_offset + from_window_size],
+            to_window,
+            from_offset,
+            suffix_array_algorithm,
+            suffix_array_threads,
+            min_match,
+            skip_ahead_size)
+
+
+def calc_to_window_size(from_data, to_data, max_memory):
+    """Returns the to window size of a windowed patch. The content defined
+    chunks index of the from data and the from and to data, unless
+    memory mapped, are not part of any window, and are subtracted from
+    `max_memory` first.
+
+    """
+
+    used_memory = ((len(from_data) >> CDC_AVERAGE_SIZE_BITS)
+                   * CDC_INDEX_ENTRY_SIZE)
+
+    for data in [from_data, to_data]:
+        if not isinstance(data, mmap.mmap):
+            used_memory += len(data)
+
+    if max_memory - used_memory < MAX_MEMORY_MIN:
+        raise Error(
+            'Expected max memory of at least {} bytes, but got {}. The '
+            'chunks index and the from and to data not memory mapped '
+            'use {} bytes.'.format(used_memory + MAX_MEMORY_MIN,
+                                   max_memory,
+                                   used_memory))
+
+    return (max_memory - used_memory) // MAX_MEMORY_TO_WINDOW_DIVISOR
+
+
+def is_windowed(ffrom, fto, max_memory):
+    """Returns True if a sequential patch from `ffrom` to `fto` must be
+    created in windows to fit in `max_memory` bytes.
+
+    """
+
+    if max_memory is None:
+        return False
+
+    return estimate_create_patch_memory(file_size(ffrom),
+                                        file_size(fto)) > max_memory
+
+
+def create_patch_sequential_windowed(ffrom,
+                                     fto,
+                                     fpatch,
+                                     compression,
+                                     suffix_array_algorithm,
+                                     suffix_array_threads,
+                                     data_format,
+                                     use_mmap,
+                                     heatshrink_window_sz2,
+                                     heatshrink_lookahead_sz2,
+                                     compression_level,
+                                     compression_threads,
+                                     min_match,
+                                     skip_ahead_size,
+                                     max_memory):
+    """Create a sequential patch using the bsdiff algorithm on windows of
+    the from and to data, so that the suffix array and buffers of a
+    window, the chunks index and the from and to data, unless memory
+    mapped, fit in `max_memory` bytes.
+
+    """
+
+    if max_memory < MAX_MEMORY_MIN:
+        raise Error(
+            'Expected max memory of at least {} bytes, but got {}.'.format(
+                MAX_MEMORY_MIN,
+                max_memory))
+
+    if data_format is not None:
+        raise Error('Data formats are not supported with max memory.')
+
+    with open_data(ffrom, use_mmap) as from_data:
+        with open_data(fto, use_mmap) as to_data:
+            to_window_size = calc_to_window_size(from_data,
+                                                 to_data,
+                                                 max_memory)
+            fpatch.write(
+                pack_header(PATCH_TYPE_SEQUENTIAL,
+                            compression_string_to_number(compression)))
+            fpatch.write(pack_size(len(to_data)))
+
+            if len(to_data) == 0:
+                return
+
+            compressor = create_compressor(compression,
+                                           heatshrink_window_sz2,
+                                           heatshrink_lookahead_sz2,
+                                           compression_level,
+                                           compression_threads)
+            write_compressed(fpatch, compressor, pack_size(0))
+            controls = create_windowed_controls(from_data,
+                                                to_data,
+                                                to_window_size,
+                                                2 * to_window_size,
+                                                suffix_array_algorithm,
+                                                suffix_array_threads,
+                                                min_match,
+                                                skip_ahead_size)
+            compress_chunks(fpatch,
+                            compressor,
+                            compression,
+                            create_controls_chunks(controls))
+
+
 def create_patch(ffrom,
                  fto,
                  fpatch,
@@ -515,7 +1638,17 @@ def create_patch(ffrom,
                  match_block_size=64,
                  use_mmap=True,
                  heatshrink_window_sz2=8,
-                 heatshrink_lookahead_sz2=7):
+                 heatshrink_lookahead_sz2=7,
+                 suffix_array_threads=None,
+                 suffix_array_cache_dir=None,
+                 suffix_array_cache_size=None,
+                 jobs=1,
+                 compression_level=None,
+                 compression_threads=1,
+                 min_match=8,
+                 skip_ahead_size=0,
+                 max_memory=None,
+                 stats=None):
     """Create a patch from `ffrom` to `fto` and write it to `fpatch`. All
     three arguments are file-like objects.
 
@@ -525,12 +1658,60 @@ def create_patch(ffrom,
     `patch_type` must be ``'sequential'``, ``'in-place'`` or
     ``'bsdiff'``.
 
-    `algorithm` must be ``'sequential'`` or ``'hdiffpatch'``.
-
-    `suffix_array_algorithm` must be ``'sais'`` or ``'divsufsort'``.
+    `algorithm` must be ``'bsdiff'``, ``'hdiffpatch'``,
+    ``'match-blocks'`` or ``'cdc-bsdiff'``. The latter creates a
+    sequential patch, copying content defined chunks of the to data
+    that are found in the from data, and only using the bsdiff
+    algorithm on the data between them. It is a lot faster than the
+    bsdiff algorithm for big files that mostly differ by moved
+    blocks, but may create bigger patches. Data formats are not
+    supported by it.
+
+    `suffix_array_algorithm` must be ``'sais'``, ``'divsufsort'`` or
+    ``'divsufsort-mt'``. The latter creates the same suffix array as
+    ``'divsufsort'``, but using `suffix_array_threads` threads,
+    defaulting to the number of CPUs.
+
+    Suffix arrays are stored in and loaded from the directory
+    `suffix_array_cache_dir`, if given. Creating many patches from the
+    same from data only creates its suffix array once. The least
+    recently used suffix arrays are removed from the cache when its
+    size exceeds `suffix_array_cache_size` bytes, if given.
 
     `memory_size`, `segment_size` and `minimum_shift_size` are used
-    when creating an in-place patch.
+    when creating an in-place patch. Up to `jobs` segments of an
+    in-place patch are created in parallel, or as many as there are
+    CPUs if ``None``.
+
+    `compression_level` is the lzma preset (0-9, default 6), the bz2
+    level (1-9, default 9), the zstd level (1-22, default 22) or the
+    lz4 level (0-16, default 16). Lower levels create bigger patches
+    faster. zstd compresses using `compression_threads` threads, or as
+    many as there are CPUs if ``None``. Other compressions ignore
+    `compression_threads`.
+
+    `min_match` and `skip_ahead_size` are used by the bsdiff
+    algorithm. A new control is created when a match is more than
+    `min_match` bytes longer than the match at the current
+    offset. Default 8. Matches of at least `skip_ahead_size` bytes at
+    the current offset are used without searching for longer matches,
+    which is faster when the from and to data are similar, but may
+    create bigger patches. Default 0, which disables skipping ahead.
+
+    `max_memory` limits the memory used by the bsdiff algorithm when
+    creating a sequential patch, in bytes. It is only supported by
+    sequential patches created by the bsdiff algorithm. If the suffix
+    array and buffers for the whole from and to data would not fit,
+    the to data is split into windows that are diffed one at a time
+    against the region of the from data with the most content
+    defined chunks in common with the window. The limit then covers
+    the suffix array and buffers of a window, the index of the
+    content defined chunks of the from data, and the from and to data
+    if not memory mapped. Memory mapped data is backed by the files
+    and not counted. Memory used by the compressor is not covered
+    either. Patches created this way may be bigger. Data formats are
+    not supported when windows are used. Default ``None``, which does
+    not limit memory.
 
     `match_score` is used by the hdiffpatch algorithm. Default
     6. Recommended 0-4 for binary files and 4-9 for text files.
@@ -539,10 +1720,18 @@ def create_patch(ffrom,
     64. Less memory is needed to create the patch, but the patch will
     be bigger.
 
+    Sizes, times, the peak memory usage of the process and chunk count
+    of the created patch, as well as wall and CPU time per stage, are
+    recorded in `stats`, if given. It must be a
+    :class:`~detools.PatchStats`.
+
     >>> ffrom = open('foo.old', 'rb')
     >>> fto = open('foo.new', 'rb')
     >>> fpatch = open('foo.patch', 'wb')
-    >>> create_patch(ffrom, fto, fpatch)
+    >>> stats = PatchStats()
+    >>> create_patch(ffrom, fto, fpatch, stats=stats)
+    >>> stats.to_size
+    2780
 
     """
 
@@ -559,57 +1748,125 @@ def create_patch(ffrom,
                                to_code_begin,
                                to_code_end)
 
-    if algorithm == 'bsdiff' and patch_type == 'sequential':
-        create_patch_sequential(ffrom,
-                                fto,
-                                fpatch,
-                                compression,
-                                suffix_array_algorithm,
-                                data_format,
-                                data_segment,
-                                use_mmap,
-                                heatshrink_window_sz2,
-                                heatshrink_lookahead_sz2)
-    elif algorithm == 'bsdiff' and patch_type == 'in-place':
-        create_patch_in_place(ffrom,
-                              fto,
-                              fpatch,
-                              compression,
-                              suffix_array_algorithm,
-                              memory_size,
-                              segment_size,
-                              minimum_shift_size,
-                              data_format,
-                              data_segment,
-                              use_mmap,
-                              heatshrink_window_sz2,
-                              heatshrink_lookahead_sz2)
-    elif algorithm == 'bsdiff' and patch_type == 'bsdiff':
-        create_patch_bsdiff(ffrom, fto, fpatch)
-    elif algorithm == 'hdiffpatch' and patch_type == 'hdiffpatch':
-        create_patch_hdiffpatch(ffrom,
-                                fto,
-                                fpatch,
-                                compression,
-                                match_score,
-                                use_mmap,
-                                heatshrink_window_sz2,
-                                heatshrink_lookahead_sz2)
-    elif algorithm == 'match-blocks':
-        create_patch_match_blocks(ffrom,
+    suffix_array_cache = create_suffix_array_cache(suffix_array_cache_dir,
+                                                   suffix_array_cache_size)
+
+    if stats is not None:
+        patch_offset = fpatch.tell()
+
+    if max_memory is not None:
+        if algorithm != 'bsdiff' or patch_type != 'sequential':
+            raise Error(
+                'Max memory is only supported by sequential patches created '
+                'by the bsdiff algorithm.')
+
+    with collect_stats(stats):
+        if (algorithm == 'bsdiff'
+            and patch_type == 'sequential'
+            and is_windowed(ffrom, fto, max_memory)):
+            create_patch_sequential_windowed(ffrom,
+                                             fto,
+                                             fpatch,
+                                             compression,
+                                             suffix_array_algorithm,
+                                             suffix_array_threads,
+                                             data_format,
+                                             use_mmap,
+                                             heatshrink_window_sz2,
+                                             heatshrink_lookahead_sz2,
+                                             compression_level,
+                                             compression_threads,
+                                             min_match,
+                                             skip_ahead_size,
+                                             max_memory)
+        elif algorithm == 'bsdiff' and patch_type == 'sequential':
+            create_patch_sequential(ffrom,
+                                    fto,
+                                    fpatch,
+                                    compression,
+                                    suffix_array_algorithm,
+                                    suffix_array_threads,
+                                    suffix_array_cache,
+                                    data_format,
+                                    data_segment,
+                                    use_mmap,
+                                    heatshrink_window_sz2,
+                                    heatshrink_lookahead_sz2,
+                                    compression_level,
+                                    compression_threads,
+                                    min_match,
+                                    skip_ahead_size)
+        elif algorithm == 'bsdiff' and patch_type == 'in-place':
+            create_patch_in_place(ffrom,
                                   fto,
                                   fpatch,
                                   compression,
-                                  patch_type,
-                                  match_block_size,
+                                  suffix_array_algorithm,
+                                  suffix_array_threads,
+                                  suffix_array_cache,
+                                  memory_size,
+                                  segment_size,
+                                  minimum_shift_size,
+                                  data_format,
+                                  data_segment,
                                   use_mmap,
                                   heatshrink_window_sz2,
-                                  heatshrink_lookahead_sz2)
-    else:
-        raise Error(
-            "Bad algorithm ({}) and patch type ({}) combination.".format(
-                algorithm,
-                patch_type))
+                                  heatshrink_lookahead_sz2,
+                                  compression_level,
+                                  compression_threads,
+                                  min_match,
+                                  skip_ahead_size,
+                                  jobs)
+        elif algorithm == 'cdc-bsdiff' and patch_type == 'sequential':
+            create_patch_cdc_bsdiff(ffrom,
+                                    fto,
+                                    fpatch,
+                                    compression,
+                                    suffix_array_algorithm,
+                                    suffix_array_threads,
+                                    data_format,
+                                    use_mmap,
+                                    heatshrink_window_sz2,
+                                    heatshrink_lookahead_sz2,
+                                    compression_level,
+                                    compression_threads,
+                                    min_match,
+                                    skip_ahead_size)
+        elif algorithm == 'bsdiff' and patch_type == 'bsdiff':
+            create_patch_bsdiff(ffrom, fto, fpatch, min_match, skip_ahead_size)
+        elif algorithm == 'hdiffpatch' and patch_type == 'hdiffpatch':
+            create_patch_hdiffpatch(ffrom,
+                                    fto,
+                                    fpatch,
+                                    compression,
+                                    match_score,
+                                    use_mmap,
+                                    heatshrink_window_sz2,
+                                    heatshrink_lookahead_sz2,
+                                    compression_level,
+                                    compression_threads)
+        elif algorithm == 'match-blocks':
+            create_patch_match_blocks(ffrom,
+                                      fto,
+                                      fpatch,
+                                      compression,
+                                      patch_type,
+                                      match_block_size,
+                                      use_mmap,
+                                      heatshrink_window_sz2,
+                                      heatshrink_lookahead_sz2,
+                                      compression_level,
+                                      compression_threads)
+        else:
+            raise Error(
+                "Bad algorithm ({}) and patch type ({}) combination.".format(
+                    algorithm,
+                    patch_type))
+
+    if stats is not None:
+        stats.from_size = file_size(ffrom)
+        stats.to_size = file_size(fto)
+        stats.patch_size = fpatch.tell() - patch_offset
 
 
 def create_patch_filenames(fromfile,
@@ -639,7 +1896,17 @@ def create_patch_filenames(fromfile,
                            match_block_size=64,
                            use_mmap=True,
                            heatshrink_window_sz2=8,
-                           heatshrink_lookahead_sz2=7):
+                           heatshrink_lookahead_sz2=7,
+                           suffix_array_threads=None,
+                           suffix_array_cache_dir=None,
+                           suffix_array_cache_size=None,
+                           jobs=1,
+                           compression_level=None,
+                           compression_threads=1,
+                           min_match=8,
+                           skip_ahead_size=0,
+                           max_memory=None,
+                           stats=None):
     """Same as :func:`~detools.create_patch()`, but with filenames instead
     of file-like objects.
 
@@ -677,4 +1944,475 @@ def create_patch_filenames(fromfile,
                              match_block_size,
                              use_mmap,
                              heatshrink_window_sz2,
-                             heatshrink_lookahead_sz2)
+                             heatshrink_lookahead_sz2,
+                             suffix_array_threads,
+                             suffix_array_cache_dir,
+                             suffix_array_cache_size,
+                             jobs,
+                             compression_level,
+                             compression_threads,
+                             min_match,
+                             skip_ahead_size,
+                             max_memory,
+                             stats)
+
+
+@contextmanager
+def given_patch_files(fto, fpatch):
+    yield fto, fpatch
+
+
+@contextmanager
+def open_patch_files(tofile, patchfile):
+    with open(tofile, 'rb') as fto:
+        with open(patchfile, 'wb') as fpatch:
+            yield fto, fpatch
+
+
+def create_patches_item(suffix_array,
+                        from_data,
+                        patch_files,
+                        compression,
+                        heatshrink_window_sz2,
+                        heatshrink_lookahead_sz2,
+                        compression_level,
+                        compression_threads,
+                        min_match,
+                        skip_ahead_size):
+    with patch_files() as (fto, fpatch):
+        create_patch_sequential_suffix_array(suffix_array,
+                                             from_data,
+                                             fto,
+                                             fpatch,
+                                             compression,
+                                             heatshrink_window_sz2,
+                                             heatshrink_lookahead_sz2,
+                                             compression_level,
+                                             compression_threads,
+                                             min_match,
+                                             skip_ahead_size)
+
+
+def create_patches_common(ffrom,
+                          patches_files,
+                          compression,
+                          suffix_array_algorithm,
+                          use_mmap,
+                          heatshrink_window_sz2,
+                          heatshrink_lookahead_sz2,
+                          compression_level,
+                          compression_threads,
+                          min_match,
+                          skip_ahead_size,
+                          suffix_array_threads,
+                          suffix_array_cache_dir,
+                          suffix_array_cache_size,
+                          jobs):
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+
+    suffix_array_cache = create_suffix_array_cache(suffix_array_cache_dir,
+                                                   suffix_array_cache_size)
+
+    with open_from_data(ffrom, use_mmap) as (from_data, open_suffix_array):
+        with open_suffix_array(from_data,
+                               suffix_array_algorithm,
+                               suffix_array_threads,
+                               suffix_array_cache) as suffix_array:
+            # The bsdiff algorithm and most compressors release the
+            # GIL, so threads are enough to create patches in parallel
+            # using the same suffix array.
+            with ThreadPoolExecutor(jobs) as executor:
+                futures = [
+                    executor.submit(create_patches_item,
+                                    suffix_array,
+                                    from_data,
+                                    patch_files,
+                                    compression,
+                                    heatshrink_window_sz2,
+                                    heatshrink_lookahead_sz2,
+                                    compression_level,
+                                    compression_threads,
+                                    min_match,
+                                    skip_ahead_size)
+                    for patch_files in patches_files
+                ]
+
+                for future in futures:
+                    future.result()
+
+
+@contextmanager
+def open_suffix_array_cache_dir(suffix_array_cache_dir):
+    """Yields given suffix array cache directory, or a temporary directory
+    if ``None``.
+
+    """
+
+    if suffix_array_cache_dir is not None:
+        yield suffix_array_cache_dir
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            yield directory
+
+
+def create_patches_processes(fromfile,
+                             tofiles,
+                             patchfiles,
+                             compression,
+                             suffix_array_algorithm,
+                             use_mmap,
+                             heatshrink_window_sz2,
+                             heatshrink_lookahead_sz2,
+                             compression_level,
+                             compression_threads,
+                             min_match,
+                             skip_ahead_size,
+                             suffix_array_threads,
+                             suffix_array_cache_dir,
+                             suffix_array_cache_size,
+                             jobs):
+    """Create the patches in a pool of `jobs` processes. The suffix array
+    is created once and added to a suffix array cache, temporary if no
+    directory is given, which the processes load it from using mmap,
+    so its memory is shared by all processes.
+
+    """
+
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+
+    with open_suffix_array_cache_dir(suffix_array_cache_dir) as directory:
+        suffix_array_cache = create_suffix_array_cache(directory,
+                                                       suffix_array_cache_size)
+
+        with open(fromfile, 'rb') as ffrom:
+            with open_from_data(ffrom, use_mmap) as (from_data, _):
+                with load_suffix_array(from_data,
+                                       suffix_array_algorithm,
+                                       suffix_array_threads,
+                                       suffix_array_cache):
+                    pass
+
+        with ProcessPoolExecutor(jobs) as executor:
+            futures = [
+                executor.submit(create_patches_filenames,
+                                fromfile,
+                                [tofile],
+                                [patchfile],
+                                compression,
+                                suffix_array_algorithm,
+                                use_mmap,
+                                heatshrink_window_sz2,
+                                heatshrink_lookahead_sz2,
+                                suffix_array_threads,
+                                directory,
+                                suffix_array_cache_size,
+                                1,
+                                compression_level,
+                                compression_threads,
+                                min_match,
+                                skip_ahead_size)
+                for tofile, patchfile in zip(tofiles, patchfiles)
+            ]
+
+            for future in futures:
+                future.result()
+
+
+def check_patches_count(tos, patches):
+    if len(tos) != len(patches):
+        raise Error(
+            'Got {} to files, but {} patch files.'.format(len(tos),
+                                                          len(patches)))
+
+
+def create_patches(ffrom,
+                   ftos,
+                   fpatches,
+                   compression='lzma',
+                   suffix_array_algorithm='divsufsort',
+                   use_mmap=True,
+                   heatshrink_window_sz2=8,
+                   heatshrink_lookahead_sz2=7,
+                   suffix_array_threads=None,
+                   suffix_array_cache_dir=None,
+                   suffix_array_cache_size=None,
+                   jobs=1,
+                   compression_level=None,
+                   compression_threads=1,
+                   min_match=8,
+                   skip_ahead_size=0):
+    """Create one sequential bsdiff patch from `ffrom` to each file in
+    `ftos` and write it to the file at the same index in
+    `fpatches`. All files are file-like objects.
+
+    The suffix array of the from data is only created once, which
+    makes this function a lot faster than calling
+    :func:`~detools.create_patch()` once per to file.
+
+    `jobs` is the number of patches created in parallel, or ``None``
+    for the number of CPUs.
+
+    See :func:`~detools.create_patch()` for a description of the other
+    arguments.
+
+    >>> ffrom = open('foo.old', 'rb')
+    >>> ftos = [open('foo.new', 'rb'), open('foo.newer', 'rb')]
+    >>> fpatches = [open('foo.patch', 'wb'), open('foo-newer.patch', 'wb')]
+    >>> create_patches(ffrom, ftos, fpatches)
+
+    """
+
+    check_patches_count(ftos, fpatches)
+    create_patches_common(ffrom,
+                          [
+                              partial(given_patch_files, fto, fpatch)
+                              for fto, fpatch in zip(ftos, fpatches)
+                          ],
+                          compression,
+                          suffix_array_algorithm,
+                          use_mmap,
+                          heatshrink_window_sz2,
+                          heatshrink_lookahead_sz2,
+                          compression_level,
+                          compression_threads,
+                          min_match,
+                          skip_ahead_size,
+                          suffix_array_threads,
+                          suffix_array_cache_dir,
+                          suffix_array_cache_size,
+                          jobs)
+
+
+def create_patches_filenames(fromfile,
+                             tofiles,
+                             patchfiles,
+                             compression='lzma',
+                             suffix_array_algorithm='divsufsort',
+                             use_mmap=True,
+                             heatshrink_window_sz2=8,
+                             heatshrink_lookahead_sz2=7,
+                             suffix_array_threads=None,
+                             suffix_array_cache_dir=None,
+                             suffix_array_cache_size=None,
+                             jobs=1,
+                             compression_level=None,
+                             compression_threads=1,
+                             min_match=8,
+                             skip_ahead_size=0,
+                             use_processes=False):
+    """Same as :func:`~detools.create_patches()`, but with filenames
+    instead of file-like objects. To and patch files are only opened
+    while their patch is created.
+
+    Patches are created in a process pool of `jobs` processes instead
+    of threads if `use_processes` is ``True``, which is faster if the
+    compressor does not release the GIL. The suffix array is then
+    shared with the processes through a suffix array cache, which is
+    temporary if `suffix_array_cache_dir` is not given.
+
+    >>> create_patches_filenames('foo.old',
+                                 ['foo.new', 'foo.newer'],
+                                 ['foo.patch', 'foo-newer.patch'])
+
+    """
+
+    check_patches_count(tofiles, patchfiles)
+
+    if use_processes:
+        create_patches_processes(fromfile,
+                                 tofiles,
+                                 patchfiles,
+                                 compression,
+                                 suffix_array_algorithm,
+                                 use_mmap,
+                                 heatshrink_window_sz2,
+                                 heatshrink_lookahead_sz2,
+                                 compression_level,
+                                 compression_threads,
+                                 min_match,
+                                 skip_ahead_size,
+                                 suffix_array_threads,
+                                 suffix_array_cache_dir,
+                                 suffix_array_cache_size,
+                                 jobs)
+
+        return
+
+    with open(fromfile, 'rb') as ffrom:
+        create_patches_common(ffrom,
+                              [
+                                  partial(open_patch_files, tofile, patchfile)
+                                  for tofile, patchfile in zip(tofiles,
+                                                               patchfiles)
+                              ],
+                              compression,
+                              suffix_array_algorithm,
+                              use_mmap,
+                              heatshrink_window_sz2,
+                              heatshrink_lookahead_sz2,
+                              compression_level,
+                              compression_threads,
+                              min_match,
+                              skip_ahead_size,
+                              suffix_array_threads,
+                              suffix_array_cache_dir,
+                              suffix_array_cache_size,
+                              jobs)
+
+
+def estimate_create_patch_memory(from_size, to_size):
+    """Returns the estimated peak memory usage in bytes when creating a
+    bsdiff patch. The suffix array dominates, followed by the from and
+    to data and the diff buffer.
+
+    """
+
+    return suffix_array_size(from_size) + from_size + 2 * to_size
+
+
+def execute_within_memory_limit(executor, calls, memory_limit):
+    """Execute given calls in given executor and return their results in
+    order. Each call is a tuple of estimated memory usage, function
+    and arguments. A call is not started until the estimated memory
+    usage of all running calls fits in `memory_limit`. A call that
+    does not fit on its own is started once all others are done.
+
+    """
+
+    results = len(calls) * [None]
+    futures = {}
+    used_memory = 0
+
+    for index, (memory, function, args) in enumerate(calls):
+        while (futures
+               and memory_limit is not None
+               and used_memory + memory > memory_limit):
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                done_index, done_memory = futures.pop(future)
+                results[done_index] = future.result()
+                used_memory -= done_memory
+
+        futures[executor.submit(function, *args)] = (index, memory)
+        used_memory += memory
+
+    for future, (index, _) in futures.items():
+        results[index] = future.result()
+
+    return results
+
+
+def create_patch_stats(ffrom, fto, fpatch, kwargs):
+    stats = PatchStats()
+    create_patch(ffrom, fto, fpatch, stats=stats, **kwargs)
+
+    return stats
+
+
+def create_patch_filenames_stats(fromfile, tofile, patchfile, kwargs):
+    stats = PatchStats()
+    create_patch_filenames(fromfile, tofile, patchfile, stats=stats, **kwargs)
+
+    return stats
+
+
+def log_patches_stats(stats):
+    for i, patch_stats in enumerate(stats):
+        LOGGER.info('Patch %d of %s from %s to %s created in %s.',
+                    i,
+                    format_size(patch_stats.patch_size),
+                    format_size(patch_stats.from_size),
+                    format_size(patch_stats.to_size),
+                    format_timespan(patch_stats.time))
+
+
+def create_patches_to(fto,
+                      ffroms,
+                      fpatches,
+                      jobs=None,
+                      memory_limit=None,
+                      **kwargs):
+    """Create one patch from each file in `ffroms` to `fto` and write it
+    to the file at the same index in `fpatches`. All files are
+    file-like objects.
+
+    Patches are created in parallel by up to `jobs` threads, by default
+    the number of CPUs. No more patches are created at the same time
+    than their estimated memory usage fits in `memory_limit` bytes, if
+    given.
+
+    Other keyword arguments are passed to
+    :func:`~detools.create_patch()`.
+
+    Returns a list of :class:`~detools.PatchStats`, one per patch.
+
+    >>> fto = open('foo.new', 'rb')
+    >>> ffroms = [open('foo.old', 'rb'), open('foo.older', 'rb')]
+    >>> fpatches = [BytesIO(), BytesIO()]
+    >>> stats = create_patches_to(fto, ffroms, fpatches)
+    >>> stats[0].patch_size
+    127
+
+    """
+
+    check_patches_count(ffroms, fpatches)
+
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+
+    # Each thread needs its own to file position.
+    to_data = file_read(fto)
+    calls = [
+        (estimate_create_patch_memory(file_size(ffrom), len(to_data)),
+         create_patch_stats,
+         (ffrom, BytesIO(to_data), fpatch, kwargs))
+        for ffrom, fpatch in zip(ffroms, fpatches)
+    ]
+
+    with ThreadPoolExecutor(jobs) as executor:
+        stats = execute_within_memory_limit(executor, calls, memory_limit)
+
+    log_patches_stats(stats)
+
+    return stats
+
+
+def create_patches_to_filenames(tofile,
+                                fromfiles,
+                                patchfiles,
+                                jobs=None,
+                                memory_limit=None,
+                                **kwargs):
+    """Same as :func:`~detools.create_patches_to()`, but with filenames
+    instead of file-like objects, and patches are created in a process
+    pool of `jobs` processes.
+
+    >>> create_patches_to_filenames('foo.new',
+                                    ['foo.old', 'foo.older'],
+                                    ['foo.patch', 'foo-older.patch'],
+                                    memory_limit=2 ** 30)
+
+    """
+
+    check_patches_count(fromfiles, patchfiles)
+
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+
+    to_size = os.path.getsize(tofile)
+    calls = [
+        (estimate_create_patch_memory(os.path.getsize(fromfile), to_size),
+         create_patch_filenames_stats,
+         (fromfile, tofile, patchfile, kwargs))
+        for fromfile, patchfile in zip(fromfiles, patchfiles)
+    ]
+
+    with ProcessPoolExecutor(jobs) as executor:
+        stats = execute_within_memory_limit(executor, calls, memory_limit)
+
+    log_patches_stats(stats)
+
+    return stats
@@ -26,6 +26,7 @@
  */
 
 #include <Python.h>
+#include <string>
 #include "HDiffPatch/libHDiffPatch/HDiff/diff.h"
 #include "HDiffPatch/libHDiffPatch/HPatch/patch.h"
 #include "HDiffPatch/file_for_patch.h"
@@ -81,7 +82,12 @@ static PyObject *create_patch_suffix_array(uint8_t *from_p,
                                            int patch_type)
 {
     std::vector<unsigned char> diff;
+    std::string error;
+    bool failed;
 
+    failed = false;
+
+    Py_BEGIN_ALLOW_THREADS
     try {
         create_compressed_diff(&to_p[0],
                                &to_p[to_size],
@@ -92,7 +98,13 @@ static PyObject *create_patch_suffix_array(uint8_t *from_p,
                                match_score,
                                patch_type);
     } catch (const std::exception& e) {
-        PyErr_SetString(PyExc_RuntimeError, e.what());
+        error = e.what();
+        failed = true;
+    }
+    Py_END_ALLOW_THREADS
+
+    if (failed) {
+        PyErr_SetString(PyExc_RuntimeError, error.c_str());
 
         return (NULL);
     }
@@ -101,6 +113,75 @@ static PyObject *create_patch_suffix_array(uint8_t *from_p,
                                           diff.size()));
 }
 
+/* Patch output stream writing into a bytearray, which is resized as
+   data is written. Writes are made with the GIL released, so it is
+   acquired when resizing. */
+struct bytearray_stream_output_t {
+    hpatch_TStreamOutput base;
+    PyObject *byte_array_p;
+    Py_ssize_t length;
+    PyThreadState *thread_state_p;
+};
+
+static hpatch_BOOL bytearray_stream_output_read_writed(
+    const hpatch_TStreamOutput *stream_p,
+    hpatch_StreamPos_t read_from_pos,
+    unsigned char *data_p,
+    unsigned char *data_end_p)
+{
+    struct bytearray_stream_output_t *self_p;
+    Py_ssize_t size;
+
+    self_p = (struct bytearray_stream_output_t *)stream_p->streamImport;
+    size = (Py_ssize_t)(data_end_p - data_p);
+
+    if ((Py_ssize_t)read_from_pos + size > self_p->length) {
+        return (hpatch_FALSE);
+    }
+
+    memcpy(data_p,
+           &PyByteArray_AS_STRING(self_p->byte_array_p)[read_from_pos],
+           (size_t)size);
+
+    return (hpatch_TRUE);
+}
+
+static hpatch_BOOL bytearray_stream_output_write(
+    const hpatch_TStreamOutput *stream_p,
+    hpatch_StreamPos_t write_to_pos,
+    const unsigned char *data_p,
+    const unsigned char *data_end_p)
+{
+    int res;
+    struct bytearray_stream_output_t *self_p;
+    Py_ssize_t size;
+    Py_ssize_t end;
+
+    self_p = (struct bytearray_stream_output_t *)stream_p->streamImport;
+    size = (Py_ssize_t)(data_end_p - data_p);
+    end = (Py_ssize_t)write_to_pos + size;
+
+    if (end > PyByteArray_GET_SIZE(self_p->byte_array_p)) {
+        PyEval_RestoreThread(self_p->thread_state_p);
+        res = PyByteArray_Resize(self_p->byte_array_p, 2 * end);
+        self_p->thread_state_p = PyEval_SaveThread();
+
+        if (res != 0) {
+            return (hpatch_FALSE);
+        }
+    }
+
+    memcpy(&PyByteArray_AS_STRING(self_p->byte_array_p)[write_to_pos],
+           data_p,
+           (size_t)size);
+
+    if (end > self_p->length) {
+        self_p->length = end;
+    }
+
+    return (hpatch_TRUE);
+}
+
 static PyObject *create_patch_match_blocks(uint8_t *from_p,
                                            uint8_t *to_p,
                                            Py_ssize_t from_size,
@@ -111,66 +192,63 @@ static PyObject *create_patch_match_blocks(uint8_t *from_p,
     int res;
     hpatch_TStreamInput from_data;
     hpatch_TStreamInput to_data;
-    hpatch_TFileStreamOutput patch_data;
-    PyObject *byte_array_p;
-    size_t members_read;
+    struct bytearray_stream_output_t patch_data;
+    std::string error;
+    bool failed;
 
     mem_as_hStreamInput(&from_data, &from_p[0], &from_p[from_size]);
     mem_as_hStreamInput(&to_data, &to_p[0], &to_p[to_size]);
-    hpatch_TFileStreamOutput_init(&patch_data);
-    hpatch_TFileStreamOutput_tmpfile(&patch_data, ~(hpatch_StreamPos_t)0);
-
-    create_compressed_diff_stream(&to_data,
-                                  &from_data,
-                                  &patch_data.base,
-                                  NULL,
-                                  match_block_size,
-                                  patch_type);
-
-    byte_array_p = PyByteArray_FromStringAndSize("", 1);
-
-    if (byte_array_p == NULL) {
-        goto out1;
+    memset(&patch_data, 0, sizeof(patch_data));
+    patch_data.base.streamImport = &patch_data;
+    patch_data.base.streamSize = ~(hpatch_StreamPos_t)0;
+    patch_data.base.read_writed = bytearray_stream_output_read_writed;
+    patch_data.base.write = bytearray_stream_output_write;
+    patch_data.length = 0;
+
+    /* Start with room for a patch a quarter of the to data size. */
+    patch_data.byte_array_p = PyByteArray_FromStringAndSize(NULL,
+                                                            to_size / 4 + 1);
+
+    if (patch_data.byte_array_p == NULL) {
+        return (NULL);
     }
 
-    res = PyByteArray_Resize(byte_array_p, (Py_ssize_t)patch_data.out_length);
+    failed = false;
+    patch_data.thread_state_p = PyEval_SaveThread();
 
-    if (res != 0) {
-        goto out2;
+    try {
+        create_compressed_diff_stream(&to_data,
+                                      &from_data,
+                                      &patch_data.base,
+                                      NULL,
+                                      match_block_size,
+                                      patch_type);
+    } catch (const std::exception& e) {
+        error = e.what();
+        failed = true;
     }
 
-    res = fseek(patch_data.m_file, 0, SEEK_SET);
+    PyEval_RestoreThread(patch_data.thread_state_p);
 
-    if (res != 0) {
-        PyErr_SetString(PyExc_RuntimeError, "internal error: fseek failed");
+    if (failed) {
+        /* Keep the error set by a failed resize, if any. */
+        if (!PyErr_Occurred()) {
+            PyErr_SetString(PyExc_RuntimeError, error.c_str());
+        }
 
-        goto out2;
+        goto err1;
     }
 
-    members_read = fread(PyByteArray_AsString(byte_array_p),
-                         1,
-                         (size_t)patch_data.out_length,
-                         patch_data.m_file);
-    hpatch_TFileStreamOutput_close(&patch_data);
-
-    if (members_read != patch_data.out_length) {
-        PyErr_SetString(PyExc_RuntimeError, "internal error: fread failed");
+    res = PyByteArray_Resize(patch_data.byte_array_p, patch_data.length);
 
-        goto out3;
+    if (res != 0) {
+        goto err1;
     }
 
-    return (byte_array_p);
-
- out1:
-    hpatch_TFileStreamOutput_close(&patch_data);
-
-    return (NULL);
+    return (patch_data.byte_array_p);
 
- out2:
-    hpatch_TFileStreamOutput_close(&patch_data);
-
- out3:
-    Py_DECREF(byte_array_p);
+ err1:
+    Py_DECREF(patch_data.byte_array_p);
 
     return (NULL);
 }
@@ -226,43 +304,64 @@ static PyObject *m_create_patch(PyObject *self_p, PyObject* args_p)
 }
 
 static int parse_apply_patch_args(PyObject *args_p,
-                                   char **from_pp,
-                                   char **patch_pp,
-                                   Py_ssize_t *from_size_p,
-                                   Py_ssize_t *patch_size_p)
+                                  Py_buffer *from_view_p,
+                                  Py_buffer *patch_view_p,
+                                  Py_buffer *to_view_p,
+                                  Py_ssize_t *cache_size_p)
 {
     int res;
-    PyObject *from_bytes_p;
-    PyObject *patch_bytes_p;
+    PyObject *from_p;
+    PyObject *patch_p;
+    PyObject *to_p;
 
     res = PyArg_ParseTuple(args_p,
-                           "OO",
-                           &from_bytes_p,
-                           &patch_bytes_p);
+                           "OOOn",
+                           &from_p,
+                           &patch_p,
+                           &to_p,
+                           cache_size_p);
 
     if (res == 0) {
         return (-1);
     }
 
-    res = PyBytes_AsStringAndSize(from_bytes_p, from_pp, from_size_p);
+    if (*cache_size_p < 0) {
+        PyErr_SetString(PyExc_ValueError, "Negative cache size.");
 
-    if (res != 0) {
         return (-1);
     }
 
-    res = PyBytes_AsStringAndSize(patch_bytes_p, patch_pp, patch_size_p);
+    res = PyObject_GetBuffer(from_p, from_view_p, PyBUF_CONTIG_RO);
+
+    if (res == -1) {
+        return (res);
+    }
+
+    res = PyObject_GetBuffer(patch_p, patch_view_p, PyBUF_CONTIG_RO);
 
-    if (res != 0) {
-        return (-1);
+    if (res == -1) {
+        goto err1;
+    }
+
+    res = PyObject_GetBuffer(to_p, to_view_p, PyBUF_CONTIG);
+
+    if (res == -1) {
+        goto err2;
     }
 
+    return (res);
+
+ err2:
+    PyBuffer_Release(patch_view_p);
+
+ err1:
+    PyBuffer_Release(from_view_p);
+
     return (res);
 }
 
 #define PATCH_CACHE_SIZE_MIN       (1024 * 8)
 #define PATCH_CACHE_SIZE_BEST_MIN  ((size_t)1 << 21)
-#define PATCH_CACHE_SIZE_DEFAULT   ((size_t)1 << 26)
-#define PATCH_CACHE_SIZE_BEST_MAX  ((size_t)1 << 30)
 
 static uint8_t* get_patch_mem_cache(size_t patchCacheSize,
                                     hpatch_StreamPos_t oldDataSize,
@@ -281,12 +380,15 @@ static uint8_t* get_patch_mem_cache(size_t patchCacheSize,
         temp_cache_size = (size_t)(oldDataSize + PATCH_CACHE_SIZE_BEST_MIN);
     }
 
-    while (!temp_cache_p) {
+    while (true) {
         temp_cache_p = (uint8_t *)malloc(temp_cache_size);
 
-        if ((!temp_cache_p) && (temp_cache_size >= PATCH_CACHE_SIZE_MIN * 2)) {
-            temp_cache_size >>= 1;
+        if ((temp_cache_p != NULL)
+            || (temp_cache_size < PATCH_CACHE_SIZE_MIN * 2)) {
+            break;
         }
+
+        temp_cache_size >>= 1;
     }
 
     *out_memCacheSize = (temp_cache_p ? temp_cache_size : 0);
@@ -295,15 +397,23 @@ static uint8_t* get_patch_mem_cache(size_t patchCacheSize,
 }
 
 /**
- * def apply_patch(from_data, patch_data) -> to_data
+ * def apply_patch(from_data, patch_data, to_data, cache_size)
+ *
+ * All data are accessed with the buffer protocol, so memory mapped
+ * files are not read into memory. to_data must be writable and have
+ * the size of the patched data. At most cache_size bytes are
+ * allocated for the patch cache.
  */
 static PyObject *m_apply_patch(PyObject *self_p, PyObject* args_p)
 {
     int res;
+    Py_buffer from_view;
+    Py_buffer patch_view;
+    Py_buffer to_view;
+    Py_ssize_t cache_size;
     uint8_t *from_p;
     uint8_t *patch_p;
-    Py_ssize_t from_size;
-    Py_ssize_t patch_size;
+    uint8_t *to_p;
     hpatch_TStreamOutput to_data;
     hpatch_TStreamInput patch_data;
     hpatch_TStreamInput from_data;
@@ -311,62 +421,87 @@ static PyObject *m_apply_patch(PyObject *self_p, PyObject* args_p)
     size_t temp_cache_size;
     hpatch_BOOL patch_result;
     hpatch_compressedDiffInfo patch_info;
-    PyObject *byte_array_p;
-    uint8_t *to_p;
 
     res = parse_apply_patch_args(args_p,
-                                  (char **)&from_p,
-                                  (char **)&patch_p,
-                                  &from_size,
-                                  &patch_size);
+                                 &from_view,
+                                 &patch_view,
+                                 &to_view,
+                                 &cache_size);
 
     if (res != 0) {
         return (NULL);
     }
 
-    mem_as_hStreamInput(&from_data, &from_p[0], &from_p[from_size]);
-    mem_as_hStreamInput(&patch_data, &patch_p[0], &patch_p[patch_size]);
+    from_p = (uint8_t *)from_view.buf;
+    patch_p = (uint8_t *)patch_view.buf;
+    to_p = (uint8_t *)to_view.buf;
+    mem_as_hStreamInput(&from_data, &from_p[0], &from_p[from_view.len]);
+    mem_as_hStreamInput(&patch_data, &patch_p[0], &patch_p[patch_view.len]);
 
-    if (!getCompressedDiffInfo(&patch_info, &patch_data)){
-        return (NULL);
-    }
+    if (!getCompressedDiffInfo(&patch_info, &patch_data)) {
+        PyErr_SetString(PyExc_RuntimeError, "Corrupt patch.");
 
-    if (from_data.streamSize != patch_info.oldDataSize){
-        return (NULL);
+        goto err1;
     }
 
-    byte_array_p = PyByteArray_FromStringAndSize("", 1);
+    if (from_data.streamSize != patch_info.oldDataSize) {
+        PyErr_Format(PyExc_RuntimeError,
+                     "Expected from size %llu, but got %llu.",
+                     (unsigned long long)patch_info.oldDataSize,
+                     (unsigned long long)from_data.streamSize);
 
-    if (byte_array_p == NULL) {
-        return (NULL);
+        goto err1;
     }
 
-    res = PyByteArray_Resize(byte_array_p, (Py_ssize_t)patch_info.newDataSize);
+    if ((hpatch_StreamPos_t)to_view.len != patch_info.newDataSize) {
+        PyErr_Format(PyExc_RuntimeError,
+                     "Expected to size %llu, but got %llu.",
+                     (unsigned long long)patch_info.newDataSize,
+                     (unsigned long long)to_view.len);
 
-    if (res != 0) {
-        return (NULL);
+        goto err1;
     }
 
-    to_p = (uint8_t *)PyByteArray_AsString(byte_array_p);
-    mem_as_hStreamOutput(&to_data, &to_p[0], &to_p[patch_info.newDataSize]);
-    temp_cache_p = get_patch_mem_cache(PATCH_CACHE_SIZE_DEFAULT,
+    mem_as_hStreamOutput(&to_data, &to_p[0], &to_p[to_view.len]);
+    temp_cache_p = get_patch_mem_cache((size_t)cache_size,
                                        from_data.streamSize,
                                        &temp_cache_size);
 
+    if (temp_cache_p == NULL) {
+        PyErr_NoMemory();
+
+        goto err1;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
     patch_result = patch_decompress_with_cache(&to_data,
                                                &from_data,
                                                &patch_data,
                                                NULL,
                                                &temp_cache_p[0],
                                                &temp_cache_p[temp_cache_size]);
+    Py_END_ALLOW_THREADS
 
-    if (patch_result != 1) {
-        exit(1);
+    free(temp_cache_p);
+
+    if (!patch_result) {
+        PyErr_SetString(PyExc_RuntimeError, "Corrupt patch.");
+
+        goto err1;
     }
 
-    free(temp_cache_p);
+    PyBuffer_Release(&from_view);
+    PyBuffer_Release(&patch_view);
+    PyBuffer_Release(&to_view);
 
-    return (byte_array_p);
+    Py_RETURN_NONE;
+
+ err1:
+    PyBuffer_Release(&from_view);
+    PyBuffer_Release(&patch_view);
+    PyBuffer_Release(&to_view);
+
+    return (NULL);
 }
 
 static PyMethodDef module_methods[] = {
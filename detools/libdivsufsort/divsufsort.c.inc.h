@@ -28,16 +28,130 @@
 #ifdef _OPENMP
 # include <omp.h>
 #endif
+#if defined(BUILD_DIVSUFSORT_MT) && !defined(_WIN32)
+# include <pthread.h>
+#endif
 
 
 /*- Private Functions -*/
 
+#if defined(BUILD_DIVSUFSORT_MT) && !defined(_WIN32)
+/* State shared by all type B* sorting threads. Same bucket
+   distribution as the OpenMP version below, but using pthreads. */
+struct sssort_shared_t {
+  pthread_mutex_t mutex;
+  const sauchar_t *T;
+  saidx_t *SA;
+  saidx_t *PAb;
+  saidx_t *bucket_B;
+  saidx_t n;
+  saidx_t m;
+  saint_t c0;
+  saint_t c1;
+  saidx_t j;
+};
+
+struct sssort_worker_t {
+  pthread_t thread;
+  struct sssort_shared_t *shared;
+  saidx_t *buf;
+  saidx_t bufsize;
+};
+
+static
+void *
+sssort_worker(void *arg) {
+  struct sssort_worker_t *worker = (struct sssort_worker_t *)arg;
+  struct sssort_shared_t *shared = worker->shared;
+  saidx_t *bucket_B = shared->bucket_B;
+  saidx_t *SA = shared->SA;
+  saidx_t k, l;
+  saint_t d0, d1;
+
+  for(;;) {
+    k = 0;
+    pthread_mutex_lock(&shared->mutex);
+    if(0 < (l = shared->j)) {
+      d0 = shared->c0, d1 = shared->c1;
+      do {
+        k = BUCKET_BSTAR(d0, d1);
+        if(--d1 <= d0) {
+          d1 = ALPHABET_SIZE - 1;
+          if(--d0 < 0) { break; }
+        }
+      } while(((l - k) <= 1) && (0 < (l = k)));
+      shared->c0 = d0, shared->c1 = d1, shared->j = k;
+    }
+    pthread_mutex_unlock(&shared->mutex);
+    if(l == 0) { break; }
+    if((l - k) <= 1) { continue; }
+    sssort(shared->T, shared->PAb, SA + k, SA + l,
+           worker->buf, worker->bufsize, 2, shared->n,
+           *(SA + k) == (shared->m - 1));
+  }
+
+  return NULL;
+}
+
+/* Sorts the type B* substrings using given number of threads. Falls
+   back to fewer threads if threads cannot be created. */
+static
+void
+sssort_parallel(const sauchar_t *T, saidx_t *SA, saidx_t *PAb,
+                saidx_t *bucket_B, saidx_t n, saidx_t m,
+                saint_t threads) {
+  struct sssort_shared_t shared;
+  struct sssort_worker_t *workers;
+  saidx_t *buf, bufsize;
+  saint_t i, started;
+
+  workers = (struct sssort_worker_t *)malloc(threads * sizeof(*workers));
+  if(workers == NULL) { threads = 1; workers = NULL; }
+
+  shared.T = T, shared.SA = SA, shared.PAb = PAb, shared.bucket_B = bucket_B;
+  shared.n = n, shared.m = m;
+  shared.c0 = ALPHABET_SIZE - 2, shared.c1 = ALPHABET_SIZE - 1, shared.j = m;
+  pthread_mutex_init(&shared.mutex, NULL);
+  buf = SA + m, bufsize = (n - (2 * m)) / threads;
+
+  if(workers == NULL) {
+    struct sssort_worker_t worker;
+    worker.shared = &shared, worker.buf = buf, worker.bufsize = bufsize;
+    sssort_worker(&worker);
+  } else {
+    for(i = 0; i < threads; ++i) {
+      workers[i].shared = &shared;
+      workers[i].buf = buf + i * bufsize;
+      workers[i].bufsize = bufsize;
+    }
+    /* The calling thread is worker 0. */
+    for(i = 1, started = 1; i < threads; ++i, ++started) {
+      if(pthread_create(&workers[i].thread, NULL,
+                        sssort_worker, &workers[i]) != 0) {
+        break;
+      }
+    }
+    sssort_worker(&workers[0]);
+    for(i = 1; i < started; ++i) {
+      pthread_join(workers[i].thread, NULL);
+    }
+    free(workers);
+  }
+
+  pthread_mutex_destroy(&shared.mutex);
+}
+#endif
+
 /* Sorts suffixes of type B*. */
 static
 saidx_t
 sort_typeBstar(const sauchar_t *T, saidx_t *SA,
                saidx_t *bucket_A, saidx_t *bucket_B,
+#if defined(BUILD_DIVSUFSORT_MT)
+               saidx_t n, saint_t threads) {
+#else
                saidx_t n) {
+#endif
   saidx_t *PAb, *ISAb, *buf;
 #ifdef _OPENMP
   saidx_t *curbuf;
@@ -130,6 +244,16 @@ note:
       }
     }
 #else
+#if defined(BUILD_DIVSUFSORT_MT) && !defined(_WIN32)
+    if(1 < threads) {
+      sssort_parallel(T, SA, PAb, bucket_B, n, m, threads);
+    } else {
+#elif defined(BUILD_DIVSUFSORT_MT)
+    (void)threads;
+    {
+#else
+    {
+#endif
     buf = SA + m, bufsize = n - (2 * m);
     for(c0 = ALPHABET_SIZE - 2, j = m; 0 < j; --c0) {
       for(c1 = ALPHABET_SIZE - 1; c0 < c1; j = i, --c1) {
@@ -140,6 +264,7 @@ note:
         }
       }
     }
+    }
 #endif
 
     /* Compute ranks of type B* substrings. */
@@ -252,6 +377,7 @@ construct_SA(const sauchar_t *T, saidx_t *SA,
   }
 }
 
+#if !defined(BUILD_DIVSUFSORT_MT)
 /* Constructs the burrows-wheeler transformed string directly
    by using the sorted order of type B* suffixes. */
 static
@@ -322,6 +448,7 @@ construct_BWT(const sauchar_t *T, saidx_t *SA,
 
   return (saidx_t)(orig - SA);
 }
+#endif
 
 
 /*---------------------------------------------------------------------------*/
@@ -329,7 +456,11 @@ construct_BWT(const sauchar_t *T, saidx_t *SA,
 /*- Function -*/
 
 saint_t
+#if defined(BUILD_DIVSUFSORT_MT)
+divsufsort_mt(const sauchar_t *T, saidx_t *SA, saidx_t n, saint_t threads) {
+#else
 divsufsort(const sauchar_t *T, saidx_t *SA, saidx_t n) {
+#endif
   saidx_t *bucket_A, *bucket_B;
   saidx_t m;
   saint_t err = 0;
@@ -345,7 +476,11 @@ divsufsort(const sauchar_t *T, saidx_t *SA, saidx_t n) {
 
   /* Suffixsort. */
   if((bucket_A != NULL) && (bucket_B != NULL)) {
+#if defined(BUILD_DIVSUFSORT_MT)
+    m = sort_typeBstar(T, SA, bucket_A, bucket_B, n, threads);
+#else
     m = sort_typeBstar(T, SA, bucket_A, bucket_B, n);
+#endif
     construct_SA(T, SA, bucket_A, bucket_B, n, m);
   } else {
     err = -2;
@@ -357,6 +492,7 @@ divsufsort(const sauchar_t *T, saidx_t *SA, saidx_t n) {
   return err;
 }
 
+#if !defined(BUILD_DIVSUFSORT_MT)
 saidx_t
 divbwt(const sauchar_t *T, sauchar_t *U, saidx_t *A, saidx_t n) {
   saidx_t *B;
@@ -396,3 +532,4 @@ const char *
 divsufsort_version(void) {
   return PROJECT_VERSION_FULL;
 }
+#endif
@@ -77,6 +77,11 @@ extern "C" {
 # define sa_simplesearch sa_simplesearch64
 # define sssort sssort64
 # define trsort trsort64
+#elif defined(BUILD_DIVSUFSORT_MT)
+# include "divsufsort.h"
+# include "divsufsort_mt.h"
+# define sssort sssort_mt
+# define trsort trsort_mt
 #else
 # include "divsufsort.h"
 #endif
@@ -29,10 +29,41 @@
 #include <Python.h>
 #include "sais/sais.h"
 #include "libdivsufsort/divsufsort.h"
+#include "libdivsufsort/divsufsort_mt.h"
+#include "libdivsufsort/divsufsort64.h"
 
 typedef int32_t (*create_t)(const uint8_t *buf_p,
                             int32_t *suffix_array_p,
-                            int32_t length);
+                            int32_t length,
+                            int threads);
+
+static int32_t create_sais(const uint8_t *buf_p,
+                           int32_t *suffix_array_p,
+                           int32_t length,
+                           int threads)
+{
+    (void)threads;
+
+    return (sais(buf_p, suffix_array_p, length));
+}
+
+static int32_t create_divsufsort(const uint8_t *buf_p,
+                                 int32_t *suffix_array_p,
+                                 int32_t length,
+                                 int threads)
+{
+    (void)threads;
+
+    return (divsufsort(buf_p, suffix_array_p, length));
+}
+
+static int32_t create_divsufsort_mt(const uint8_t *buf_p,
+                                    int32_t *suffix_array_p,
+                                    int32_t length,
+                                    int threads)
+{
+    return (divsufsort_mt(buf_p, suffix_array_p, length, threads));
+}
 
 static PyObject *create(PyObject *self_p,
                         PyObject* args_p,
@@ -44,16 +75,25 @@ static PyObject *create(PyObject *self_p,
     PyObject *from_p;
     PyObject *suffix_array_buffer_p;
     int32_t *suffix_array_p;
+    int threads;
 
+    threads = 1;
     res = PyArg_ParseTuple(args_p,
-                           "OO",
+                           "OO|i",
                            &from_p,
-                           &suffix_array_buffer_p);
+                           &suffix_array_buffer_p,
+                           &threads);
 
     if (res == 0) {
         return (NULL);
     }
 
+    if (threads < 1) {
+        PyErr_SetString(PyExc_ValueError, "Threads must be at least 1.");
+
+        return (NULL);
+    }
+
     /* Input argument conversion. */
     res = PyObject_GetBuffer(from_p, &from_view, PyBUF_CONTIG_RO);
 
@@ -69,15 +109,104 @@ static PyObject *create(PyObject *self_p,
         goto err1;
     }
 
+    if (from_view.len > INT32_MAX) {
+        PyErr_SetString(PyExc_ValueError,
+                        "Data too long for a 32 bits suffix array.");
+
+        goto err2;
+    }
+
+    if (suffix_array_view.len < 4 * (from_view.len + 1)) {
+        PyErr_SetString(PyExc_ValueError, "Suffix array too small.");
+
+        goto err2;
+    }
+
     suffix_array_p = (int32_t *)suffix_array_view.buf;
     suffix_array_p[0] = (int32_t)from_view.len;
 
-    /* Execute the SA-IS algorithm. */
+    /* Create the suffix array without holding the GIL. */
+    Py_BEGIN_ALLOW_THREADS
     res = create_callback((uint8_t *)from_view.buf,
                           &suffix_array_p[1],
-                          (int32_t)from_view.len);
+                          (int32_t)from_view.len,
+                          threads);
+    Py_END_ALLOW_THREADS
 
     if (res != 0) {
+        PyErr_Format(PyExc_RuntimeError,
+                     "Suffix array creation failed with %d.",
+                     res);
+
+        goto err2;
+    }
+
+    PyBuffer_Release(&from_view);
+    PyBuffer_Release(&suffix_array_view);
+    Py_INCREF(Py_None);
+
+    return (Py_None);
+
+ err2:
+    PyBuffer_Release(&suffix_array_view);
+
+ err1:
+    PyBuffer_Release(&from_view);
+
+    return (NULL);
+}
+
+static PyObject *create64(PyObject* args_p)
+{
+    int res;
+    Py_buffer from_view;
+    Py_buffer suffix_array_view;
+    PyObject *from_p;
+    PyObject *suffix_array_buffer_p;
+    saidx64_t *suffix_array_p;
+
+    res = PyArg_ParseTuple(args_p, "OO", &from_p, &suffix_array_buffer_p);
+
+    if (res == 0) {
+        return (NULL);
+    }
+
+    /* Input argument conversion. */
+    res = PyObject_GetBuffer(from_p, &from_view, PyBUF_CONTIG_RO);
+
+    if (res == -1) {
+        return (NULL);
+    }
+
+    res = PyObject_GetBuffer(suffix_array_buffer_p,
+                             &suffix_array_view,
+                             PyBUF_CONTIG);
+
+    if (res == -1) {
+        goto err1;
+    }
+
+    if (suffix_array_view.len < 8 * (from_view.len + 1)) {
+        PyErr_SetString(PyExc_ValueError, "Suffix array too small.");
+
+        goto err2;
+    }
+
+    suffix_array_p = (saidx64_t *)suffix_array_view.buf;
+    suffix_array_p[0] = (saidx64_t)from_view.len;
+
+    /* Create the suffix array without holding the GIL. */
+    Py_BEGIN_ALLOW_THREADS
+    res = divsufsort64((uint8_t *)from_view.buf,
+                       &suffix_array_p[1],
+                       (saidx64_t)from_view.len);
+    Py_END_ALLOW_THREADS
+
+    if (res != 0) {
+        PyErr_Format(PyExc_RuntimeError,
+                     "Suffix array creation failed with %d.",
+                     res);
+
         goto err2;
     }
 
@@ -101,7 +230,7 @@ static PyObject *create(PyObject *self_p,
  */
 static PyObject *m_sais(PyObject *self_p, PyObject* args_p)
 {
-    return (create(self_p, args_p, sais));
+    return (create(self_p, args_p, create_sais));
 }
 
 /**
@@ -109,12 +238,187 @@ static PyObject *m_sais(PyObject *self_p, PyObject* args_p)
  */
 static PyObject *m_divsufsort(PyObject *self_p, PyObject* args_p)
 {
-    return (create(self_p, args_p, divsufsort));
+    return (create(self_p, args_p, create_divsufsort));
+}
+
+/**
+ * def divsufsort_mt(data, threads) -> suffix array
+ */
+static PyObject *m_divsufsort_mt(PyObject *self_p, PyObject* args_p)
+{
+    return (create(self_p, args_p, create_divsufsort_mt));
+}
+
+/**
+ * def divsufsort64(data) -> suffix array
+ */
+static PyObject *m_divsufsort64(PyObject *self_p, PyObject* args_p)
+{
+    return (create64(args_p));
+}
+
+static int get_item_size(Py_ssize_t size, Py_buffer *view_p)
+{
+    if (view_p->len == 4 * (size + 1)) {
+        return (4);
+    } else if (view_p->len == 8 * (size + 1)) {
+        return (8);
+    } else {
+        return (0);
+    }
+}
+
+static int64_t get_length(Py_buffer *view_p)
+{
+    if (view_p->len >= 4) {
+        if (view_p->len == 4 * ((int64_t)((int32_t *)view_p->buf)[0] + 1)) {
+            return (((int32_t *)view_p->buf)[0]);
+        }
+    }
+
+    if (view_p->len >= 8) {
+        if (view_p->len == 8 * (((int64_t *)view_p->buf)[0] + 1)) {
+            return (((int64_t *)view_p->buf)[0]);
+        }
+    }
+
+    return (-1);
+}
+
+static void offset_suffix_array(void *src_p,
+                                int src_item_size,
+                                int64_t length,
+                                void *dst_p,
+                                int dst_item_size,
+                                int64_t offset)
+{
+    int64_t i;
+    int64_t j;
+    int64_t value;
+
+    j = 1;
+
+    for (i = 1; i <= length; i++) {
+        if (src_item_size == 4) {
+            value = ((int32_t *)src_p)[i];
+        } else {
+            value = ((int64_t *)src_p)[i];
+        }
+
+        if (value < offset) {
+            continue;
+        }
+
+        value -= offset;
+
+        if (dst_item_size == 4) {
+            ((int32_t *)dst_p)[j] = (int32_t)value;
+        } else {
+            ((int64_t *)dst_p)[j] = value;
+        }
+
+        j++;
+    }
+
+    if (dst_item_size == 4) {
+        ((int32_t *)dst_p)[0] = (int32_t)(length - offset);
+    } else {
+        ((int64_t *)dst_p)[0] = (length - offset);
+    }
+}
+
+/**
+ * def offset(suffix_array, offset, result)
+ *
+ * Create the suffix array of data[offset:] in result from given
+ * suffix array of data. The suffixes of data[offset:] are the
+ * suffixes of data starting at or after offset, in the same order,
+ * so no sorting is needed. Both suffix arrays may have 32 or 64 bits
+ * items.
+ */
+static PyObject *m_offset(PyObject *self_p, PyObject* args_p)
+{
+    int res;
+    PyObject *src_p;
+    PyObject *dst_p;
+    Py_buffer src_view;
+    Py_buffer dst_view;
+    Py_ssize_t offset;
+    int64_t length;
+    int src_item_size;
+    int dst_item_size;
+
+    res = PyArg_ParseTuple(args_p, "OnO", &src_p, &offset, &dst_p);
+
+    if (res == 0) {
+        return (NULL);
+    }
+
+    res = PyObject_GetBuffer(src_p, &src_view, PyBUF_CONTIG_RO);
+
+    if (res == -1) {
+        return (NULL);
+    }
+
+    res = PyObject_GetBuffer(dst_p, &dst_view, PyBUF_CONTIG);
+
+    if (res == -1) {
+        goto err1;
+    }
+
+    length = get_length(&src_view);
+
+    if (length < 0) {
+        PyErr_SetString(PyExc_ValueError, "Bad suffix array size.");
+
+        goto err2;
+    }
+
+    if ((offset < 0) || (offset > length)) {
+        PyErr_SetString(PyExc_ValueError, "Bad offset.");
+
+        goto err2;
+    }
+
+    src_item_size = get_item_size(length, &src_view);
+    dst_item_size = get_item_size(length - offset, &dst_view);
+
+    if (dst_item_size == 0) {
+        PyErr_SetString(PyExc_ValueError, "Bad result suffix array size.");
+
+        goto err2;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    offset_suffix_array(src_view.buf,
+                        src_item_size,
+                        length,
+                        dst_view.buf,
+                        dst_item_size,
+                        offset);
+    Py_END_ALLOW_THREADS
+
+    PyBuffer_Release(&src_view);
+    PyBuffer_Release(&dst_view);
+    Py_INCREF(Py_None);
+
+    return (Py_None);
+
+ err2:
+    PyBuffer_Release(&dst_view);
+
+ err1:
+    PyBuffer_Release(&src_view);
+
+    return (NULL);
 }
 
 static PyMethodDef module_methods[] = {
     { "sais", m_sais, METH_VARARGS },
     { "divsufsort", m_divsufsort, METH_VARARGS },
+    { "divsufsort_mt", m_divsufsort_mt, METH_VARARGS },
+    { "divsufsort64", m_divsufsort64, METH_VARARGS },
+    { "offset", m_offset, METH_VARARGS },
     { NULL }
 };
 
@@ -0,0 +1,152 @@
+import os
+import mmap
+import hashlib
+import logging
+import tempfile
+
+from humanfriendly import format_size
+
+
+LOGGER = logging.getLogger(__name__)
+
+SUFFIX = '.sa'
+
+# Suffix array algorithms creating identical suffix arrays share cache
+# entries.
+SUFFIX_ARRAY_ALGORITHM_KEYS = {
+    'divsufsort-mt': 'divsufsort'
+}
+
+
+class SuffixArrayCache(object):
+    """An on-disk cache of suffix arrays in given directory. Each suffix
+    array is stored in its own file, named after a hash of the data
+    and the suffix array algorithm, and is loaded using mmap.
+
+    The least recently used suffix arrays are removed when the total
+    size of the cache exceeds `maximum_size` bytes. There is no limit
+    if `maximum_size` is ``None``.
+
+    """
+
+    def __init__(self, directory, maximum_size=None):
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+        self._maximum_size = maximum_size
+
+    def key(self, data, suffix_array_algorithm):
+        """Returns the cache key of given data and suffix array
+        algorithm. ``'divsufsort'`` and ``'divsufsort-mt'`` create the
+        same suffix array, and thus have the same key.
+
+        """
+
+        suffix_array_algorithm = SUFFIX_ARRAY_ALGORITHM_KEYS.get(
+            suffix_array_algorithm,
+            suffix_array_algorithm)
+
+        return '{}-{}'.format(hashlib.sha256(data).hexdigest(),
+                              suffix_array_algorithm)
+
+    def get(self, key, size):
+        """Returns a read-only mmap of the suffix array with given key, or
+        ``None`` if missing. A suffix array that is not `size` bytes
+        is treated as missing.
+
+        """
+
+        path = self._path(key)
+
+        try:
+            with open(path, 'rb') as fin:
+                if os.fstat(fin.fileno()).st_size != size:
+                    return None
+
+                suffix_array = mmap.mmap(fin.fileno(),
+                                         0,
+                                         access=mmap.ACCESS_READ)
+        except OSError:
+            return None
+
+        # Mark as recently used.
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        return suffix_array
+
+    def put(self, key, size, create):
+        """Create a suffix array of `size` bytes by calling `create` with a
+        writable mmap, store it in the cache and return a read-only mmap
+        of it.
+
+        """
+
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self._directory)
+
+        try:
+            with os.fdopen(fd, 'w+b') as fout:
+                fout.truncate(size)
+
+                with mmap.mmap(fout.fileno(), size) as suffix_array:
+                    create(suffix_array)
+                    suffix_array.flush()
+
+            path = self._path(key)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+
+            raise
+
+        self._evict(path)
+
+        with open(path, 'rb') as fin:
+            return mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _path(self, key):
+        return os.path.join(self._directory, key + SUFFIX)
+
+    def _evict(self, keep_path):
+        """Remove least recently used suffix arrays, except `keep_path`,
+        until the cache fits in its maximum size.
+
+        """
+
+        if self._maximum_size is None:
+            return
+
+        entries = []
+
+        for name in os.listdir(self._directory):
+            if not name.endswith(SUFFIX):
+                continue
+
+            path = os.path.join(self._directory, name)
+
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total_size = sum([size for _, size, _ in entries])
+
+        for _, size, path in sorted(entries):
+            if total_size <= self._maximum_size:
+                break
+
+            if path == keep_path:
+                continue
+
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+
+            total_size -= size
+            LOGGER.debug('Removed suffix array %s of %s from the cache.',
+                          path,
+                          format_size(size))
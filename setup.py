@@ -57,9 +57,24 @@ setup(name='detools',
                     sources=[
                         "detools/suffix_array.c",
                         "detools/sais/sais.c",
-                        "detools/libdivsufsort/divsufsort.c"
+                        "detools/libdivsufsort/divsufsort.c",
+                        "detools/libdivsufsort/divsufsort_mt.c",
+                        "detools/libdivsufsort/divsufsort64.c"
                     ]),
           Extension(name="detools.bsdiff", sources=["detools/bsdiff.c"]),
+          Extension(name="detools.ccrle",
+                    sources=["detools/ccrle.c"],
+                    optional=True),
+          Extension(name="detools.capply",
+                    sources=[
+                        "detools/capply.c",
+                        "c/detools.c",
+                        "c/heatshrink/heatshrink_decoder.c"
+                    ],
+                    include_dirs=["c", "c/heatshrink"],
+                    define_macros=[("DETOOLS_CONFIG_FILE_IO", "0")],
+                    libraries=["lzma"],
+                    optional=True),
           Extension(name="detools.hdiffpatch", sources=HDIFFPATCH_SOURCES)
       ],
       test_suite="tests",
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+#
+# Apply a sequential patch using the buffered Python apply engine, the
+# C apply engine and the previous implementation, which processed the
+# patch in 4096 bytes chunks and allocated new buffers for each chunk,
+# and print the elapsed times.
+#
+# $ python3 tests/benchmark_apply.py [<from-file> <to-file>]
+#
+
+import os
+import sys
+import time
+import argparse
+from io import BytesIO
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+
+sys.path.insert(0, os.path.join(SCRIPT_DIR, '..'))
+
+import detools
+from detools import bsdiff
+from detools.errors import Error
+from detools.common import unpack_size
+from detools.apply import PatchReader
+from detools.apply import read_header_sequential
+
+
+class PreviousPatchReader(object):
+
+    def __init__(self, fpatch, compression):
+        self.decompressor = PatchReader(fpatch, compression).decompressor
+        self._fpatch = fpatch
+
+    def read(self, size):
+        return self.decompress(size)
+
+    def decompress(self, size):
+        buf = b''
+
+        while len(buf) < size:
+            if self.decompressor.needs_input:
+                data = self._fpatch.read(4096)
+            else:
+                data = b''
+
+            buf += self.decompressor.decompress(data, size - len(buf))
+
+        return buf
+
+
+def previous_iter_chunks(patch_reader, to_pos, to_size, message):
+    size = unpack_size(patch_reader)
+
+    if to_pos + size > to_size:
+        raise Error(message)
+
+    offset = 0
+
+    while offset < size:
+        chunk_size = min(size - offset, 4096)
+        offset += chunk_size
+        patch_data = patch_reader.decompress(chunk_size)
+
+        yield chunk_size, patch_data
+
+
+def previous_apply_patch(ffrom, fpatch, fto):
+    compression, to_size = read_header_sequential(fpatch)
+
+    if to_size == 0:
+        return to_size
+
+    patch_reader = PreviousPatchReader(fpatch, compression)
+
+    if unpack_size(patch_reader) != 0:
+        raise Error('Data formats are not supported.')
+
+    to_pos = 0
+
+    while to_pos < to_size:
+        for chunk_size, patch_data in previous_iter_chunks(
+                patch_reader,
+                to_pos,
+                to_size,
+                'Patch diff data too long.'):
+            from_data = ffrom.read(chunk_size)
+            fto.write(bsdiff.add_bytes(patch_data, from_data))
+            to_pos += chunk_size
+
+        for chunk_size, patch_data in previous_iter_chunks(
+                patch_reader,
+                to_pos,
+                to_size,
+                'Patch extra data too long.'):
+            fto.write(patch_data)
+            to_pos += chunk_size
+
+        ffrom.seek(unpack_size(patch_reader), os.SEEK_CUR)
+
+    return to_size
+
+
+def python_apply_patch(ffrom, fpatch, fto):
+    return detools.apply_patch(ffrom, fpatch, fto, engine='python')
+
+
+def c_apply_patch(ffrom, fpatch, fto):
+    return detools.apply_patch(ffrom, fpatch, fto, engine='c')
+
+
+def measure(apply_patch, from_data, patch, repetitions):
+    best_time = None
+
+    for _ in range(repetitions):
+        fto = BytesIO()
+        start_time = time.time()
+        apply_patch(BytesIO(from_data), BytesIO(patch), fto)
+        elapsed_time = time.time() - start_time
+
+        if best_time is None or elapsed_time < best_time:
+            best_time = elapsed_time
+
+    return best_time, fto.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-s', '--scale',
+        type=int,
+        default=16,
+        help=('Repeat the from and to data this many times to get bigger '
+              'inputs (default: %(default)s).'))
+    parser.add_argument(
+        '-r', '--repetitions',
+        type=int,
+        default=3,
+        help='Number of repetitions (default: %(default)s).')
+    parser.add_argument(
+        '-c', '--compression',
+        default='none',
+        help='Compression (default: %(default)s).')
+    parser.add_argument(
+        'fromfile',
+        nargs='?',
+        default=os.path.join(SCRIPT_DIR,
+                             'files/micropython/esp8266-20180511-v1.9.4.bin'))
+    parser.add_argument(
+        'tofile',
+        nargs='?',
+        default=os.path.join(SCRIPT_DIR,
+                             'files/micropython/esp8266-20190125-v1.10.bin'))
+    args = parser.parse_args()
+
+    with open(args.fromfile, 'rb') as fin:
+        from_data = args.scale * fin.read()
+
+    with open(args.tofile, 'rb') as fin:
+        to_data = args.scale * fin.read()
+
+    fpatch = BytesIO()
+    detools.create_patch(BytesIO(from_data),
+                         BytesIO(to_data),
+                         fpatch,
+                         compression=args.compression)
+    patch = fpatch.getvalue()
+
+    print('From:          {} ({} bytes)'.format(args.fromfile, len(from_data)))
+    print('To:            {} ({} bytes)'.format(args.tofile, len(to_data)))
+    print('Patch:         {} bytes ({})'.format(len(patch), args.compression))
+    print()
+
+    previous_time, previous_to_data = measure(previous_apply_patch,
+                                              from_data,
+                                              patch,
+                                              args.repetitions)
+    buffered_time, buffered_to_data = measure(python_apply_patch,
+                                              from_data,
+                                              patch,
+                                              args.repetitions)
+    c_time, c_to_data = measure(c_apply_patch,
+                                from_data,
+                                patch,
+                                args.repetitions)
+
+    if any([data != to_data
+            for data in [previous_to_data, buffered_to_data, c_to_data]]):
+        sys.exit('error: Wrong to data.')
+
+    megabytes = len(to_data) / 1000000
+
+    print('Previous:      {:.3f} s ({:.1f} MB/s)'.format(
+        previous_time,
+        megabytes / previous_time))
+    print('Buffered:      {:.3f} s ({:.1f} MB/s, speedup {:.2f})'.format(
+        buffered_time,
+        megabytes / buffered_time,
+        previous_time / buffered_time))
+    print('C:             {:.3f} s ({:.1f} MB/s, speedup {:.2f})'.format(
+        c_time,
+        megabytes / c_time,
+        previous_time / c_time))
+
+
+if __name__ == '__main__':
+    main()
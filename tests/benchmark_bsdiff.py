@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+#
+# Run the bsdiff algorithm on a few pairs of from and to data and
+# print the CPU time of the best of a number of runs. The suffix
+# array is created once per pair and is not part of the time.
+#
+# $ python3 tests/benchmark_bsdiff.py [<from-file> <to-file>]
+#
+
+import os
+import sys
+import time
+import random
+import hashlib
+import argparse
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+
+sys.path.insert(0, os.path.join(SCRIPT_DIR, '..'))
+
+from detools import bsdiff
+from detools.create import create_suffix_array
+from detools.create import suffix_array_size
+
+
+def create_similar_data(size, number_of_changes):
+    """Returns random from data and the same data with a number of small
+    changes, like two builds of the same image.
+
+    """
+
+    rng = random.Random(0)
+    from_data = rng.randbytes(size)
+    to_data = bytearray(from_data)
+
+    for _ in range(number_of_changes):
+        offset = rng.randrange(size - 16)
+        to_data[offset:offset + 16] = rng.randbytes(16)
+
+    return from_data, bytes(to_data)
+
+
+def create_datas(args):
+    datas = []
+
+    with open(args.fromfile, 'rb') as fin:
+        from_data = fin.read()
+
+    with open(args.tofile, 'rb') as fin:
+        to_data = fin.read()
+
+    datas.append((os.path.basename(args.tofile), from_data, to_data))
+    datas.append(('similar',) + create_similar_data(args.size, 1000))
+    datas.append(('identical',) + 2 * (create_similar_data(args.size, 0)[0], ))
+
+    return datas
+
+
+def run_bsdiff(suffix_array, from_data, to_data):
+    chunks = bsdiff.create_patch(suffix_array,
+                                 from_data,
+                                 to_data,
+                                 bytearray(len(to_data) + 1),
+                                 8,
+                                 0)
+
+    return hashlib.sha256(b''.join(chunks)).hexdigest()[:16]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-n', '--number-of-runs',
+        type=int,
+        default=3,
+        help='Number of runs per data (default: %(default)s).')
+    parser.add_argument(
+        '-s', '--size',
+        type=int,
+        default=8000000,
+        help='Size of the generated data (default: %(default)s).')
+    parser.add_argument(
+        'fromfile',
+        nargs='?',
+        default=os.path.join(SCRIPT_DIR,
+                             'files/micropython/esp8266-20180511-v1.9.4.bin'))
+    parser.add_argument(
+        'tofile',
+        nargs='?',
+        default=os.path.join(SCRIPT_DIR,
+                             'files/micropython/esp8266-20190125-v1.10.bin'))
+    args = parser.parse_args()
+
+    for name, from_data, to_data in create_datas(args):
+        suffix_array = bytearray(suffix_array_size(len(from_data)))
+        create_suffix_array(suffix_array, from_data, 'divsufsort', None)
+        times = []
+
+        for _ in range(args.number_of_runs):
+            start_time = time.process_time()
+            digest = run_bsdiff(suffix_array, from_data, to_data)
+            times.append(time.process_time() - start_time)
+
+        print('{:36} {:9} bytes {:8.3f} s  {}'.format(name,
+                                                     len(to_data),
+                                                     min(times),
+                                                     digest))
+
+
+if __name__ == '__main__':
+    main()
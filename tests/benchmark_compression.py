@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+#
+# Decompress heatshrink and lz4 compressed data of increasing sizes,
+# using the current decompressors and the previous ones, which
+# concatenated and sliced bytes objects, and print the elapsed
+# times. The current decompressors run in linear time, so their
+# throughput should not drop as the size grows.
+#
+# $ python3 tests/benchmark_compression.py [<file>]
+#
+
+import os
+import sys
+import time
+import argparse
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+
+sys.path.insert(0, os.path.join(SCRIPT_DIR, '..'))
+
+import lz4.frame
+from heatshrink2.core import Reader
+from heatshrink2.core import Encoder
+from detools.create import create_compressor
+from detools.compression.heatshrink import unpack_header
+from detools.compression.heatshrink import HeatshrinkDecompressor
+from detools.compression.lz4 import Lz4Decompressor
+
+
+class PreviousHeatshrinkDecompressor(object):
+
+    def __init__(self, number_of_bytes):
+        self._number_of_bytes_left = number_of_bytes
+        self._data = b''
+        self._encoder = None
+
+    def decompress(self, data, size):
+        if self._encoder is None:
+            if not data:
+                return b''
+
+            window_sz2, lookahead_sz2 = unpack_header(data[:1])
+            self._encoder = Encoder(Reader(window_sz2=window_sz2,
+                                           lookahead_sz2=lookahead_sz2))
+            data = data[1:]
+            self._number_of_bytes_left -= 1
+
+        if self._number_of_bytes_left > 0:
+            self._data += self._encoder.fill(data)
+            self._number_of_bytes_left -= len(data)
+
+        if self._number_of_bytes_left == 0:
+            self._data += self._encoder.finish()
+            self._number_of_bytes_left = -1
+
+        decompressed = self._data[:size]
+        self._data = self._data[size:]
+
+        return decompressed
+
+    @property
+    def needs_input(self):
+        return self._data == b'' and not self.eof
+
+    @property
+    def eof(self):
+        return self._number_of_bytes_left == -1 and self._data == b''
+
+
+class PreviousLz4Decompressor(lz4.frame.LZ4FrameDecompressor):
+
+    pass
+
+
+def compress(compression, data):
+    compressor = create_compressor(compression, 8, 7, None, 1)
+
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress(decompressor, compressed, input_size, read_size):
+    chunks = []
+    offset = 0
+
+    while not decompressor.eof:
+        if decompressor.needs_input:
+            data = compressed[offset:offset + input_size]
+            offset += len(data)
+        else:
+            data = b''
+
+        chunks.append(decompressor.decompress(data, read_size))
+
+    return b''.join(chunks)
+
+
+def measure(create_decompressor, compressed, data, input_size, read_size):
+    start_time = time.time()
+    decompressed = decompress(create_decompressor(len(compressed)),
+                              compressed,
+                              input_size,
+                              read_size)
+    elapsed_time = time.time() - start_time
+
+    if decompressed != data:
+        sys.exit('error: Wrong decompressed data.')
+
+    return elapsed_time
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-s', '--scales',
+        default='1,4,8',
+        help=('Comma separated list of how many times to repeat the file '
+              '(default: %(default)s).'))
+    parser.add_argument(
+        '-i', '--input-size',
+        type=int,
+        default=16777216,
+        help=('Number of compressed bytes given to the decompressor at a '
+              'time (default: %(default)s).'))
+    parser.add_argument(
+        '-r', '--read-size',
+        type=int,
+        default=4096,
+        help=('Number of bytes to read from the decompressor at a time '
+              '(default: %(default)s).'))
+    parser.add_argument(
+        'file',
+        nargs='?',
+        default=os.path.join(SCRIPT_DIR,
+                             'files/micropython/esp8266-20190125-v1.10.bin'))
+    args = parser.parse_args()
+
+    with open(args.file, 'rb') as fin:
+        file_data = fin.read()
+
+    decompressors = [
+        ('heatshrink', PreviousHeatshrinkDecompressor, HeatshrinkDecompressor),
+        ('lz4',
+         lambda _: PreviousLz4Decompressor(),
+         lambda _: Lz4Decompressor())
+    ]
+
+    for compression, create_previous, create_current in decompressors:
+        print('{}:'.format(compression))
+
+        for scale in args.scales.split(','):
+            data = int(scale) * file_data
+            compressed = compress(compression, data)
+            megabytes = len(data) / 1000000
+            previous_time = measure(create_previous,
+                                    compressed,
+                                    data,
+                                    args.input_size,
+                                    args.read_size)
+            current_time = measure(create_current,
+                                   compressed,
+                                   data,
+                                   args.input_size,
+                                   args.read_size)
+            print('  {:5.1f} MB: previous {:.3f} s ({:.1f} MB/s), '
+                  'current {:.3f} s ({:.1f} MB/s)'.format(
+                      megabytes,
+                      previous_time,
+                      megabytes / previous_time,
+                      current_time,
+                      megabytes / current_time))
+
+
+if __name__ == '__main__':
+    main()
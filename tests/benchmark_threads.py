@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+#
+# Create the same patch a number of times, first sequentially and then
+# in a thread pool of increasing size, and print the elapsed times.
+#
+# $ python3 tests/benchmark_threads.py [<from-file> <to-file>]
+#
+
+import os
+import sys
+import time
+import argparse
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+
+sys.path.insert(0, os.path.join(SCRIPT_DIR, '..'))
+
+import detools
+
+
+def create_patch(from_data, to_data, compression):
+    fpatch = BytesIO()
+    detools.create_patch(BytesIO(from_data),
+                         BytesIO(to_data),
+                         fpatch,
+                         compression=compression,
+                         use_mmap=False)
+
+    return len(fpatch.getvalue())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-n', '--number-of-patches',
+        type=int,
+        default=8,
+        help='Number of patches to create (default: %(default)s).')
+    parser.add_argument(
+        '-c', '--compression',
+        default='lzma',
+        help='Compression (default: %(default)s).')
+    parser.add_argument(
+        'fromfile',
+        nargs='?',
+        default=os.path.join(SCRIPT_DIR,
+                             'files/micropython/esp8266-20180511-v1.9.4.bin'))
+    parser.add_argument(
+        'tofile',
+        nargs='?',
+        default=os.path.join(SCRIPT_DIR,
+                             'files/micropython/esp8266-20190125-v1.10.bin'))
+    args = parser.parse_args()
+
+    with open(args.fromfile, 'rb') as fin:
+        from_data = fin.read()
+
+    with open(args.tofile, 'rb') as fin:
+        to_data = fin.read()
+
+    print('From:          {}'.format(args.fromfile))
+    print('To:            {}'.format(args.tofile))
+    print('Patches:       {}'.format(args.number_of_patches))
+    print('CPUs:          {}'.format(os.cpu_count()))
+    print()
+
+    start_time = time.time()
+
+    for _ in range(args.number_of_patches):
+        create_patch(from_data, to_data, args.compression)
+
+    sequential_time = time.time() - start_time
+
+    print('Sequential:    {:.2f} s'.format(sequential_time))
+
+    threads = 1
+
+    while threads <= min(args.number_of_patches, os.cpu_count()):
+        start_time = time.time()
+
+        with ThreadPoolExecutor(threads) as executor:
+            list(executor.map(create_patch,
+                              args.number_of_patches * [from_data],
+                              args.number_of_patches * [to_data],
+                              args.number_of_patches * [args.compression]))
+
+        elapsed_time = time.time() - start_time
+
+        print('{:2} threads:    {:.2f} s (speedup {:.2f})'.format(
+            threads,
+            elapsed_time,
+            sequential_time / elapsed_time))
+        threads *= 2
+
+
+if __name__ == '__main__':
+    main()
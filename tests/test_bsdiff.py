@@ -2,6 +2,7 @@ import unittest
 import struct
 
 import detools.bsdiff
+import detools.suffix_array
 
 
 def read_file(filename):
@@ -72,6 +73,212 @@ class DetoolsBsdiffTest(unittest.TestCase):
                                             bytearray(4 * (len(from_data) + 1))),
                 chunks)
 
+    def test_bsdiff_repeated_data(self):
+        """Matches ending at the end of the from data, and matches longer
+        than the compared blocks.
+
+        """
+
+        datas = [
+            (
+                b'AAAA',
+                b'AAAAAAB',
+                [b'\x04', b'\x00\x00\x00\x00', b'\x03', b'AAB', b'\x44']
+            ),
+            (
+                b'abcabcabcx',
+                b'xabcabcabcabcab',
+                [
+                    b'\x00', b'', b'\x01', b'x', b'\x00',
+                    b'\x09', 9 * b'\x00', b'\x05', b'abcab', b'\x48'
+                ]
+            ),
+            (
+                1000 * b'A',
+                1300 * b'A' + b'B',
+                [
+                    b'\xa1\x0c', 801 * b'\x00', b'\x00', b'', b'\xe1\x0c',
+                    b'\xb3\x07', 499 * b'\x00', b'\x01', b'B', b'\xf3\x07'
+                ]
+            )
+        ]
+
+        for from_data, to_data, chunks in datas:
+            suffix_array = bytearray(4 * (len(from_data) + 1))
+            detools.suffix_array.divsufsort(from_data, suffix_array)
+            self.assertEqual(
+                detools.bsdiff.create_patch(suffix_array,
+                                            from_data,
+                                            to_data,
+                                            bytearray(len(to_data))),
+                chunks)
+
+    def test_bsdiff_64_bits_suffix_array(self):
+        from_data = read_file('tests/files/foo/old')
+        to_data = read_file('tests/files/foo/new')
+        suffix_array = bytearray(4 * (len(from_data) + 1))
+        detools.suffix_array.divsufsort(from_data, suffix_array)
+        expected = detools.bsdiff.create_patch(suffix_array,
+                                               from_data,
+                                               to_data,
+                                               bytearray(len(to_data)))
+        suffix_array = bytearray(8 * (len(from_data) + 1))
+        detools.suffix_array.divsufsort64(from_data, suffix_array)
+        self.assertEqual(
+            detools.bsdiff.create_patch(suffix_array,
+                                        from_data,
+                                        to_data,
+                                        bytearray(len(to_data))),
+            expected)
+
+    def test_bsdiff_iter(self):
+        datas = [
+            ('tests/files/foo/old', 'tests/files/foo/new'),
+            ('tests/files/micropython/esp8266-20180511-v1.9.4.bin',
+             'tests/files/micropython/esp8266-20190125-v1.10.bin'),
+            ('tests/files/foo/old', 'tests/files/foo/old'),
+            ('tests/files/empty/nonempty.bin', 'tests/files/empty/new')
+        ]
+
+        for from_filename, to_filename in datas:
+            from_data = read_file(from_filename)
+            to_data = read_file(to_filename)
+
+            for item_size, create in [(4, detools.suffix_array.divsufsort),
+                                      (8, detools.suffix_array.divsufsort64)]:
+                suffix_array = bytearray(item_size * (len(from_data) + 1))
+                create(from_data, suffix_array)
+                expected = detools.bsdiff.create_patch(
+                    suffix_array,
+                    from_data,
+                    to_data,
+                    bytearray(len(to_data) + 1))
+                chunks = detools.bsdiff.create_patch_iter(suffix_array,
+                                                          from_data,
+                                                          to_data)
+                self.assertEqual(b''.join(chunks), b''.join(expected))
+                self.assertEqual(list(chunks), [])
+
+    def test_bsdiff_bad_suffix_array_size(self):
+        with self.assertRaises(ValueError) as cm:
+            detools.bsdiff.create_patch(bytearray(12),
+                                        b'1234',
+                                        b'1234',
+                                        bytearray(4))
+
+        self.assertEqual(str(cm.exception), 'Bad suffix array size.')
+
+        with self.assertRaises(ValueError) as cm:
+            detools.bsdiff.create_patch_iter(bytearray(12), b'1234', b'1234')
+
+        self.assertEqual(str(cm.exception), 'Bad suffix array size.')
+
+    def test_bsdiff_bad_options(self):
+        datas = [
+            ((-1, 0), 'Negative minimum match.'),
+            ((8, -1), 'Negative skip ahead size.')
+        ]
+
+        for options, message in datas:
+            with self.assertRaises(ValueError) as cm:
+                detools.bsdiff.create_patch(bytearray(8),
+                                            b'1',
+                                            b'1',
+                                            bytearray(1),
+                                            *options)
+
+            self.assertEqual(str(cm.exception), message)
+
+            with self.assertRaises(ValueError) as cm:
+                detools.bsdiff.create_patch_iter(bytearray(8),
+                                                 b'1',
+                                                 b'1',
+                                                 *options)
+
+            self.assertEqual(str(cm.exception), message)
+
+    def test_content_defined_chunks(self):
+        data = read_file('tests/files/micropython/esp8266-20190125-v1.10.bin')
+        ends = detools.bsdiff.content_defined_chunks(data, 12, 1024, 65536)
+        sizes = [end - begin for begin, end in zip([0] + ends, ends)]
+
+        self.assertEqual(ends[-1], len(data))
+        self.assertTrue(all(1024 <= size <= 65536 for size in sizes[:-1]))
+
+        # Chunks after inserted data are the same as before.
+        moved_ends = detools.bsdiff.content_defined_chunks(b'0123' + data,
+                                                           12,
+                                                           1024,
+                                                           65536)
+        self.assertEqual([end - 4 for end in moved_ends[3:]], ends[3:])
+
+        # Empty data and chunks of maximum size.
+        self.assertEqual(
+            detools.bsdiff.content_defined_chunks(b'', 12, 1024, 65536),
+            [])
+        self.assertEqual(
+            detools.bsdiff.content_defined_chunks(10 * b'1', 12, 4, 4),
+            [4, 8, 10])
+
+    def test_content_defined_chunks_bad_arguments(self):
+        datas = [
+            ((0, 1, 2), 'Bad average size bits.'),
+            ((64, 1, 2), 'Bad average size bits.'),
+            ((12, 3, 2), 'Bad chunk sizes.'),
+            ((12, 0, 0), 'Bad chunk sizes.')
+        ]
+
+        for arguments, message in datas:
+            with self.assertRaises(ValueError) as cm:
+                detools.bsdiff.content_defined_chunks(b'1', *arguments)
+
+            self.assertEqual(str(cm.exception), message)
+
+    def test_add_bytes(self):
+        # Sizes around the 8 bytes word size and the GIL release limit.
+        for size in [0, 1, 7, 8, 9, 15, 16, 17, 100, 8191, 8192, 10000]:
+            a = bytes([(7 * i) % 256 for i in range(size)])
+            b = bytes([(255 - 3 * i) % 256 for i in range(size)])
+            expected = bytes([(x + y) % 256 for x, y in zip(a, b)])
+
+            self.assertEqual(detools.bsdiff.add_bytes(a, b), expected)
+
+            dst = bytearray(size)
+            detools.bsdiff.add_bytes_into(dst, a, b)
+            self.assertEqual(dst, expected)
+
+            dst = bytearray(a)
+            detools.bsdiff.add_bytes_into(dst, dst, b)
+            self.assertEqual(dst, expected)
+
+            dst = bytearray(a)
+            detools.bsdiff.add_bytes_inplace(dst, b)
+            self.assertEqual(dst, expected)
+
+            # Unaligned buffers.
+            dst = bytearray(size + 1)
+            detools.bsdiff.add_bytes_into(memoryview(dst)[1:], a, b)
+            self.assertEqual(dst[1:], expected)
+
+    def test_add_bytes_bad_lengths(self):
+        with self.assertRaises(ValueError) as cm:
+            detools.bsdiff.add_bytes(b'12', b'1')
+
+        self.assertEqual(str(cm.exception), 'Lengths must be equal.')
+
+        with self.assertRaises(ValueError) as cm:
+            detools.bsdiff.add_bytes_into(bytearray(2), b'12', b'1')
+
+        self.assertEqual(str(cm.exception), 'Lengths must be equal.')
+
+        with self.assertRaises(ValueError) as cm:
+            detools.bsdiff.add_bytes_inplace(bytearray(2), b'1')
+
+        self.assertEqual(str(cm.exception), 'Lengths must be equal.')
+
+        with self.assertRaises(BufferError):
+            detools.bsdiff.add_bytes_inplace(b'12', b'12')
+
 
 if __name__ == '__main__':
     unittest.main()
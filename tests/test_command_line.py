@@ -1,5 +1,6 @@
 import os
 import unittest
+import tempfile
 from unittest.mock import patch
 from io import StringIO
 
@@ -13,6 +14,18 @@ def read_file(filename):
 
 class DetoolsCommandLineTest(unittest.TestCase):
 
+    def setUp(self):
+        output_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(output_dir.cleanup)
+        self.output_dir = output_dir.name
+
+    def output_file(self, name):
+        """Returns the path of given output file in a temporary directory.
+
+        """
+
+        return os.path.join(self.output_dir, name)
+
     def execute_and_assert(self, argv, actual_file, expected_file):
         if os.path.exists(actual_file):
             os.remove(actual_file)
@@ -23,7 +36,7 @@ class DetoolsCommandLineTest(unittest.TestCase):
         self.assertEqual(read_file(actual_file), read_file(expected_file))
 
     def test_create_patch_foo(self):
-        foo_patch = 'foo.patch'
+        foo_patch = self.output_file('foo.patch')
         argv = [
             'detools',
             'create_patch',
@@ -34,8 +47,75 @@ class DetoolsCommandLineTest(unittest.TestCase):
 
         self.execute_and_assert(argv, foo_patch, 'tests/files/foo/patch')
 
+    def test_create_patch_foo_suffix_array_cache(self):
+        foo_patch = self.output_file('foo.patch')
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            argv = [
+                'detools',
+                'create_patch',
+                '--suffix-array-cache-dir', cache_dir,
+                '--suffix-array-cache-size', '1M',
+                'tests/files/foo/old',
+                'tests/files/foo/new',
+                foo_patch
+            ]
+
+            for _ in range(2):
+                self.execute_and_assert(argv, foo_patch, 'tests/files/foo/patch')
+
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+    def test_create_patches_foo(self):
+        foo_patch = self.output_file('foo.patch')
+        foo_2_patch = self.output_file('foo-2.patch')
+        argv = [
+            'detools',
+            'create_patches',
+            '-j', '2',
+            'tests/files/foo/old',
+            'tests/files/foo/new', foo_patch,
+            'tests/files/foo/new', foo_2_patch
+        ]
+
+        self.execute_and_assert(argv, foo_patch, 'tests/files/foo/patch')
+        self.assertEqual(read_file(foo_2_patch),
+                         read_file('tests/files/foo/patch'))
+
+    def test_create_patches_foo_processes(self):
+        foo_patch = self.output_file('foo.patch')
+        foo_2_patch = self.output_file('foo-2.patch')
+        argv = [
+            'detools',
+            'create_patches',
+            '-j', '2',
+            '--processes',
+            'tests/files/foo/old',
+            'tests/files/foo/new', foo_patch,
+            'tests/files/foo/new', foo_2_patch
+        ]
+
+        self.execute_and_assert(argv, foo_patch, 'tests/files/foo/patch')
+        self.assertEqual(read_file(foo_2_patch),
+                         read_file('tests/files/foo/patch'))
+
+    def test_create_patches_odd_number_of_files(self):
+        argv = [
+            'detools',
+            'create_patches',
+            'tests/files/foo/old',
+            'tests/files/foo/new'
+        ]
+
+        with patch('sys.argv', argv):
+            with self.assertRaises(SystemExit) as cm:
+                detools._main()
+
+            self.assertEqual(str(cm.exception),
+                             'error: Expected pairs of to and patch files.')
+
     def test_create_patch_foo_heatshrink(self):
-        foo_patch = 'foo.patch'
+        foo_patch = self.output_file('foo.patch')
         argv = [
             'detools',
             'create_patch',
@@ -48,7 +128,7 @@ class DetoolsCommandLineTest(unittest.TestCase):
         self.execute_and_assert(argv, foo_patch, 'tests/files/foo/heatshrink.patch')
 
     def test_create_patch_foo_heatshrink_custom(self):
-        foo_patch = 'foo.patch'
+        foo_patch = self.output_file('foo.patch')
         argv = [
             'detools',
             'create_patch',
@@ -63,7 +143,7 @@ class DetoolsCommandLineTest(unittest.TestCase):
         self.execute_and_assert(argv, foo_patch, 'tests/files/foo/heatshrink-10-5.patch')
 
     def test_create_patch_foo_hdiffpatch_no_mmap(self):
-        foo_patch = 'foo.patch'
+        foo_patch = self.output_file('foo.patch')
         argv = [
             'detools',
             'create_patch',
@@ -77,8 +157,46 @@ class DetoolsCommandLineTest(unittest.TestCase):
 
         self.execute_and_assert(argv, foo_patch, 'tests/files/foo/hdiffpatch.patch')
 
+    def test_create_patch_foo_cdc_bsdiff(self):
+        foo_patch = self.output_file('foo.patch')
+        foo_new = self.output_file('foo.new')
+        argv = [
+            'detools',
+            'create_patch',
+            '-a', 'cdc-bsdiff',
+            'tests/files/foo/old',
+            'tests/files/foo/new',
+            foo_patch
+        ]
+
+        with patch('sys.argv', argv):
+            detools._main()
+
+        argv = [
+            'detools',
+            'apply_patch',
+            'tests/files/foo/old',
+            foo_patch,
+            foo_new
+        ]
+
+        self.execute_and_assert(argv, foo_new, 'tests/files/foo/new')
+
+    def test_create_patch_foo_max_memory(self):
+        foo_patch = self.output_file('foo.patch')
+        argv = [
+            'detools',
+            'create_patch',
+            '--max-memory', '1M',
+            'tests/files/foo/old',
+            'tests/files/foo/new',
+            foo_patch
+        ]
+
+        self.execute_and_assert(argv, foo_patch, 'tests/files/foo/patch')
+
     def test_create_patch_foo_no_mmap(self):
-        foo_patch = 'foo.patch'
+        foo_patch = self.output_file('foo.patch')
         argv = [
             'detools',
             'create_patch',
@@ -91,7 +209,7 @@ class DetoolsCommandLineTest(unittest.TestCase):
         self.execute_and_assert(argv, foo_patch, 'tests/files/foo/patch')
 
     def test_create_patch_empty_from_non_empty_to_mmap(self):
-        nonempty_patch = 'nonempty.patch'
+        nonempty_patch = self.output_file('nonempty.patch')
         argv = [
             'detools',
             'create_patch',
@@ -105,7 +223,7 @@ class DetoolsCommandLineTest(unittest.TestCase):
                                 'tests/files/empty/nonempty.patch')
 
     def test_create_patch_foo_sais(self):
-        foo_patch = 'foo.patch'
+        foo_patch = self.output_file('foo.patch')
         argv = [
             'detools',
             'create_patch',
@@ -118,7 +236,7 @@ class DetoolsCommandLineTest(unittest.TestCase):
         self.execute_and_assert(argv, foo_patch, 'tests/files/foo/patch')
 
     def test_apply_patch_foo(self):
-        foo_new = 'foo.new'
+        foo_new = self.output_file('foo.new')
         argv = [
             'detools',
             '--debug',
@@ -130,6 +248,48 @@ class DetoolsCommandLineTest(unittest.TestCase):
 
         self.execute_and_assert(argv, foo_new, 'tests/files/foo/new')
 
+    def test_apply_patch_foo_engines(self):
+        foo_new = self.output_file('foo.new')
+
+        for engine in ['c', 'python']:
+            argv = [
+                'detools',
+                'apply_patch',
+                '--engine', engine,
+                'tests/files/foo/old',
+                'tests/files/foo/patch',
+                foo_new
+            ]
+
+            self.execute_and_assert(argv, foo_new, 'tests/files/foo/new')
+
+    def test_apply_patch_foo_mmap(self):
+        foo_new = self.output_file('foo.new')
+        argv = [
+            'detools',
+            'apply_patch',
+            '--mmap',
+            'tests/files/foo/old',
+            'tests/files/foo/patch',
+            foo_new
+        ]
+
+        self.execute_and_assert(argv, foo_new, 'tests/files/foo/new')
+
+    def test_apply_patch_foo_hdiffpatch_mmap(self):
+        foo_new = self.output_file('foo.new')
+        argv = [
+            'detools',
+            'apply_patch',
+            '--mmap',
+            '--hdiffpatch-cache-size', '1M',
+            'tests/files/foo/old',
+            'tests/files/foo/hdiffpatch.patch',
+            foo_new
+        ]
+
+        self.execute_and_assert(argv, foo_new, 'tests/files/foo/new')
+
     def test_patch_info_foo(self):
         argv = [
             'detools',
@@ -292,7 +452,7 @@ class DetoolsCommandLineTest(unittest.TestCase):
                          'Median extra size:  14 bytes\n')
 
     def test_create_patch_foo_in_place(self):
-        foo_patch = 'foo-in-place-3000-1500.patch'
+        foo_patch = self.output_file('foo-in-place-3000-1500.patch')
         argv = [
             'detools',
             'create_patch_in_place',
@@ -307,8 +467,58 @@ class DetoolsCommandLineTest(unittest.TestCase):
                                 foo_patch,
                                 'tests/files/foo/in-place-3000-1500.patch')
 
+    def test_create_patch_foo_in_place_jobs(self):
+        foo_patch = self.output_file('foo-in-place-3000-1500.patch')
+        argv = [
+            'detools',
+            'create_patch_in_place',
+            '--memory-size', '3000',
+            '--segment-size', '1500',
+            '-j', '2',
+            'tests/files/foo/old',
+            'tests/files/foo/new',
+            foo_patch
+        ]
+
+        self.execute_and_assert(argv,
+                                foo_patch,
+                                'tests/files/foo/in-place-3000-1500.patch')
+
+    def test_create_patch_foo_compression_level(self):
+        foo_patch = self.output_file('foo.patch')
+        argv = [
+            'detools',
+            'create_patch',
+            '--compression', 'zstd',
+            '--compression-level', '22',
+            '--compression-threads', '1',
+            'tests/files/foo/old',
+            'tests/files/foo/new',
+            foo_patch
+        ]
+
+        self.execute_and_assert(argv,
+                                foo_patch,
+                                'tests/files/foo/zstd.patch')
+
+    def test_create_patch_foo_min_match_and_skip_ahead_size(self):
+        foo_patch = self.output_file('foo.patch')
+        argv = [
+            'detools',
+            'create_patch',
+            '--min-match', '8',
+            '--skip-ahead-size', '0',
+            'tests/files/foo/old',
+            'tests/files/foo/new',
+            foo_patch
+        ]
+
+        self.execute_and_assert(argv,
+                                foo_patch,
+                                'tests/files/foo/patch')
+
     def test_apply_patch_foo_in_place(self):
-        foo_mem = 'foo.mem'
+        foo_mem = self.output_file('foo.mem')
         argv = [
             'detools',
             '--debug',
@@ -454,7 +664,7 @@ class DetoolsCommandLineTest(unittest.TestCase):
             '\n')
 
     def test_create_patch_foo_in_place_size_units(self):
-        foo_patch = 'foo-in-place-3k-1.5k.patch'
+        foo_patch = self.output_file('foo-in-place-3k-1.5k.patch')
         argv = [
             'detools',
             'create_patch_in_place',
@@ -475,7 +685,7 @@ class DetoolsCommandLineTest(unittest.TestCase):
                          read_file('tests/files/foo/in-place-3k-1.5k.patch'))
 
     def test_apply_patch_foo_in_place_size_units(self):
-        foo_mem = 'foo.mem'
+        foo_mem = self.output_file('foo.mem')
         argv = [
             'detools',
             '--debug',
@@ -717,7 +927,7 @@ class DetoolsCommandLineTest(unittest.TestCase):
             'Median extra size:  0 bytes\n')
 
     def test_create_patch_pybv11_arm_cortex_m4(self):
-        pybv11_patch = 'pybv11-aarch64.patch'
+        pybv11_patch = self.output_file('pybv11-aarch64.patch')
         argv = [
             'detools',
             'create_patch',
@@ -739,7 +949,7 @@ class DetoolsCommandLineTest(unittest.TestCase):
                       'arm-cortex-m4.patch'))
 
     def test_create_patch_pybv11_data_sections(self):
-        pybv11_patch = 'pybv11-data-format-with-data-sections.patch'
+        pybv11_patch = self.output_file('pybv11-data-format-with-data-sections.patch')
         argv = [
             'detools',
             'create_patch',
@@ -767,7 +977,7 @@ class DetoolsCommandLineTest(unittest.TestCase):
                       'arm-cortex-m4-data-sections.patch'))
 
     def test_create_patch_pybv11_elf_data_sections(self):
-        pybv11_patch = 'pybv11-data-format-with-elf-data-sections.patch'
+        pybv11_patch = self.output_file('pybv11-data-format-with-elf-data-sections.patch')
         argv = [
             'detools',
             'create_patch',
@@ -808,7 +1018,7 @@ class DetoolsCommandLineTest(unittest.TestCase):
                 "'tests/files/pybv11/1f5d945af/firmware1.bin'.")
 
     def test_create_patch_pybv11_elf_data_sections_offsets(self):
-        pybv11_patch = 'pybv11-data-format-with-elf-data-sections-offsets.patch'
+        pybv11_patch = self.output_file('pybv11-data-format-with-elf-data-sections-offsets.patch')
         argv = [
             'detools',
             'create_patch',
@@ -828,7 +1038,7 @@ class DetoolsCommandLineTest(unittest.TestCase):
                                 'arm-cortex-m4-elf-data-sections.patch')
 
     def test_apply_patch_pybv11_elf_data_sections(self):
-        pybv11_new = 'pybv11-elf-data-sections.new'
+        pybv11_new = self.output_file('pybv11-elf-data-sections.new')
         argv = [
             'detools',
             '--debug',
@@ -2039,7 +2249,7 @@ class DetoolsCommandLineTest(unittest.TestCase):
             '\n')
 
     def test_create_patch_foo_bsdiff(self):
-        foo_patch = 'foo.patch'
+        foo_patch = self.output_file('foo.patch')
         argv = [
             'detools',
             'create_patch_bsdiff',
@@ -2051,7 +2261,7 @@ class DetoolsCommandLineTest(unittest.TestCase):
         self.execute_and_assert(argv, foo_patch, 'tests/files/foo/bsdiff.patch')
 
     def test_apply_patch_foo_bsdiff(self):
-        foo_new = 'foo.new'
+        foo_new = self.output_file('foo.new')
         argv = [
             'detools',
             'apply_patch_bsdiff',
@@ -2063,7 +2273,7 @@ class DetoolsCommandLineTest(unittest.TestCase):
         self.execute_and_assert(argv, foo_new, 'tests/files/foo/new')
 
     def test_create_patch_foo_hdiffpatch(self):
-        foo_patch = 'foo.patch'
+        foo_patch = self.output_file('foo.patch')
         argv = [
             'detools',
             'create_patch',
@@ -2077,7 +2287,7 @@ class DetoolsCommandLineTest(unittest.TestCase):
         self.execute_and_assert(argv, foo_patch, 'tests/files/foo/hdiffpatch.patch')
 
     def test_create_patch_foo_hdiffpatch_none(self):
-        foo_patch = 'foo.patch'
+        foo_patch = self.output_file('foo.patch')
         argv = [
             'detools',
             'create_patch',
@@ -2094,7 +2304,7 @@ class DetoolsCommandLineTest(unittest.TestCase):
                                 'tests/files/foo/hdiffpatch-none.patch')
 
     def test_create_patch_foo_hdiffpatch_match_score_0(self):
-        foo_patch = 'foo.patch'
+        foo_patch = self.output_file('foo.patch')
         argv = [
             'detools',
             'create_patch',
@@ -2111,7 +2321,7 @@ class DetoolsCommandLineTest(unittest.TestCase):
                                 'tests/files/foo/hdiffpatch-match-score-0.patch')
 
     def test_create_patch_foo_hdiffpatch_match_block_size_64(self):
-        foo_patch = 'foo.patch'
+        foo_patch = self.output_file('foo.patch')
         argv = [
             'detools',
             'create_patch',
@@ -2129,7 +2339,7 @@ class DetoolsCommandLineTest(unittest.TestCase):
             'tests/files/foo/hdiffpatch-match-block-size-64.patch')
 
     def test_apply_patch_foo_hdiffpatch(self):
-        foo_new = 'foo.new'
+        foo_new = self.output_file('foo.new')
         argv = [
             'detools',
             'apply_patch',
@@ -2141,7 +2351,7 @@ class DetoolsCommandLineTest(unittest.TestCase):
         self.execute_and_assert(argv, foo_new, 'tests/files/foo/new')
 
     def test_apply_patch_foo_hdiffpatch_none(self):
-        foo_new = 'foo.new'
+        foo_new = self.output_file('foo.new')
         argv = [
             'detools',
             'apply_patch',
@@ -0,0 +1,34 @@
+import unittest
+
+from detools.compression.utils import OutputBuffer
+
+
+class DetoolsCompressionUtilsTest(unittest.TestCase):
+
+    def test_output_buffer(self):
+        buf = OutputBuffer()
+
+        self.assertEqual(len(buf), 0)
+        self.assertEqual(buf.read(1), b'')
+
+        buf.append(b'')
+        buf.append(b'ABC')
+        buf.append(bytearray(b'DE'))
+        buf.append(b'FGHI')
+
+        self.assertEqual(len(buf), 9)
+        self.assertEqual(buf.read(2), b'AB')
+        self.assertEqual(buf.read(0), b'')
+        self.assertEqual(buf.read(4), b'CDEF')
+        self.assertEqual(len(buf), 3)
+
+        buf.append(b'J')
+
+        self.assertEqual(buf.read(1), b'G')
+        self.assertEqual(buf.read(10), b'HIJ')
+        self.assertEqual(len(buf), 0)
+        self.assertEqual(buf.read(10), b'')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,18 @@
+import random
 import unittest
 
 import detools
 from detools.create import CrleCompressor
 from detools.apply import CrleDecompressor
+from detools.compression.crle import PythonCrleCompressor
+from detools.compression.crle import PythonCrleDecompressor
 
 
 class DetoolsCrleTest(unittest.TestCase):
 
+    COMPRESSOR = CrleCompressor
+    DECOMPRESSOR = CrleDecompressor
+
     def test_compress(self):
         datas = [
             (                       [b''], b'\x00\x00'),
@@ -23,7 +29,7 @@ class DetoolsCrleTest(unittest.TestCase):
         ]
 
         for chunks, compressed in datas:
-            compressor = CrleCompressor()
+            compressor = self.COMPRESSOR()
             data = b''
 
             for chunk in chunks:
@@ -36,7 +42,7 @@ class DetoolsCrleTest(unittest.TestCase):
     def test_decompress_no_data(self):
         compressed = b'\x00\x00'
 
-        decompressor = CrleDecompressor(len(compressed))
+        decompressor = self.DECOMPRESSOR(len(compressed))
 
         self.assertEqual(decompressor.needs_input, True)
         self.assertEqual(decompressor.decompress(compressed, 1), b'')
@@ -57,7 +63,7 @@ class DetoolsCrleTest(unittest.TestCase):
         ]
 
         for chunks, decompressed in datas:
-            decompressor = CrleDecompressor(sum([len(c) for c in chunks]))
+            decompressor = self.DECOMPRESSOR(sum([len(c) for c in chunks]))
 
             for chunk in chunks:
                 self.assertEqual(decompressor.needs_input, True)
@@ -74,7 +80,7 @@ class DetoolsCrleTest(unittest.TestCase):
             self.assertEqual(data, decompressed)
 
     def test_decompress_bad_kind(self):
-        decompressor = CrleDecompressor(3)
+        decompressor = self.DECOMPRESSOR(3)
 
         with self.assertRaises(detools.Error) as cm:
             decompressor.decompress(b'\x02\x01A', 1)
@@ -85,7 +91,7 @@ class DetoolsCrleTest(unittest.TestCase):
 
     def test_decompress_at_eof(self):
         compressed = b'\x00\x01A'
-        decompressor = CrleDecompressor(len(compressed))
+        decompressor = self.DECOMPRESSOR(len(compressed))
 
         self.assertEqual(decompressor.decompress(compressed, 1), b'A')
         self.assertEqual(decompressor.eof, True)
@@ -102,11 +108,60 @@ class DetoolsCrleTest(unittest.TestCase):
 
     def test_decompress_ignore_extra_data(self):
         compressed = b'\x00\x01A'
-        decompressor = CrleDecompressor(len(compressed))
+        decompressor = self.DECOMPRESSOR(len(compressed))
 
         self.assertEqual(decompressor.decompress(compressed + b'B', 1), b'A')
         self.assertEqual(decompressor.eof, True)
 
+    def test_compress_and_decompress_random(self):
+        """Random data with many short and long repeated segments,
+        compressed and decompressed in chunks of random sizes, must
+        give the same result as the Python implementation.
+
+        """
+
+        rand = random.Random(0)
+        data = b''.join([rand.randint(1, 10) * bytes([rand.randint(0, 3)])
+                         for _ in range(20000)])
+        expected = PythonCrleCompressor()
+        expected = expected.compress(data) + expected.flush()
+
+        for _ in range(5):
+            compressor = self.COMPRESSOR()
+            compressed = []
+            offset = 0
+
+            while offset < len(data):
+                size = rand.randint(0, 100)
+                compressed.append(compressor.compress(data[offset:offset + size]))
+                offset += size
+
+            compressed.append(compressor.flush())
+            compressed = b''.join(compressed)
+            self.assertEqual(compressed, expected)
+
+            decompressor = self.DECOMPRESSOR(len(compressed))
+            decompressed = []
+            offset = 0
+
+            while not decompressor.eof:
+                if decompressor.needs_input:
+                    size = rand.randint(1, 100)
+                    chunk = compressed[offset:offset + size]
+                    offset += size
+                else:
+                    chunk = b''
+
+                decompressed.append(decompressor.decompress(chunk, 37))
+
+            self.assertEqual(b''.join(decompressed), data)
+
+
+class DetoolsPythonCrleTest(DetoolsCrleTest):
+
+    COMPRESSOR = PythonCrleCompressor
+    DECOMPRESSOR = PythonCrleDecompressor
+
 
 if __name__ == '__main__':
     unittest.main()
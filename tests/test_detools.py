@@ -1,10 +1,25 @@
+import os
+import time
+import random
 import logging
+import threading
 import unittest
+import tempfile
+import tracemalloc
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
 
 import detools
 from detools.common import pack_size
 from detools.common import unpack_size_bytes
+from detools.create import execute_within_memory_limit
+from detools.create import ChunksProducer
+
+
+def read_file(filename):
+    with open(filename, 'rb') as fin:
+        return fin.read()
 
 
 class DetoolsTest(unittest.TestCase):
@@ -34,13 +49,14 @@ class DetoolsTest(unittest.TestCase):
                            patch_filename,
                            **kwargs):
         patch_type = kwargs.get('patch_type', 'sequential')
+        engine = kwargs.get('engine', 'auto')
 
         if patch_type in ['sequential', 'hdiffpatch']:
             fto = BytesIO()
 
             with open(from_filename, 'rb') as ffrom:
                 with open(patch_filename, 'rb') as fpatch:
-                    to_size = detools.apply_patch(ffrom, fpatch, fto)
+                    to_size = detools.apply_patch(ffrom, fpatch, fto, engine)
 
             actual = fto.getvalue()
         elif patch_type == 'in-place':
@@ -53,7 +69,7 @@ class DetoolsTest(unittest.TestCase):
             fmem = BytesIO(data)
 
             with open(patch_filename, 'rb') as fpatch:
-                to_size = detools.apply_patch_in_place(fmem, fpatch)
+                to_size = detools.apply_patch_in_place(fmem, fpatch, engine)
 
             actual = fmem.getvalue()[:to_size]
         elif patch_type == 'bsdiff':
@@ -428,6 +444,369 @@ class DetoolsTest(unittest.TestCase):
             memory_size=3000,
             segment_size=50)
 
+    def test_create_and_apply_patch_foo_in_place_many_segments_jobs(self):
+        for jobs in [2, None]:
+            for use_mmap in [True, False]:
+                self.assert_create_and_apply_patch(
+                    'tests/files/foo/old',
+                    'tests/files/foo/new',
+                    'tests/files/foo/in-place-many-segments.patch',
+                    patch_type='in-place',
+                    memory_size=3000,
+                    segment_size=50,
+                    jobs=jobs,
+                    use_mmap=use_mmap)
+
+    def test_create_and_apply_patch_compression_pipeline(self):
+        # Tiny batches and queue to exercise the pipeline between the
+        # bsdiff and compression threads.
+        with patch('detools.create.COMPRESSION_BATCH_SIZE', 1):
+            with patch('detools.create.COMPRESSION_QUEUE_SIZE', 1):
+                self.assert_create_and_apply_patch(
+                    'tests/files/micropython/esp8266-20180511-v1.9.4.bin',
+                    'tests/files/micropython/esp8266-20190125-v1.10.bin',
+                    'tests/files/micropython/esp8266-20180511-v1.9.4--20190125-v1.10.patch')
+
+    def test_create_patch_compression_error(self):
+        fpatch = BytesIO()
+
+        with patch('detools.create.COMPRESSION_BATCH_SIZE', 1):
+            with patch('detools.create.COMPRESSION_QUEUE_SIZE', 1):
+                with patch('detools.create.NoneCompressor.compress',
+                           side_effect=ValueError('Compression failed.')):
+                    with self.assertRaises(ValueError) as cm:
+                        with open('tests/files/foo/old', 'rb') as fold:
+                            with open('tests/files/foo/new', 'rb') as fnew:
+                                detools.create_patch(fold,
+                                                     fnew,
+                                                     fpatch,
+                                                     compression='none')
+
+        self.assertEqual(str(cm.exception), 'Compression failed.')
+
+    def test_create_patch_bsdiff_error(self):
+        fpatch = BytesIO()
+
+        with patch('detools.create.bsdiff.create_patch_iter',
+                   side_effect=ValueError('Bsdiff failed.')):
+            with self.assertRaises(ValueError) as cm:
+                with open('tests/files/foo/old', 'rb') as fold:
+                    with open('tests/files/foo/new', 'rb') as fnew:
+                        detools.create_patch(fold, fnew, fpatch)
+
+        self.assertEqual(str(cm.exception), 'Bsdiff failed.')
+
+    def test_create_and_apply_patch_compression_level(self):
+        datas = [
+            ('lzma', [0, 6, 9]),
+            ('bz2', [1, 9]),
+            ('zstd', [1, 22]),
+            ('lz4', [0, 16])
+        ]
+        from_data = read_file('tests/files/foo/old')
+        to_data = read_file('tests/files/foo/new')
+
+        for compression, compression_levels in datas:
+            for compression_level in compression_levels:
+                for compression_threads in [1, 2, None]:
+                    fpatch = BytesIO()
+                    detools.create_patch(
+                        BytesIO(from_data),
+                        BytesIO(to_data),
+                        fpatch,
+                        compression=compression,
+                        compression_level=compression_level,
+                        compression_threads=compression_threads)
+                    fto = BytesIO()
+                    detools.apply_patch(BytesIO(from_data),
+                                        BytesIO(fpatch.getvalue()),
+                                        fto)
+                    self.assertEqual(fto.getvalue(), to_data)
+
+        # Default levels.
+        datas = [
+            ('lzma', 6, 'tests/files/foo/patch'),
+            ('zstd', 22, 'tests/files/foo/zstd.patch')
+        ]
+
+        for compression, compression_level, patch_filename in datas:
+            fpatch = BytesIO()
+            detools.create_patch(BytesIO(from_data),
+                                 BytesIO(to_data),
+                                 fpatch,
+                                 compression=compression,
+                                 compression_level=compression_level)
+            self.assertEqual(fpatch.getvalue(), read_file(patch_filename))
+
+    def test_create_patch_in_place_data_format_compression_level(self):
+        from_data = read_file(
+            'tests/files/micropython/esp8266-20180511-v1.9.4.bin')
+        to_data = read_file('tests/files/micropython/esp8266-20190125-v1.10.bin')
+        fpatches = []
+
+        # Applying in-place patches with a data format is not yet
+        # implemented, so only create them.
+        for compression_level in [None, 6, 9]:
+            fpatch = BytesIO()
+            detools.create_patch(BytesIO(from_data),
+                                 BytesIO(to_data),
+                                 fpatch,
+                                 patch_type='in-place',
+                                 memory_size=2097152,
+                                 segment_size=65536,
+                                 data_format='xtensa-lx106',
+                                 compression_level=compression_level,
+                                 compression_threads=2)
+            fpatches.append(fpatch.getvalue())
+
+        self.assertEqual(fpatches[1], fpatches[0])
+        self.assertNotEqual(fpatches[2], fpatches[0])
+
+    def test_create_patch_bad_compression_level(self):
+        datas = [
+            ('lzma', 10, 1, 'Expected lzma compression level 0..9, but got 10.'),
+            ('bz2', 0, 1, 'Expected bz2 compression level 1..9, but got 0.'),
+            ('zstd', 23, 1, 'Expected zstd compression level 1..22, but got 23.'),
+            ('crle',
+             1,
+             1,
+             'Compression level is not supported by crle compression.'),
+            ('zstd',
+             None,
+             0,
+             'Expected at least one compression thread, but got 0.')
+        ]
+
+        for compression, compression_level, compression_threads, message in datas:
+            with self.assertRaises(detools.Error) as cm:
+                detools.create_patch(BytesIO(b'1'),
+                                     BytesIO(b'2'),
+                                     BytesIO(),
+                                     compression=compression,
+                                     compression_level=compression_level,
+                                     compression_threads=compression_threads)
+
+            self.assertEqual(str(cm.exception), message)
+
+    def test_create_and_apply_patch_min_match_and_skip_ahead_size(self):
+        from_data = read_file(
+            'tests/files/micropython/esp8266-20180511-v1.9.4.bin')
+        to_data = read_file(
+            'tests/files/micropython/esp8266-20190125-v1.10.bin')
+        datas = [
+            ('sequential', {}),
+            ('in-place', {'memory_size': 1048576, 'segment_size': 65536}),
+            ('bsdiff', {})
+        ]
+
+        for patch_type, kwargs in datas:
+            for min_match, skip_ahead_size in [(0, 0), (16, 0), (8, 64)]:
+                fpatch = BytesIO()
+                detools.create_patch(BytesIO(from_data),
+                                     BytesIO(to_data),
+                                     fpatch,
+                                     compression='none',
+                                     patch_type=patch_type,
+                                     min_match=min_match,
+                                     skip_ahead_size=skip_ahead_size,
+                                     **kwargs)
+                fpatch.seek(0)
+
+                if patch_type == 'in-place':
+                    fmem = BytesIO(from_data
+                                   + (1048576 - len(from_data)) * b'\xff')
+                    detools.apply_patch_in_place(fmem, fpatch)
+                    to = fmem.getvalue()[:len(to_data)]
+                elif patch_type == 'bsdiff':
+                    fto = BytesIO()
+                    detools.apply_patch_bsdiff(BytesIO(from_data), fpatch, fto)
+                    to = fto.getvalue()
+                else:
+                    fto = BytesIO()
+                    detools.apply_patch(BytesIO(from_data), fpatch, fto)
+                    to = fto.getvalue()
+
+                self.assertEqual(to, to_data)
+
+        # The defaults create the same patch as before.
+        fpatch = BytesIO()
+        detools.create_patch(BytesIO(from_data),
+                             BytesIO(to_data),
+                             fpatch,
+                             min_match=8,
+                             skip_ahead_size=0)
+        self.assertEqual(
+            fpatch.getvalue(),
+            read_file('tests/files/micropython/'
+                      'esp8266-20180511-v1.9.4--20190125-v1.10.patch'))
+
+    def test_create_and_apply_patch_cdc_bsdiff(self):
+        rng = random.Random(0)
+        from_data = rng.randbytes(300000)
+        blocks = [from_data[i:i + 30000] for i in range(0, 300000, 30000)]
+        rng.shuffle(blocks)
+        shuffled = bytearray(b''.join(blocks))
+        shuffled[1000:1008] = rng.randbytes(5)
+        datas = [
+            (read_file('tests/files/foo/old'),
+             read_file('tests/files/foo/new')),
+            (read_file('tests/files/micropython/esp8266-20180511-v1.9.4.bin'),
+             read_file('tests/files/micropython/esp8266-20190125-v1.10.bin')),
+            (b'', b'12345'),
+            (b'12345', b''),
+            (from_data, from_data),
+            (from_data, bytes(shuffled)),
+            (from_data,
+             from_data[:100000] + rng.randbytes(3000) + from_data[150000:])
+        ]
+
+        for from_data, to_data in datas:
+            fpatch = BytesIO()
+            detools.create_patch(BytesIO(from_data),
+                                 BytesIO(to_data),
+                                 fpatch,
+                                 algorithm='cdc-bsdiff')
+
+            for engine in ['python', 'c']:
+                fto = BytesIO()
+                to_size = detools.apply_patch(BytesIO(from_data),
+                                              BytesIO(fpatch.getvalue()),
+                                              fto,
+                                              engine)
+                self.assertEqual(to_size, len(to_data))
+                self.assertEqual(fto.getvalue(), to_data)
+
+        # Moved blocks are copied.
+        self.assertLess(len(fpatch.getvalue()), 5000)
+
+    def test_create_patch_cdc_bsdiff_data_format(self):
+        with self.assertRaises(detools.Error) as cm:
+            detools.create_patch(BytesIO(b'12345'),
+                                 BytesIO(b'1234'),
+                                 BytesIO(),
+                                 algorithm='cdc-bsdiff',
+                                 data_format='arm-cortex-m4')
+
+        self.assertEqual(
+            str(cm.exception),
+            'Data formats are not supported by the cdc-bsdiff algorithm.')
+
+    def test_create_and_apply_patch_max_memory(self):
+        rng = random.Random(0)
+        from_data = rng.randbytes(3000000)
+        datas = [
+            (read_file('tests/files/micropython/esp8266-20180511-v1.9.4.bin'),
+             read_file('tests/files/micropython/esp8266-20190125-v1.10.bin')),
+            (b'12345', rng.randbytes(2000000)),
+            (from_data,
+             from_data[2000000:] + rng.randbytes(3000) + from_data[:2000000])
+        ]
+
+        for from_data, to_data in datas:
+            fpatch = BytesIO()
+
+            # The from and to data must be memory mapped to fit.
+            with tempfile.TemporaryDirectory() as tmpdir:
+                from_filename = os.path.join(tmpdir, 'from')
+                to_filename = os.path.join(tmpdir, 'to')
+
+                with open(from_filename, 'wb') as fout:
+                    fout.write(from_data)
+
+                with open(to_filename, 'wb') as fout:
+                    fout.write(to_data)
+
+                with open(from_filename, 'rb') as ffrom:
+                    with open(to_filename, 'rb') as fto:
+                        detools.create_patch(ffrom,
+                                             fto,
+                                             fpatch,
+                                             use_mmap=True,
+                                             max_memory=2097152)
+
+            for engine in ['python', 'c']:
+                fto = BytesIO()
+                to_size = detools.apply_patch(BytesIO(from_data),
+                                              BytesIO(fpatch.getvalue()),
+                                              fto,
+                                              engine)
+                self.assertEqual(to_size, len(to_data))
+                self.assertEqual(fto.getvalue(), to_data)
+
+        # Moved data is found in the from data, except for the part of
+        # the window with the moved data boundary not in its from window.
+        self.assertLess(len(fpatch.getvalue()), 30000)
+
+        # No windows are needed if the from and to data fits.
+        fpatch = BytesIO()
+        detools.create_patch(BytesIO(read_file('tests/files/foo/old')),
+                             BytesIO(read_file('tests/files/foo/new')),
+                             fpatch,
+                             max_memory=1048576)
+        self.assertEqual(fpatch.getvalue(), read_file('tests/files/foo/patch'))
+
+    def test_create_patch_max_memory_errors(self):
+        from_data = read_file(
+            'tests/files/micropython/esp8266-20180511-v1.9.4.bin')
+        to_data = read_file(
+            'tests/files/micropython/esp8266-20190125-v1.10.bin')
+
+        with self.assertRaises(detools.Error) as cm:
+            detools.create_patch(BytesIO(from_data),
+                                 BytesIO(to_data),
+                                 BytesIO(),
+                                 max_memory=1000000)
+
+        self.assertEqual(
+            str(cm.exception),
+            'Expected max memory of at least 1048576 bytes, but got 1000000.')
+
+        with self.assertRaises(detools.Error) as cm:
+            detools.create_patch(BytesIO(from_data),
+                                 BytesIO(to_data),
+                                 BytesIO(),
+                                 data_format='arm-cortex-m4',
+                                 max_memory=1048576)
+
+        self.assertEqual(str(cm.exception),
+                         'Data formats are not supported with max memory.')
+
+        # The from and to data are read into memory.
+        with self.assertRaises(detools.Error) as cm:
+            detools.create_patch(BytesIO(from_data),
+                                 BytesIO(to_data),
+                                 BytesIO(),
+                                 max_memory=2097152)
+
+        self.assertEqual(
+            str(cm.exception),
+            'Expected max memory of at least 2292356 bytes, but got 2097152. '
+            'The chunks index and the from and to data not memory mapped use '
+            '1243780 bytes.')
+
+        datas = [
+            ('bsdiff', 'in-place'),
+            ('bsdiff', 'bsdiff'),
+            ('cdc-bsdiff', 'sequential'),
+            ('match-blocks', 'sequential')
+        ]
+
+        for algorithm, patch_type in datas:
+            with self.assertRaises(detools.Error) as cm:
+                detools.create_patch(BytesIO(from_data),
+                                     BytesIO(to_data),
+                                     BytesIO(),
+                                     algorithm=algorithm,
+                                     patch_type=patch_type,
+                                     memory_size=2097152,
+                                     segment_size=65536,
+                                     max_memory=2097152)
+
+            self.assertEqual(
+                str(cm.exception),
+                'Max memory is only supported by sequential patches created '
+                'by the bsdiff algorithm.')
+
     def test_create_and_apply_patch_bsdiff(self):
         self.assert_create_and_apply_patch(
             'tests/files/bsdiff.py',
@@ -440,6 +819,347 @@ class DetoolsTest(unittest.TestCase):
             'tests/files/READ-ME.rst',
             'tests/files/sais-READ-ME.patch')
 
+    def test_create_and_apply_patch_divsufsort_mt(self):
+        for suffix_array_threads in [None, 1, 2, 4]:
+            self.assert_create_and_apply_patch(
+                'tests/files/micropython/esp8266-20180511-v1.9.4.bin',
+                'tests/files/micropython/esp8266-20190125-v1.10.bin',
+                'tests/files/micropython/esp8266-20180511-v1.9.4--20190125-v1.10.patch',
+                suffix_array_algorithm='divsufsort-mt',
+                suffix_array_threads=suffix_array_threads)
+
+    def test_create_and_apply_patch_64_bits_suffix_array(self):
+        with patch('detools.create.SUFFIX_ARRAY_32_MAX_SIZE', 0):
+            for use_mmap in [False, True]:
+                self.assert_create_and_apply_patch(
+                    'tests/files/micropython/esp8266-20180511-v1.9.4.bin',
+                    'tests/files/micropython/esp8266-20190125-v1.10.bin',
+                    'tests/files/micropython/esp8266-20180511-v1.9.4--20190125-v1.10.patch',
+                    use_mmap=use_mmap)
+
+    def test_create_and_apply_patch_suffix_array_cache(self):
+        with tempfile.TemporaryDirectory() as suffix_array_cache_dir:
+            for use_mmap in [False, True]:
+                self.assert_create_and_apply_patch(
+                    'tests/files/micropython/esp8266-20180511-v1.9.4.bin',
+                    'tests/files/micropython/esp8266-20190125-v1.10.bin',
+                    'tests/files/micropython/esp8266-20180511-v1.9.4--20190125-v1.10.patch',
+                    use_mmap=use_mmap,
+                    suffix_array_cache_dir=suffix_array_cache_dir)
+
+            self.assertEqual(len(os.listdir(suffix_array_cache_dir)), 1)
+
+            # The suffix array is not created again, not even by the
+            # multi-threaded divsufsort algorithm.
+            for suffix_array_algorithm in ['divsufsort', 'divsufsort-mt']:
+                with patch('detools.create.create_suffix_array') as create:
+                    self.assert_create_patch(
+                        'tests/files/micropython/esp8266-20180511-v1.9.4.bin',
+                        'tests/files/micropython/esp8266-20190125-v1.10.bin',
+                        'tests/files/micropython/esp8266-20180511-v1.9.4--20190125-v1.10.patch',
+                        suffix_array_algorithm=suffix_array_algorithm,
+                        suffix_array_cache_dir=suffix_array_cache_dir)
+                    self.assertEqual(create.call_count, 0)
+
+            self.assertEqual(len(os.listdir(suffix_array_cache_dir)), 1)
+
+    def test_create_patch_in_place_data_format_suffix_array_cache(self):
+        # The from data of each segment is only used once, so its
+        # suffix array is not cached.
+        with tempfile.TemporaryDirectory() as suffix_array_cache_dir:
+            detools.create_patch(
+                BytesIO(read_file('tests/files/foo/old')),
+                BytesIO(read_file('tests/files/foo/new')),
+                BytesIO(),
+                patch_type='in-place',
+                memory_size=3000,
+                segment_size=500,
+                data_format='arm-cortex-m4',
+                suffix_array_cache_dir=suffix_array_cache_dir)
+
+            self.assertEqual(os.listdir(suffix_array_cache_dir), [])
+
+    def test_create_patch_mmap_write_error(self):
+        class FailingWriter(BytesIO):
+
+            def write(self, data):
+                raise OSError('Disk full.')
+
+        # The original error is raised, even if the chunks generator
+        # is closed early while the data is memory mapped.
+        with open('tests/files/micropython/esp8266-20180511-v1.9.4.bin',
+                  'rb') as ffrom:
+            with open('tests/files/micropython/esp8266-20190125-v1.10.bin',
+                      'rb') as fto:
+                with self.assertRaises(OSError) as cm:
+                    detools.create_patch(ffrom,
+                                         fto,
+                                         FailingWriter(),
+                                         compression='none',
+                                         use_mmap=True)
+
+        self.assertEqual(str(cm.exception), 'Disk full.')
+
+    def test_chunks_producer_stop(self):
+        # A chunks iterator without close(), like the one created by
+        # the bsdiff extension.
+        chunks = iter(100 * [65536 * b'1'])
+        producer = ChunksProducer(chunks)
+        producer.start()
+        self.assertEqual(producer.get(), 65536 * b'1')
+        producer.stop()
+        self.assertFalse(producer.is_alive())
+        self.assertGreater(len(list(chunks)), 0)
+
+        # Stop after all chunks have been created.
+        producer = ChunksProducer(iter([b'1', b'2']))
+        producer.start()
+        self.assertEqual(producer.get(), b'12')
+        self.assertIsNone(producer.get())
+        producer.stop()
+        self.assertFalse(producer.is_alive())
+
+        # Stop after chunk creation failed.
+        def failing_chunks():
+            yield 65536 * b'1'
+
+            raise ValueError('Bad chunk.')
+
+        producer = ChunksProducer(failing_chunks())
+        producer.start()
+        self.assertEqual(producer.get(), 65536 * b'1')
+
+        with self.assertRaises(ValueError):
+            producer.get()
+
+        producer.stop()
+        self.assertFalse(producer.is_alive())
+
+    def test_create_patches(self):
+        from_filename = 'tests/files/micropython/esp8266-20180511-v1.9.4.bin'
+        to_filename = 'tests/files/micropython/esp8266-20190125-v1.10.bin'
+        patch_filename_prefix = (
+            'tests/files/micropython/esp8266-20180511-v1.9.4--20190125-v1.10')
+        datas = [
+            ('lzma', '.patch', 1),
+            ('none', '-none.patch', 2),
+            ('heatshrink', '-heatshrink.patch', None)
+        ]
+
+        for compression, patch_suffix, jobs in datas:
+            for use_mmap in [False, True]:
+                fpatches = [BytesIO(), BytesIO(), BytesIO()]
+
+                with open(from_filename, 'rb') as ffrom:
+                    with open(to_filename, 'rb') as fto:
+                        ftos = [fto, BytesIO(read_file(to_filename)), BytesIO()]
+                        detools.create_patches(ffrom,
+                                               ftos,
+                                               fpatches,
+                                               compression=compression,
+                                               use_mmap=use_mmap,
+                                               jobs=jobs)
+
+                expected = read_file(patch_filename_prefix + patch_suffix)
+                self.assertEqual(fpatches[0].getvalue(), expected)
+                self.assertEqual(fpatches[1].getvalue(), expected)
+
+                # Empty to data.
+                fto = BytesIO()
+                fpatch = BytesIO()
+
+                with open(from_filename, 'rb') as ffrom:
+                    detools.create_patch(ffrom,
+                                         fto,
+                                         fpatch,
+                                         compression=compression)
+
+                self.assertEqual(fpatches[2].getvalue(), fpatch.getvalue())
+
+    def test_create_patches_filenames_processes(self):
+        from_filename = 'tests/files/micropython/esp8266-20180511-v1.9.4.bin'
+        to_filename = 'tests/files/micropython/esp8266-20190125-v1.10.bin'
+        expected = read_file(
+            'tests/files/micropython/esp8266-20180511-v1.9.4--20190125-v1.10.patch')
+
+        with tempfile.TemporaryDirectory() as directory:
+            suffix_array_cache_dir = os.path.join(directory, 'cache')
+
+            for cache_dir in [None, suffix_array_cache_dir]:
+                patch_filenames = [
+                    os.path.join(directory, 'foo.patch'),
+                    os.path.join(directory, 'foo-2.patch')
+                ]
+                detools.create_patches_filenames(
+                    from_filename,
+                    [to_filename, to_filename],
+                    patch_filenames,
+                    suffix_array_cache_dir=cache_dir,
+                    jobs=2,
+                    use_processes=True)
+
+                for patch_filename in patch_filenames:
+                    self.assertEqual(read_file(patch_filename), expected)
+
+            self.assertEqual(len(os.listdir(suffix_array_cache_dir)), 1)
+
+    def test_create_patches_bad_number_of_patch_files(self):
+        with self.assertRaises(detools.Error) as cm:
+            detools.create_patches(BytesIO(), [BytesIO()], [])
+
+        self.assertEqual(str(cm.exception), 'Got 1 to files, but 0 patch files.')
+
+    def test_create_patches_to(self):
+        datas = [
+            ('tests/files/foo/old', 'tests/files/foo/patch'),
+            ('tests/files/foo/new', None),
+            ('tests/files/foo/old', 'tests/files/foo/patch')
+        ]
+
+        for memory_limit in [None, 1, 100000]:
+            ffroms = [open(from_filename, 'rb') for from_filename, _ in datas]
+            fpatches = [BytesIO() for _ in datas]
+
+            with open('tests/files/foo/new', 'rb') as fto:
+                stats = detools.create_patches_to(fto,
+                                                  ffroms,
+                                                  fpatches,
+                                                  jobs=2,
+                                                  memory_limit=memory_limit)
+
+            for ffrom in ffroms:
+                ffrom.close()
+
+            self.assertEqual(len(stats), 3)
+
+            for (_, patch_filename), fpatch, patch_stats in zip(datas,
+                                                                fpatches,
+                                                                stats):
+                if patch_filename is not None:
+                    self.assertEqual(fpatch.getvalue(),
+                                     read_file(patch_filename))
+
+                self.assertEqual(patch_stats.from_size, 2780)
+                self.assertEqual(patch_stats.to_size, 2780)
+                self.assertEqual(patch_stats.patch_size,
+                                 len(fpatch.getvalue()))
+                self.assertGreaterEqual(patch_stats.time, 0)
+
+    def test_create_and_apply_patch_stats(self):
+        from_data = read_file('tests/files/foo/old')
+        to_data = read_file('tests/files/foo/new')
+        datas = [
+            ({}, ['read', 'suffix-sort', 'bsdiff', 'compress', 'write']),
+            ({'data_format': 'arm-cortex-m4'},
+             ['read', 'data-format', 'suffix-sort', 'bsdiff', 'compress',
+              'write']),
+            ({'patch_type': 'in-place',
+              'memory_size': 3000,
+              'segment_size': 500,
+              'jobs': 2},
+             ['read', 'suffix-sort', 'bsdiff', 'compress', 'write'])
+        ]
+
+        for kwargs, stages in datas:
+            fpatch = BytesIO()
+            stats = detools.PatchStats()
+            detools.create_patch(BytesIO(from_data),
+                                 BytesIO(to_data),
+                                 fpatch,
+                                 stats=stats,
+                                 **kwargs)
+
+            self.assertEqual(stats.from_size, 2780)
+            self.assertEqual(stats.to_size, 2780)
+            self.assertEqual(stats.patch_size, len(fpatch.getvalue()))
+            self.assertGreater(stats.chunks, 0)
+            self.assertEqual(sorted(stats.stages), sorted(stages))
+            self.assertGreaterEqual(stats.time, 0)
+            self.assertGreaterEqual(stats.cpu_time, 0)
+
+            for stage_stats in stats.stages.values():
+                self.assertGreaterEqual(stage_stats.wall_time, 0)
+                self.assertGreaterEqual(stage_stats.cpu_time, 0)
+
+        fpatch = BytesIO()
+        stats = detools.PatchStats()
+        detools.create_patch(BytesIO(from_data),
+                             BytesIO(to_data),
+                             fpatch,
+                             stats=stats)
+        chunks = stats.chunks
+        datas = [
+            ('python', ['read', 'decompress', 'apply', 'write']),
+            ('c', ['apply'])
+        ]
+
+        for engine, stages in datas:
+            fto = BytesIO()
+            stats = detools.PatchStats()
+            to_size = detools.apply_patch(BytesIO(from_data),
+                                          BytesIO(fpatch.getvalue()),
+                                          fto,
+                                          engine,
+                                          stats=stats)
+
+            self.assertEqual(fto.getvalue(), to_data)
+            self.assertEqual(stats.from_size, 2780)
+            self.assertEqual(stats.to_size, to_size)
+            self.assertEqual(stats.patch_size, len(fpatch.getvalue()))
+            self.assertEqual(stats.chunks, chunks)
+            self.assertEqual(sorted(stats.stages), sorted(stages))
+
+    def test_execute_within_memory_limit(self):
+        lock = threading.Lock()
+        running = []
+        maximum = []
+
+        def call(memory):
+            with lock:
+                running.append(memory)
+                maximum.append(sum(running))
+
+            time.sleep(0.01)
+
+            with lock:
+                running.remove(memory)
+
+            return memory
+
+        memories = [3, 4, 2, 8, 1, 1, 1]
+        calls = [(memory, call, (memory, )) for memory in memories]
+
+        with ThreadPoolExecutor(4) as executor:
+            self.assertEqual(
+                execute_within_memory_limit(executor, calls, 6),
+                memories)
+
+        # The call of 8 exceeds the limit on its own.
+        self.assertEqual(sorted(maximum)[-2:], [6, 8])
+
+    def test_create_patches_to_filenames(self):
+        with tempfile.TemporaryDirectory() as directory:
+            patch_filenames = [
+                os.path.join(directory, 'foo.patch'),
+                os.path.join(directory, 'foo-none.patch')
+            ]
+            stats = detools.create_patches_to_filenames(
+                'tests/files/micropython/esp8266-20190125-v1.10.bin',
+                2 * ['tests/files/micropython/esp8266-20180511-v1.9.4.bin'],
+                patch_filenames,
+                jobs=2,
+                memory_limit=2 ** 20,
+                compression='none')
+
+            for patch_filename, patch_stats in zip(patch_filenames, stats):
+                self.assertEqual(
+                    read_file(patch_filename),
+                    read_file('tests/files/micropython/'
+                              'esp8266-20180511-v1.9.4--20190125-v1.10-none.patch'))
+                self.assertEqual(patch_stats.patch_size,
+                                 os.path.getsize(patch_filename))
+                self.assertIn('bsdiff', patch_stats.stages)
+
     def test_create_and_apply_patch_3f5531ba56182a807a5c358f04678b3b026d3a(self):
         self.assert_create_and_apply_patch(
             'tests/files/3f5531ba56182a807a5c358f04678b3b026d3a.bin',
@@ -532,6 +1252,332 @@ class DetoolsTest(unittest.TestCase):
 
                 self.assertEqual(str(cm.exception), "Early end of patch data.")
 
+    def test_apply_patch_foo_short_from(self):
+        fnew = BytesIO()
+
+        with open('tests/files/foo/patch', 'rb') as fpatch:
+            with self.assertRaises(detools.Error) as cm:
+                detools.apply_patch(BytesIO(read_file('tests/files/foo/old')[:1000]),
+                                    fpatch,
+                                    fnew)
+
+            self.assertEqual(str(cm.exception), "Out of from data.")
+
+    def test_apply_patch_small_chunk_size(self):
+        datas = [
+            ('-none.patch', 'sequential'),
+            ('.patch', 'sequential'),
+            ('-crle.patch', 'sequential'),
+            ('-heatshrink.patch', 'sequential'),
+            ('-in-place.patch', 'in-place')
+        ]
+
+        for chunk_size in [7, 4096]:
+            with patch('detools.apply.CHUNK_SIZE', chunk_size):
+                for patch_suffix, patch_type in datas:
+                    kwargs = {'patch_type': patch_type}
+
+                    if patch_type == 'in-place':
+                        kwargs['memory_size'] = 2097152
+
+                    self.assert_apply_patch(
+                        'tests/files/micropython/esp8266-20180511-v1.9.4.bin',
+                        'tests/files/micropython/esp8266-20190125-v1.10.bin',
+                        'tests/files/micropython/esp8266-20180511-v1.9.4--'
+                        '20190125-v1.10' + patch_suffix,
+                        **kwargs)
+
+    def test_apply_patch_engines(self):
+        datas = [
+            ('-none.patch', 'sequential'),
+            ('.patch', 'sequential'),
+            ('-crle.patch', 'sequential'),
+            ('-heatshrink.patch', 'sequential'),
+            ('-in-place.patch', 'in-place')
+        ]
+
+        for engine in ['c', 'python']:
+            for patch_suffix, patch_type in datas:
+                kwargs = {'patch_type': patch_type, 'engine': engine}
+
+                if patch_type == 'in-place':
+                    kwargs['memory_size'] = 2097152
+
+                self.assert_apply_patch(
+                    'tests/files/micropython/esp8266-20180511-v1.9.4.bin',
+                    'tests/files/micropython/esp8266-20190125-v1.10.bin',
+                    'tests/files/micropython/esp8266-20180511-v1.9.4--'
+                    '20190125-v1.10' + patch_suffix,
+                    **kwargs)
+
+    def test_apply_patch_mmap(self):
+        datas = [
+            ('tests/files/foo/old', 'tests/files/foo/new', 'none.patch'),
+            ('tests/files/foo/old', 'tests/files/foo/new', 'patch'),
+            ('tests/files/foo/old', 'tests/files/foo/new', 'crle.patch'),
+            ('tests/files/foo/old', 'tests/files/foo/new', 'heatshrink.patch'),
+            ('tests/files/foo/old', 'tests/files/foo/new', 'zstd.patch'),
+            ('tests/files/foo/old', 'tests/files/foo/new', 'lz4.patch'),
+            ('tests/files/foo/new', 'tests/files/foo/old', 'backwards.patch'),
+            ('tests/files/programmer/0.8.0.bin',
+             'tests/files/programmer/0.9.0.bin',
+             '../programmer/0.8.0--0.9.0-arm-cortex-m4.patch')
+        ]
+
+        for engine in ['auto', 'python']:
+            for from_filename, to_filename, patch_filename in datas:
+                patch_filename = 'tests/files/foo/' + patch_filename
+                expected = read_file(to_filename)
+
+                # Write the to data after a prefix to check that the
+                # current to file position is respected.
+                with tempfile.TemporaryFile() as fto:
+                    fto.write(b'prefix')
+
+                    with open(from_filename, 'rb') as ffrom:
+                        with open(patch_filename, 'rb') as fpatch:
+                            to_size = detools.apply_patch(ffrom,
+                                                          fpatch,
+                                                          fto,
+                                                          engine,
+                                                          use_mmap=True)
+
+                    self.assertEqual(to_size, len(expected))
+                    self.assertEqual(fto.tell(), 6 + to_size)
+                    fto.seek(0)
+                    self.assertEqual(fto.read(), b'prefix' + expected)
+
+                # Files that cannot be memory mapped are read and
+                # written as usual.
+                fto = BytesIO()
+
+                with open(from_filename, 'rb') as ffrom:
+                    with open(patch_filename, 'rb') as fpatch:
+                        detools.apply_patch(BytesIO(ffrom.read()),
+                                            fpatch,
+                                            fto,
+                                            engine,
+                                            use_mmap=True)
+
+                self.assertEqual(fto.getvalue(), expected)
+
+    def test_apply_patch_mmap_filenames(self):
+        to_size = detools.apply_patch_filenames('tests/files/foo/old',
+                                                'tests/files/foo/patch',
+                                                'foo.new',
+                                                use_mmap=True)
+
+        self.assertEqual(to_size, 2780)
+        self.assertEqual(read_file('foo.new'), read_file('tests/files/foo/new'))
+
+    def test_apply_patch_mmap_errors(self):
+        datas = [
+            ('diff-data-too-long.patch', 'Patch diff data too long.'),
+            ('extra-data-too-long.patch', 'Patch extra data too long.'),
+            ('short.patch', 'End of patch not found.')
+        ]
+
+        for patch_filename, message in datas:
+            with tempfile.TemporaryFile() as fto:
+                with open('tests/files/foo/old', 'rb') as ffrom:
+                    with open('tests/files/foo/' + patch_filename,
+                              'rb') as fpatch:
+                        with self.assertRaises(detools.Error) as cm:
+                            detools.apply_patch(ffrom,
+                                                fpatch,
+                                                fto,
+                                                'python',
+                                                use_mmap=True)
+
+                self.assertEqual(str(cm.exception), message)
+
+        # From data too short.
+        with tempfile.TemporaryFile() as fto:
+            with open('tests/files/foo/patch', 'rb') as fpatch:
+                with self.assertRaises(detools.Error) as cm:
+                    detools.apply_patch(BytesIO(b'\x00'),
+                                        fpatch,
+                                        fto,
+                                        'python',
+                                        use_mmap=True)
+
+        self.assertEqual(str(cm.exception), 'Out of from data.')
+
+    def test_apply_patch_hdiffpatch_mmap(self):
+        expected = read_file('tests/files/foo/new')
+
+        for cache_size in [None, 1, 4096, 1 << 30]:
+            with tempfile.TemporaryFile() as fto:
+                fto.write(b'prefix')
+
+                with open('tests/files/foo/old', 'rb') as ffrom:
+                    with open('tests/files/foo/hdiffpatch.patch',
+                              'rb') as fpatch:
+                        to_size = detools.apply_patch(
+                            ffrom,
+                            fpatch,
+                            fto,
+                            use_mmap=True,
+                            hdiffpatch_cache_size=cache_size)
+
+                self.assertEqual(to_size, len(expected))
+                self.assertEqual(fto.tell(), 6 + to_size)
+                fto.seek(0)
+                self.assertEqual(fto.read(), b'prefix' + expected)
+
+    def test_apply_patch_hdiffpatch_errors(self):
+        # From data too short.
+        for use_mmap in [False, True]:
+            with tempfile.TemporaryFile() as fto:
+                with open('tests/files/foo/hdiffpatch.patch', 'rb') as fpatch:
+                    with self.assertRaises(detools.Error) as cm:
+                        detools.apply_patch(BytesIO(b'\x00'),
+                                            fpatch,
+                                            fto,
+                                            use_mmap=use_mmap)
+
+            self.assertEqual(str(cm.exception),
+                             'Expected from size 2780, but got 1.')
+
+    def test_apply_patch_c_engine_not_supported(self):
+        datas = [
+            ('tests/files/foo/zstd.patch',
+             "The C engine does not support compression 'zstd'."),
+            ('tests/files/foo/heatshrink-10-5.patch',
+             'Heatshrink header.'),
+            ('tests/files/foo/arm-cortex-m4.patch',
+             'Data formats are not supported by the C engine.')
+        ]
+
+        for patch_filename, message in datas:
+            with self.assertRaises(detools.Error) as cm:
+                detools.apply_patch_filenames('tests/files/foo/old',
+                                              patch_filename,
+                                              'foo.new',
+                                              engine='c')
+
+            self.assertEqual(str(cm.exception), message)
+
+            # The automatic engine falls back to the Python engine.
+            detools.apply_patch_filenames('tests/files/foo/old',
+                                          patch_filename,
+                                          'foo.new')
+            self.assertEqual(read_file('foo.new'),
+                             read_file('tests/files/foo/new'))
+
+    def test_apply_patch_c_engine_corrupt_patch(self):
+        with self.assertRaises(detools.Error) as cm:
+            detools.apply_patch_filenames(
+                'tests/files/foo/old',
+                'tests/files/foo/diff-data-too-long.patch',
+                'foo.new',
+                engine='c')
+
+        self.assertEqual(str(cm.exception), 'Corrupt patch.')
+
+    def test_apply_patch_c_engine_chunks(self):
+        """The C engine reads and writes file-like objects in chunks,
+        without loading the from or patch data, or buffering the to
+        data.
+
+        """
+
+        class Writer(object):
+
+            def __init__(self):
+                self.chunks = []
+
+            def write(self, data):
+                self.chunks.append(len(data))
+
+                return len(data)
+
+        rng = random.Random(0)
+        from_data = rng.randbytes(4000000)
+        to_data = bytearray(from_data)
+        to_data[1000:1010] = rng.randbytes(10)
+        fpatch = BytesIO()
+        detools.create_patch(BytesIO(from_data),
+                             BytesIO(bytes(to_data)),
+                             fpatch,
+                             compression='none')
+        ffrom = BytesIO(from_data)
+        fpatch = BytesIO(fpatch.getvalue())
+        fto = Writer()
+        tracemalloc.start()
+
+        try:
+            to_size = detools.apply_patch(ffrom, fpatch, fto, engine='c')
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        self.assertEqual(to_size, len(to_data))
+        self.assertEqual(sum(fto.chunks), len(to_data))
+        self.assertLessEqual(max(fto.chunks), 65536)
+        self.assertLess(peak, 1000000)
+
+        # The from data starts at the current from file position.
+        ffrom = BytesIO(b'prefix' + from_data)
+        ffrom.seek(6)
+        fto = BytesIO()
+        detools.apply_patch(ffrom, BytesIO(fpatch.getvalue()), fto, 'c')
+        self.assertEqual(fto.getvalue(), to_data)
+
+        # Errors raised by the file-like objects are not replaced.
+        class FailingWriter(object):
+
+            def write(self, data):
+                raise OSError('Disk full.')
+
+        for engine in ['c', 'auto']:
+            with self.assertRaises(OSError) as cm:
+                detools.apply_patch(BytesIO(from_data),
+                                    BytesIO(fpatch.getvalue()),
+                                    FailingWriter(),
+                                    engine)
+
+            self.assertEqual(str(cm.exception), 'Disk full.')
+
+    def test_apply_patch_c_engine_partially_written(self):
+        from_data = read_file(
+            'tests/files/micropython/esp8266-20180511-v1.9.4.bin')
+        to_data = read_file('tests/files/micropython/esp8266-20190125-v1.10.bin')
+        patch = read_file('tests/files/micropython/esp8266-20180511-v1.9.4--'
+                          '20190125-v1.10.patch')
+        datas = [
+            (patch + 100 * b'\x00', 'Corrupt patch.'),
+            (patch[:-100], 'Not enough patch data.')
+        ]
+
+        # The Python engine is not used once the C engine has written
+        # to-data, as that would append to the partial to-data.
+        for patch, message in datas:
+            fto = BytesIO()
+
+            with self.assertRaises(detools.Error) as cm:
+                detools.apply_patch(BytesIO(from_data),
+                                    BytesIO(patch),
+                                    fto,
+                                    'auto')
+
+            self.assertEqual(str(cm.exception), message)
+            actual = fto.getvalue()
+            self.assertGreater(len(actual), 0)
+            self.assertLess(len(actual), len(to_data))
+            self.assertEqual(actual, to_data[:len(actual)])
+
+    def test_apply_patch_bad_engine(self):
+        with self.assertRaises(detools.Error) as cm:
+            detools.apply_patch_filenames('tests/files/foo/old',
+                                          'tests/files/foo/patch',
+                                          'foo.new',
+                                          engine='rust')
+
+        self.assertEqual(
+            str(cm.exception),
+            "Expected engine 'auto', 'c' or 'python', but got 'rust'.")
+
     def test_apply_patch_foo_long(self):
         fnew = BytesIO()
 
@@ -889,6 +1935,37 @@ class DetoolsTest(unittest.TestCase):
                                            'tests/files/random/patch-bsdiff.bin',
                                            patch_type='bsdiff')
 
+    def test_create_patch_in_threads(self):
+        datas = [
+            (
+                'tests/files/foo/old',
+                'tests/files/foo/new',
+                'tests/files/foo/patch'
+            ),
+            (
+                'tests/files/micropython/esp8266-20180511-v1.9.4.bin',
+                'tests/files/micropython/esp8266-20190125-v1.10.bin',
+                'tests/files/micropython/esp8266-20180511-v1.9.4--20190125-v1.10.patch'
+            ),
+            (
+                'tests/files/shell/old',
+                'tests/files/shell/new',
+                'tests/files/shell/patch'
+            )
+        ]
+
+        with ThreadPoolExecutor(4) as executor:
+            futures = [
+                executor.submit(self.assert_create_patch,
+                                from_filename,
+                                to_filename,
+                                patch_filename)
+                for from_filename, to_filename, patch_filename in 2 * datas
+            ]
+
+            for future in futures:
+                future.result()
+
     def test_pack_unpack_size(self):
         datas = [
             (-16_000_000_000, b'\xc0\x80\xe5\x9aw'),
@@ -57,6 +57,108 @@ class DetoolsSuffixArrayTest(unittest.TestCase):
             detools.suffix_array.divsufsort(data, suffix_array)
             self.assertEqual(suffix_array, expected)
 
+            for threads in range(1, 5):
+                suffix_array = bytearray(len(expected))
+                detools.suffix_array.divsufsort_mt(data,
+                                                   suffix_array,
+                                                   threads)
+                self.assertEqual(suffix_array, expected)
+
+    def test_suffix_array_divsufsort64(self):
+        datas = [
+            read_file('tests/files/micropython/esp8266-20180511-v1.9.4.bin'),
+            1000 * b'abcdefghijkl' + 1000 * b'\x00\x01',
+            b'1234',
+            b''
+        ]
+
+        for data in datas:
+            suffix_array = bytearray(4 * (len(data) + 1))
+            detools.suffix_array.divsufsort(data, suffix_array)
+            expected = bytearray().join([
+                struct.pack('=q', value)
+                for value in struct.unpack('={}i'.format(len(data) + 1),
+                                           suffix_array)
+            ])
+
+            suffix_array = bytearray(len(expected))
+            detools.suffix_array.divsufsort64(data, suffix_array)
+            self.assertEqual(suffix_array, expected)
+
+    def test_suffix_array_too_small(self):
+        with self.assertRaises(ValueError) as cm:
+            detools.suffix_array.divsufsort(b'1234', bytearray(16))
+
+        self.assertEqual(str(cm.exception), 'Suffix array too small.')
+
+        with self.assertRaises(ValueError) as cm:
+            detools.suffix_array.divsufsort64(b'1234', bytearray(20))
+
+        self.assertEqual(str(cm.exception), 'Suffix array too small.')
+
+    def test_suffix_array_divsufsort_mt(self):
+        datas = [
+            read_file('tests/files/micropython/esp8266-20180511-v1.9.4.bin'),
+            1000 * b'abcdefghijkl' + 1000 * b'\x00\x01'
+        ]
+
+        for data in datas:
+            expected = bytearray(4 * (len(data) + 1))
+            detools.suffix_array.divsufsort(data, expected)
+
+            for threads in [1, 2, 3, 8]:
+                suffix_array = bytearray(len(expected))
+                detools.suffix_array.divsufsort_mt(data,
+                                                   suffix_array,
+                                                   threads)
+                self.assertEqual(suffix_array, expected)
+
+    def test_suffix_array_divsufsort_mt_bad_threads(self):
+        with self.assertRaises(ValueError) as cm:
+            detools.suffix_array.divsufsort_mt(b'1234', bytearray(20), 0)
+
+        self.assertEqual(str(cm.exception), 'Threads must be at least 1.')
+
+    def test_suffix_array_offset(self):
+        data = 100 * b'abcdefghijkl' + 100 * b'\x00\x01' + b'1234'
+        suffix_array_32 = bytearray(4 * (len(data) + 1))
+        detools.suffix_array.divsufsort(data, suffix_array_32)
+        suffix_array_64 = bytearray(8 * (len(data) + 1))
+        detools.suffix_array.divsufsort64(data, suffix_array_64)
+
+        for offset in [0, 1, 7, 600, len(data) - 1, len(data)]:
+            expected_32 = bytearray(4 * (len(data) - offset + 1))
+            detools.suffix_array.divsufsort(data[offset:], expected_32)
+            expected_64 = bytearray(8 * (len(data) - offset + 1))
+            detools.suffix_array.divsufsort64(data[offset:], expected_64)
+
+            for suffix_array in [suffix_array_32, suffix_array_64]:
+                for expected in [expected_32, expected_64]:
+                    actual = bytearray(len(expected))
+                    detools.suffix_array.offset(suffix_array,
+                                                offset,
+                                                actual)
+                    self.assertEqual(actual, expected)
+
+    def test_suffix_array_offset_errors(self):
+        suffix_array = bytearray(4 * 5)
+        detools.suffix_array.divsufsort(b'1234', suffix_array)
+
+        with self.assertRaises(ValueError) as cm:
+            detools.suffix_array.offset(suffix_array[:-1], 0, bytearray(20))
+
+        self.assertEqual(str(cm.exception), 'Bad suffix array size.')
+
+        with self.assertRaises(ValueError) as cm:
+            detools.suffix_array.offset(suffix_array, 5, bytearray(4))
+
+        self.assertEqual(str(cm.exception), 'Bad offset.')
+
+        with self.assertRaises(ValueError) as cm:
+            detools.suffix_array.offset(suffix_array, 1, bytearray(20))
+
+        self.assertEqual(str(cm.exception), 'Bad result suffix array size.')
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,70 @@
+import os
+import time
+import tempfile
+import unittest
+
+from detools.suffix_array_cache import SuffixArrayCache
+
+
+def fill(value):
+    def create(suffix_array):
+        suffix_array[:] = len(suffix_array) * value
+
+    return create
+
+
+class DetoolsSuffixArrayCacheTest(unittest.TestCase):
+
+    def test_get_and_put(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = SuffixArrayCache(directory)
+            key = cache.key(b'1234', 'divsufsort')
+            self.assertNotEqual(key, cache.key(b'1234', 'sais'))
+            self.assertNotEqual(key, cache.key(b'1235', 'divsufsort'))
+            self.assertEqual(key, cache.key(b'1234', 'divsufsort-mt'))
+            self.assertIsNone(cache.get(key, 20))
+
+            with cache.put(key, 20, fill(b'\x01')) as suffix_array:
+                self.assertEqual(suffix_array[:], 20 * b'\x01')
+
+            with cache.get(key, 20) as suffix_array:
+                self.assertEqual(suffix_array[:], 20 * b'\x01')
+
+            # Wrong size is a miss.
+            self.assertIsNone(cache.get(key, 40))
+            self.assertEqual(os.listdir(directory), [key + '.sa'])
+
+    def test_put_failure(self):
+        def create(suffix_array):
+            raise ValueError()
+
+        with tempfile.TemporaryDirectory() as directory:
+            cache = SuffixArrayCache(directory)
+            key = cache.key(b'1234', 'divsufsort')
+
+            with self.assertRaises(ValueError):
+                cache.put(key, 20, create)
+
+            self.assertEqual(os.listdir(directory), [])
+
+    def test_evict_least_recently_used(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = SuffixArrayCache(directory, 250)
+            keys = [cache.key(bytes([i]), 'divsufsort') for i in range(3)]
+
+            for i, key in enumerate(keys[:2]):
+                cache.put(key, 100, fill(b'\x00')).close()
+                os.utime(os.path.join(directory, key + '.sa'),
+                         (time.time() - 10 + i, time.time() - 10 + i))
+
+            # Use the first suffix array to make the second the least
+            # recently used.
+            cache.get(keys[0], 100).close()
+            cache.put(keys[2], 100, fill(b'\x00')).close()
+
+            self.assertEqual(sorted(os.listdir(directory)),
+                             sorted([keys[0] + '.sa', keys[2] + '.sa']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import random
+import unittest
+import tracemalloc
+from io import BytesIO
+
+import zstandard
+from detools.create import ZstdCompressor
+from detools.apply import ZstdDecompressor
+from detools.apply import PatchReader
+
+
+class DetoolsZstdTest(unittest.TestCase):
+
+    def test_compress_and_decompress(self):
+        datas = [
+            [b'A'],
+            [b'ABBCC', b'CBBA'],
+            [126 * b'A', b'', b'A'],
+            [random.Random(0).randbytes(100000)]
+        ]
+
+        for chunks in datas:
+            compressor = ZstdCompressor()
+            compressed = b''
+
+            for chunk in chunks:
+                compressed += compressor.compress(chunk)
+
+            compressed += compressor.flush()
+            decompressor = ZstdDecompressor(len(compressed))
+            data = b''
+
+            for i in range(0, len(compressed), 7):
+                self.assertEqual(decompressor.needs_input, True)
+                self.assertEqual(decompressor.eof, False)
+                data += decompressor.decompress(compressed[i:i + 7], 3)
+
+                while not decompressor.needs_input and not decompressor.eof:
+                    data += decompressor.decompress(b'', 3)
+
+            self.assertEqual(decompressor.eof, True)
+            self.assertEqual(data, b''.join(chunks))
+
+    def test_decompress_memory_usage(self):
+        """The decompressed data must not be kept in memory once read.
+
+        """
+
+        data = random.Random(0).randbytes(16000000)
+        compressed = zstandard.ZstdCompressor(level=1).compress(data)
+        fpatch = BytesIO(compressed)
+        offset = 0
+
+        tracemalloc.start()
+
+        try:
+            patch_reader = PatchReader(fpatch, 'zstd')
+
+            while offset < len(data):
+                size = min(len(data) - offset, 65536)
+                chunk = patch_reader.decompress(size)
+                self.assertEqual(chunk, data[offset:offset + size])
+                offset += size
+
+            self.assertTrue(patch_reader.eof)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        self.assertLess(peak, 2000000)
+
+
+    def test_decompress_output_size(self):
+        """Highly compressible data must be decompressed at most `size`
+        bytes at a time.
+
+        """
+
+        data = 64000000 * b'\x00'
+        compressed = zstandard.ZstdCompressor(level=1).compress(data)
+        decompressor = ZstdDecompressor(len(compressed))
+        size = 0
+
+        tracemalloc.start()
+
+        try:
+            while not decompressor.eof:
+                if decompressor.needs_input:
+                    chunk = compressed[:4096]
+                    compressed = compressed[4096:]
+                else:
+                    chunk = b''
+
+                chunk = decompressor.decompress(chunk, 65536)
+                self.assertLessEqual(len(chunk), 65536)
+                self.assertEqual(chunk, len(chunk) * b'\x00')
+                size += len(chunk)
+
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        self.assertEqual(size, len(data))
+        self.assertLess(peak, 2000000)
+
+if __name__ == '__main__':
+    unittest.main()